@@ -31,17 +31,26 @@
 
 import multiprocessing
 
+# Settings used by this Cnchi instance (see main_window). Child processes
+# inherit it, so modules without a settings reference can read it here
+settings = None
+
 
 class Settings(object):
-    """ Store all Cnchi setup options here """
+    """ Store all Cnchi setup options here
+        Settings live in a multiprocessing manager, so they are shared by
+        the GUI and the installer process. Each get() only transfers the
+        value asked for, and set() wakes up anyone waiting for a change """
 
     def __init__(self):
         """ Initialize default configuration """
 
-        # Creates a one element size queue
-        self.settings = multiprocessing.Queue(1)
+        self.manager = multiprocessing.Manager()
+
+        # Held while a setting is updated. Notified after each change.
+        self.changed = self.manager.Condition()
 
-        self.settings.put({
+        self.settings = self.manager.dict({
             'alternate_package_list': '',
             'auto_device': '/dev/sda',
             'bootloader': 'grub2',
@@ -58,8 +67,12 @@ class Settings(object):
             'desktop_ask': True,
             'desktop_manager': 'lightdm',
             'desktops': [],
+            'download_max_connections_per_mirror': 2,
+            'download_max_in_flight_bytes': 64 * 1024 * 1024,
+            'download_max_workers': 4,
             'enable_alongside': True,
             'encrypt_home': False,
+            'events_interval': 0.25,
             'f2fs': False,
             'feature_aur': False,
             'feature_bluetooth': False,
@@ -78,6 +91,8 @@ class Settings(object):
             'fullname': '',
             'GRUB_CMDLINE_LINUX': '',
             'hostname': 'reboen',
+            'http_keep_alive': True,
+            'http_pool_size': 4,
             'install_id': '',
             'is_vbox': False,
             'keyboard_layout': '',
@@ -94,6 +109,8 @@ class Settings(object):
             'network_manager': 'NetworkManager',
             'partition_mode': 'automatic',
             'password': '',
+            'pipelined_install': False,
+            'pipelined_install_waves': 4,
             'proxies': None,
             'rankmirrors_done': False,
             'rankmirrors_result': '',
@@ -127,35 +144,33 @@ class Settings(object):
             'zfs_pool_name': 'reborn',
             'zfs_pool_id': 0})
 
-    def _get_settings(self):
-        """ Get a copy of our settings """
-        settings = self.settings.get()
-        copy = settings.copy()
-        self.settings.put(settings)
-        return copy
-
-    def _update_settings(self, new_settings):
-        """ Updates global settings """
-        settings = self.settings.get()
-        try:
-            settings.update(new_settings)
-        finally:
-            self.settings.put(settings)
+    def __getstate__(self):
+        """ The manager itself can't be pickled (its proxies can) """
+        state = self.__dict__.copy()
+        state['manager'] = None
+        return state
 
     def get(self, key):
         """ Get one setting value """
-        settings = self._get_settings()
-        return settings.get(key, None)
+        return self.settings.get(key, None)
 
     def set(self, key, value):
         """ Set one setting's value """
-        settings = self._get_settings()
-        current = settings.get(key, 'keyerror')
-        exists = 'keyerror' != current
+        with self.changed:
+            current = self.settings.get(key, 'keyerror')
+            exists = 'keyerror' != current
+
+            if exists and current and isinstance(current, list) and not isinstance(value, list):
+                value = current + [value]
 
-        if exists and current and isinstance(current, list) and not isinstance(value, list):
-            settings[key].append(value)
-        else:
-            settings[key] = value
+            self.settings[key] = value
+            self.changed.notify_all()
 
-        self._update_settings(settings)
+    def wait_for(self, key, timeout=None):
+        """ Waits until a setting has a true value (instead of polling it).
+            Returns the setting value (false if timeout expired) """
+        with self.changed:
+            self.changed.wait_for(
+                lambda: self.settings.get(key, None),
+                timeout)
+            return self.settings.get(key, None)
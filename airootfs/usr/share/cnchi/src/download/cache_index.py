@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# cache_index.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Index of already verified package files (so they are not hashed again) """
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+
+# Name of the index file stored in each cache directory
+INDEX_NAME = '.cnchi-hash-index.db'
+
+# Block size used when hashing files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Store changes to disk after this number of new entries
+COMMIT_INTERVAL = 100
+
+# ioctl to share data blocks between two files (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def hash_file(path, hash_type):
+    """ Gets hash_type (sha256, md5...) hash from a file """
+    new_hash = hashlib.new(hash_type)
+    with open(path, 'rb') as hash_file_obj:
+        for block in iter(lambda: hash_file_obj.read(HASH_BLOCK_SIZE), b''):
+            new_hash.update(block)
+    return new_hash.hexdigest()
+
+
+class HashIndex(object):
+    """ Maps (path, size, mtime, inode) to the hash of a file.
+        An entry is only trusted while the file has the same size, mtime
+        and inode it had when it was hashed """
+
+    def __init__(self, db_path=':memory:'):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT NOT NULL, '
+            'hash_type TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime INTEGER NOT NULL, '
+            'inode INTEGER NOT NULL, '
+            'digest TEXT NOT NULL, '
+            'PRIMARY KEY (path, hash_type))')
+        self.conn.commit()
+
+    def lookup(self, path, hash_type):
+        """ Returns the stored hash of path, or None if it is unknown or
+            the file has changed since it was hashed """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, inode, digest FROM files '
+                'WHERE path = ? AND hash_type = ?',
+                (path, hash_type)).fetchone()
+        if row is None:
+            return None
+        size, mtime, inode, digest = row
+        if (size, mtime, inode) != (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return None
+        return digest
+
+    def store(self, path, hash_type, digest):
+        """ Remembers that path (as it is now) has this hash """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                (path, hash_type, stat.st_size, stat.st_mtime_ns,
+                 stat.st_ino, digest))
+            self.pending += 1
+            if self.pending >= COMMIT_INTERVAL:
+                self.conn.commit()
+                self.pending = 0
+
+    def get_checksum(self, path, hash_type):
+        """ Returns the hash of path, computing it only if the index does
+            not have a valid entry """
+        digest = self.lookup(path, hash_type)
+        if digest is None:
+            digest = hash_file(path, hash_type)
+            self.store(path, hash_type, digest)
+        return digest
+
+    def flush(self):
+        """ Stores pending changes to disk """
+        with self.lock:
+            if self.pending:
+                self.conn.commit()
+                self.pending = 0
+
+    def close(self):
+        """ Stores pending changes and closes the index """
+        self.flush()
+        with self.lock:
+            self.conn.close()
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_index(directory, persistent=False):
+    """ Returns the index of directory. Persistent indexes are stored in
+        the directory itself (if it is writable) so they survive between
+        installations, the others only live in memory.
+        Each caller gets an index of the kind it asks for (the first
+        caller does not decide for the others) """
+    directory = os.path.abspath(directory)
+    key = (directory, persistent)
+    with _INDEXES_LOCK:
+        if key not in _INDEXES:
+            index = None
+            if persistent and os.access(directory, os.W_OK):
+                db_path = os.path.join(directory, INDEX_NAME)
+                try:
+                    index = HashIndex(db_path)
+                except sqlite3.Error as db_error:
+                    logging.debug(
+                        "Can't open hash index %s: %s", db_path, db_error)
+            if index is None:
+                index = HashIndex()
+            _INDEXES[key] = index
+        return _INDEXES[key]
+
+
+def flush_all():
+    """ Stores pending changes of all indexes """
+    with _INDEXES_LOCK:
+        indexes = list(_INDEXES.values())
+    for index in indexes:
+        index.flush()
+
+
+def link_or_copy(src, dst):
+    """ Puts a copy of src in dst. A hard link is used if both are in the
+        same filesystem, a reflink if the filesystem supports it, and a
+        full copy only if nothing else works.
+        Returns how it was done ('link', 'reflink' or 'copy') """
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError as os_error:
+        # Whatever the reason (EXDEV, EPERM, EACCES, EROFS...), try to copy
+        logging.debug("Can't link %s to %s: %s", src, dst, os_error)
+
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+        return 'reflink'
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+
+    shutil.copy(src, dst)
+    return 'copy'
@@ -30,13 +30,15 @@
 
 import os
 import logging
-import queue
+import time
 
-import pacman.pac as pac
+import pacman.handle_service as handle_service
 import download.metalink as ml
 import download.download_requests as download_requests
+import download.session_pool as session_pool
 
 import misc.extra as misc
+import misc.event_bus as event_bus
 
 
 class DownloadPackages(object):
@@ -67,19 +69,21 @@ class DownloadPackages(object):
             self.xz_cache_dirs = []
 
         self.callback_queue = callback_queue
+        self.events = event_bus.get_event_bus(callback_queue)
 
         # Create pacman cache dir (it's ok if it already exists)
         os.makedirs(self.pacman_cache_dir, mode=0o755, exist_ok=True)
 
-        # Stores last issued event for each event type
-        # (to prevent repeating events)
-        self.last_event = {}
-
         # List of packages' metalinks
         self.metalinks = None
 
-    def start(self, metalinks=None):
-        """ Begin download """
+    def start(self, metalinks=None, on_package_ready=None,
+              downloads_bar_only=False):
+        """ Begin download
+            on_package_ready(element) is called each time a package is ready
+            in pacman's cache (from a download thread).
+            If downloads_bar_only is True, the main progress bar is left to
+            the installer (only the downloads bar shows download progress) """
         if metalinks:
             self.metalinks = metalinks
 
@@ -92,19 +96,39 @@ class DownloadPackages(object):
             txt = _("Can't create download package list.")
             raise misc.InstallError(txt)
 
-        proxies = self.settings.get("proxies")
+        proxies = self.get_setting("proxies", None)
 
         download = download_requests.Download(
             self.pacman_cache_dir,
             self.xz_cache_dirs,
             self.callback_queue,
-            proxies)
+            proxies,
+            max_workers=self.get_setting(
+                'download_max_workers',
+                download_requests.MAX_WORKERS),
+            max_in_flight_bytes=self.get_setting(
+                'download_max_in_flight_bytes',
+                download_requests.MAX_IN_FLIGHT_BYTES),
+            max_connections_per_mirror=self.get_setting(
+                'download_max_connections_per_mirror',
+                download_requests.MAX_CONNECTIONS_PER_MIRROR),
+            sessions=session_pool.get_session_pool(),
+            on_package_ready=on_package_ready,
+            downloads_bar_only=downloads_bar_only)
 
         if not download.start(self.metalinks):
             # When we can't download (even one package), we stop right here
             txt = _("Can't download needed packages. Cnchi can't continue.")
             raise misc.InstallError(txt)
 
+    def get_setting(self, key, default):
+        """ Gets a setting value (or default if it is not set) """
+        if self.settings:
+            value = self.settings.get(key)
+            if value is not None:
+                return value
+        return default
+
     def url_sort_helper(self, url):
         """ helper method for sorting mirror urls """
         if not url:
@@ -123,15 +147,17 @@ class DownloadPackages(object):
         self.queue_event('percent', '0')
         self.queue_event(
             'info', _('Creating the list of packages to download...'))
-        processed_packages = 0
         total_packages = len(self.package_names)
+        start = time.perf_counter()
 
         self.metalinks = {}
 
         try:
-            pacman = pac.Pac(
-                conf_path=self.pacman_conf_file,
-                callback_queue=self.callback_queue)
+            # Reuse the handle (and its databases) of previous stages
+            pacman = handle_service.get_handle_service().get_pac(
+                self.pacman_conf_file,
+                self.callback_queue,
+                stage="download")
             if pacman is None:
                 return None
         except Exception as ex:
@@ -141,41 +167,47 @@ class DownloadPackages(object):
             logging.error(message)
             return
 
+        def on_progress(processed_packages, total_packages):
+            """ Show progress to the user """
+            percent = round(float(processed_packages / total_packages), 2)
+            self.queue_event('percent', str(percent))
+
         try:
-            for package_name in self.package_names:
-                metalink = ml.create(pacman, package_name,
-                                     self.pacman_conf_file)
-                if metalink is None:
-                    txt = "Error creating metalink for package %s. Installation will stop"
-                    logging.error(txt, package_name)
-                    txt = _("Error creating metalink for package {0}. "
-                            "Installation will stop").format(package_name)
-                    raise misc.InstallError(txt)
-
-                # Get metalink info
-                metalink_info = ml.get_info(metalink)
-
-                # Update downloads list with the new info from
-                # the processed metalink
-                for key in metalink_info:
-                    if key not in self.metalinks:
-                        self.metalinks[key] = metalink_info[key]
-                        urls = metalink_info[key]['urls']
-                        if self.settings:
-                            # Sort urls based on the mirrorlist
-                            # we created earlier
-                            sorted_urls = sorted(
-                                urls,
-                                key=self.url_sort_helper)
-                            self.metalinks[key]['urls'] = sorted_urls
-                        else:
-                            # When testing, settings is not available
-                            self.metalinks[key]['urls'] = urls
-
-                # Show progress to the user
-                processed_packages += 1
-                percent = round(float(processed_packages / total_packages), 2)
-                self.queue_event('percent', str(percent))
+            # Get metalink info of all packages at once (dependencies shared
+            # by several packages are only resolved once)
+            metalink_info = ml.create_info(
+                pacman,
+                self.package_names,
+                self.pacman_conf_file,
+                progress_callback=on_progress)
+
+            if metalink_info is None:
+                # Find out which package is the culprit
+                for package_name in self.package_names:
+                    if ml.create_info(pacman, package_name,
+                                      self.pacman_conf_file) is None:
+                        break
+                else:
+                    package_name = ", ".join(self.package_names)
+                txt = "Error creating metalink for package %s. Installation will stop"
+                logging.error(txt, package_name)
+                txt = _("Error creating metalink for package {0}. "
+                        "Installation will stop").format(package_name)
+                raise misc.InstallError(txt)
+
+            for key in metalink_info:
+                self.metalinks[key] = metalink_info[key]
+                urls = metalink_info[key]['urls']
+                if self.settings:
+                    # Sort urls based on the mirrorlist
+                    # we created earlier
+                    sorted_urls = sorted(
+                        urls,
+                        key=self.url_sort_helper)
+                    self.metalinks[key]['urls'] = sorted_urls
+                else:
+                    # When testing, settings is not available
+                    self.metalinks[key]['urls'] = urls
         except Exception as ex:
             template = "Can't create download set. An exception of type {0} occured. Arguments:\n{1!r}"
             message = template.format(type(ex).__name__, ex.args)
@@ -183,39 +215,18 @@ class DownloadPackages(object):
             self.metalinks = None
             return
 
-        try:
-            pacman.release()
-            del pacman
-        except Exception as ex:
-            self.metalinks = None
-            template = "Can't release pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            logging.error(message)
-            return
+        logging.debug(
+            "Download list of %d packages (%d files) created in %.2f seconds",
+            total_packages,
+            len(self.metalinks),
+            time.perf_counter() - start)
 
         # Overwrite last event (to clean up the last message)
         self.queue_event('info', "")
 
     def queue_event(self, event_type, event_text=""):
         """ Adds an event to Cnchi event queue """
-
-        if self.callback_queue is None:
-            if event_type != "percent":
-                logging.debug("%s:%s", event_type, event_text)
-            return
-
-        if event_type in self.last_event:
-            if self.last_event[event_type] == event_text:
-                # do not repeat same event
-                return
-
-        self.last_event[event_type] = event_text
-
-        try:
-            # Add the event
-            self.callback_queue.put_nowait((event_type, event_text))
-        except queue.Full:
-            pass
+        self.events.queue_event(event_type, event_text)
 
 
 def test():
@@ -38,16 +38,122 @@ import time
 import hashlib
 import socket
 import io
+import json
 import threading
+import traceback
+import urllib.parse
+
+import download.cache_index as cache_index
+import download.mirror_health as mirror_health
+import download.segmented as segmented
+import download.session_pool as session_pool
+
+import misc.event_bus as event_bus
+
+# Number of packages downloaded at the same time
+MAX_WORKERS = 4
+
+# Maximum amount of bytes being downloaded at the same time
+MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+
+# Maximum simultaneous connections to the same mirror
+MAX_CONNECTIONS_PER_MIRROR = 2
+
+# Seconds between progress updates sent to Cnchi
+PROGRESS_INTERVAL = 0.5
+
+# Seconds a package is retried (while its mirrors fail or rest) before
+# giving up. Long enough to survive a short network outage
+MAX_RETRY_TIME = 5 * 60
+
+# Partially downloaded files and their info (bytes written, mirror used)
+PART_SUFFIX = '.part'
+PART_INFO_SUFFIX = '.part.json'
+
+# Events of the main progress bar (not sent when packages are installed
+# while downloading, as the installer uses that bar then)
+MAIN_BAR_EVENTS = ['percent', 'info', 'progress_bar_show_text']
+
+
+# Block size used when hashing files already on disk
+HASH_BLOCK_SIZE = cache_index.HASH_BLOCK_SIZE
+
+
+def get_checksum(file_name, hash_type):
+    """ Gets hash_type (sha256, md5...) hash from a file """
+    return cache_index.hash_file(file_name, hash_type)
 
 
 def get_md5(file_name):
     """ Gets md5 hash from a file """
-    md5_hash = hashlib.md5()
-    with open(file_name, "rb") as myfile:
-        for line in myfile:
-            md5_hash.update(line)
-    return md5_hash.hexdigest()
+    return get_checksum(file_name, 'md5')
+
+
+def get_expected_hash(element):
+    """ Returns (hash_type, hash) of a metalink element.
+        sha256 is preferred, md5 is only used if there's no sha256.
+        Returns (None, None) if the element has no hash info """
+    hashes = element.get('hashes', {})
+    for hash_type in ('sha256', 'md5'):
+        if hashes.get(hash_type):
+            return hash_type, hashes[hash_type]
+    if element.get('hash'):
+        return 'md5', element['hash']
+    return None, None
+
+
+def write_part_info(dst_path, url, completed_length, total_length):
+    """ Stores how many bytes of dst_path have been downloaded (and from
+        which mirror) in a sidecar file next to the .part file """
+    info = {
+        'url': url,
+        'bytes': completed_length,
+        'size': total_length}
+    try:
+        with open(dst_path + PART_INFO_SUFFIX, 'w') as info_file:
+            json.dump(info, info_file)
+    except OSError as os_error:
+        logging.debug("Can't write %s partial info: %s", dst_path, os_error)
+
+
+def get_part_length(dst_path):
+    """ Returns how many bytes of dst_path can be resumed (0 if none) """
+    part_path = dst_path + PART_SUFFIX
+    try:
+        with open(dst_path + PART_INFO_SUFFIX) as info_file:
+            info = json.load(info_file)
+        part_length = os.path.getsize(part_path)
+    except (OSError, ValueError):
+        # Without a valid sidecar we can't trust the partial file
+        return 0
+
+    # Data is written before the sidecar is updated, so the partial
+    # file can't be shorter than what the sidecar says
+    if part_length < info.get('bytes', 0):
+        return 0
+    if 0 < info.get('size', 0) <= part_length:
+        # Complete (or bigger than it should be), better start again
+        return 0
+    logging.debug(
+        "Found %d bytes of %s (downloaded from %s)",
+        part_length,
+        os.path.basename(dst_path),
+        info.get('url'))
+    return part_length
+
+
+def remove_part(dst_path, keep_data=False):
+    """ Removes the partial file of dst_path and its sidecar """
+    paths = [dst_path + PART_INFO_SUFFIX]
+    if not keep_data:
+        paths.append(dst_path + PART_SUFFIX)
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as os_error:
+            logging.debug("Can't remove %s: %s", path, os_error)
 
 
 class CopyToCache(threading.Thread):
@@ -70,151 +176,366 @@ class CopyToCache(threading.Thread):
                 pass
 
 
+class ByteBudget(object):
+    """ Limits how many bytes can be in flight (being downloaded) at once.
+        A download bigger than the whole budget is allowed to run alone,
+        so it never blocks forever """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size, stop_event=None):
+        """ Waits until there is room for size bytes.
+            Returns the amount reserved (must be passed to release) """
+        size = min(max(size, 0), self.max_bytes)
+        with self.condition:
+            while self.in_flight > 0 and self.in_flight + size > self.max_bytes:
+                if stop_event and stop_event.is_set():
+                    return 0
+                self.condition.wait(0.5)
+            self.in_flight += size
+        return size
+
+    def release(self, size):
+        """ Returns size bytes to the budget """
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+class MirrorSlots(object):
+    """ Caps the number of simultaneous connections to the same mirror """
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """ Returns the semaphore of the mirror that serves url """
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.max_connections)
+            return self.semaphores[host]
+
+
+class DownloadProgress(object):
+    """ Aggregates download progress from all worker threads.
+        Workers only update counters here, the thread that called
+        Download.start is the only one that sends progress events """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # identity: [completed_length, total_length]
+        self.active = {}
+        self.downloaded = 0
+        self.transferred = 0
+        self.start_time = time.perf_counter()
+        self.last_info = None
+
+    def started(self, element, info):
+        """ A worker begins processing a package """
+        with self.lock:
+            self.active[element['identity']] = [0, 0]
+            self.last_info = info
+
+    def update(self, identity, completed_length, total_length):
+        """ A worker has received more data """
+        with self.lock:
+            current = self.active.get(identity)
+            if current is not None:
+                self.transferred += max(0, completed_length - current[0])
+                current[0] = completed_length
+                current[1] = total_length
+
+    def get_downloaded(self):
+        """ Returns how many packages have been processed """
+        with self.lock:
+            return self.downloaded
+
+    def finished(self, identity):
+        """ A worker has finished with a package """
+        with self.lock:
+            self.active.pop(identity, None)
+            self.downloaded += 1
+
+    def snapshot(self):
+        """ Returns (percent, bps, downloaded, info) of all workers """
+        with self.lock:
+            completed = sum(c for c, t in self.active.values() if t > 0)
+            total = sum(t for c, t in self.active.values() if t > 0)
+            if total > 0:
+                percent = round(float(completed / total), 2)
+            else:
+                percent = 0
+            elapsed = time.perf_counter() - self.start_time
+            if elapsed > 0:
+                bps = self.transferred // elapsed
+            else:
+                bps = 0
+            return percent, bps, self.downloaded, self.last_info
+
+
 class Download(object):
     """ Class to download packages using requests
         This class tries to previously download all necessary packages for
-        Antergos installation using requests """
-
-    def __init__(self, pacman_cache_dir, xz_cache_dirs, callback_queue, proxies=None):
-        """ Initialize Download class. Gets default configuration """
+        Antergos installation using requests.
+        Packages are downloaded by a pool of worker threads. The amount of
+        bytes in flight and the connections to each mirror are limited. """
+
+    def __init__(self, pacman_cache_dir, xz_cache_dirs, callback_queue,
+                 proxies=None, max_workers=MAX_WORKERS,
+                 max_in_flight_bytes=MAX_IN_FLIGHT_BYTES,
+                 max_connections_per_mirror=MAX_CONNECTIONS_PER_MIRROR,
+                 sessions=None, on_package_ready=None, downloads_bar_only=False):
+        """ Initialize Download class. Gets default configuration
+            on_package_ready(element) is called (from a worker thread) each
+            time a package is available in pacman's cache.
+            If downloads_bar_only is True, progress is only shown in the
+            downloads progress bar """
         self.pacman_cache_dir = pacman_cache_dir
         self.xz_cache_dirs = xz_cache_dirs
         self.callback_queue = callback_queue
         self.proxies = proxies
+        self.downloads_bar_only = downloads_bar_only
+
+        # Shared HTTP sessions (one connection pool per mirror)
+        if sessions is None:
+            sessions = session_pool.get_session_pool()
+        self.sessions = sessions
 
         if self.proxies:
             logging.debug("Will use these proxy settings: %s", self.proxies)
 
+        self.max_workers = max(1, max_workers)
+        self.byte_budget = ByteBudget(max_in_flight_bytes)
+        self.mirror_slots = MirrorSlots(max(1, max_connections_per_mirror))
+
+        # Health of each mirror, shared by all packages
+        self.mirror_health = mirror_health.MirrorHealth()
+
         # Check that pacman cache directory exists
         os.makedirs(self.pacman_cache_dir, mode=0o755, exist_ok=True)
 
-        # Stores last issued event (to prevent repeating events)
-        self.last_event = {}
+        # Events are coalesced and rate limited by the bus
+        self.events = event_bus.get_event_bus(callback_queue)
+
+        self.progress = None
+        self.stop_event = threading.Event()
+
+        # Hashes of these directories' files are stored on disk
+        self.persistent_cache_dirs = [
+            os.path.abspath(xz_cache_dir) for xz_cache_dir in self.xz_cache_dirs]
 
         self.copy_to_cache_threads = []
 
+        self.on_package_ready = on_package_ready
+
     def is_hash_ok(self, path, element=None, md5hash=None):
-        """ Checks file md5 hash """
+        """ Checks file hash (sha256 if available, md5 if not) """
         # Note: path must exist!
 
+        hash_type = None
+        expected = None
         if element:
-            # element['hash'] is not always available
-            md5hash = element.get('hash', False)
+            # element hashes are not always available
+            hash_type, expected = get_expected_hash(element)
             identity = element['identity']
             filename = element['filename']
         elif md5hash:
+            hash_type = 'md5'
+            expected = md5hash
             identity = path
             filename = path
 
-        if not md5hash:
+        if not expected:
             logging.debug('Checksum unavailable for package: %s', identity)
             self.queue_event('cache_pkgs_md5_check_failed', identity)
-            # We cannot check md5, let's assume it's ok
+            # We cannot check the hash, let's assume it's ok
             return True
 
-        if md5hash != get_md5(path):
-            logging.warning("MD5 hash of file %s does not match!", filename)
+        # The index only hashes the file if it has changed since the
+        # last time it was checked
+        if expected != self.get_index(path).get_checksum(path, hash_type):
+            logging.warning(
+                "%s hash of file %s does not match!",
+                hash_type.upper(),
+                filename)
             return False
 
-        # If we reach this point, md5 hash is ok
+        # If we reach this point, hash is ok
         return True
 
+    def get_index(self, path):
+        """ Returns the hash index of path's directory. Only the indexes
+            of the user provided caches are kept between installations """
+        directory = os.path.dirname(os.path.abspath(path))
+        persistent = directory in self.persistent_cache_dirs
+        return cache_index.get_index(directory, persistent)
+
+    def record_verified(self, path, hash_type, digest):
+        """ Remembers that path (as it is now) has this hash """
+        self.get_index(path).store(path, hash_type, digest)
+
     def start(self, downloads):
         """ Downloads using requests """
-        downloaded = 0
         total_downloads = len(downloads)
 
         self.queue_event('downloads_progress_bar', 'show')
         self.queue_event('downloads_percent', '0')
+        self.queue_event('percent', '0')
 
         self.copy_to_cache_threads = []
+        self.progress = DownloadProgress()
+        self.stop_event.clear()
 
         logging.debug(
-            "Downloading packages to pacman cache dir '%s'",
-            self.pacman_cache_dir)
+            "Downloading packages to pacman cache dir '%s' using %d workers",
+            self.pacman_cache_dir,
+            self.max_workers)
+
+        # Packages are fetched in the order they are given
+        pending = queue.Queue()
+        for identity in list(downloads):
+            pending.put(downloads.pop(identity))
+
+        workers = []
+        for _index in range(min(self.max_workers, total_downloads)):
+            worker = threading.Thread(
+                target=self.worker, args=(pending, total_downloads))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        # Only this thread sends progress events to Cnchi
+        while any(worker.is_alive() for worker in workers):
+            for worker in workers:
+                worker.join(PROGRESS_INTERVAL)
+            self.queue_progress(total_downloads)
+
+        self.queue_progress(total_downloads)
+        self.queue_event('progress_bar_show_text', '')
+
+        self.sessions.log_stats()
+
+        # Store verified hashes for the next time
+        cache_index.flush_all()
+
+        if self.stop_event.is_set():
+            return False
 
-        while len(downloads) > 0:
-            needs_to_download = True
+        # Wait until all xz packages are also copied to provided cache (if any)
+        for cache_thread in self.copy_to_cache_threads:
+            cache_thread.join()
 
-            # Get package to download from downloads list
-            identity, element = downloads.popitem()
+        self.queue_event('downloads_progress_bar', 'hide')
+        return True
 
-            self.queue_event('percent', '0')
+    def worker(self, pending, total_downloads):
+        """ Worker thread. Takes packages from the pending queue until it is
+            empty or another worker has failed """
+        while not self.stop_event.is_set():
+            try:
+                element = pending.get_nowait()
+            except queue.Empty:
+                return
 
-            txt = _("Fetching {0} {1} ({2}/{3})...").format(
-                element['identity'],
-                element['version'],
-                downloaded + 1,
-                total_downloads)
-            self.queue_event('info', txt)
-
-            dst_path = os.path.join(self.pacman_cache_dir, element['filename'])
-
-            if os.path.exists(dst_path):
-                # File already exists in destination pacman's cache
-                # (previous install?). We check the file md5 hash.
-                if not self.is_hash_ok(path=dst_path, element=element):
-                    # We're sure it's a wrong hash. Force to download it
-                    needs_to_download = True
-                else:
-                    needs_to_download = False
-                    logging.debug(
-                        "File %s found in %s cache, there is no need to download it",
-                        element['filename'],
-                        self.pacman_cache_dir)
-            else:
-                needs_to_download = True
-                # Check all cache directories
-                for xz_cache_dir in self.xz_cache_dirs:
-                    dst_xz_cache_path = os.path.join(
-                        xz_cache_dir,
-                        element['filename'])
-
-                    if (os.path.exists(dst_xz_cache_path) and
-                            self.is_hash_ok(path=dst_xz_cache_path, element=element)):
-                        # We're lucky, the package is already downloaded
-                        # in the cache the user has given us
-                        # and its md5 checks out (if there is a md5)
-                        try:
-                            shutil.copy(dst_xz_cache_path, dst_path)
-                            needs_to_download = False
-                            logging.debug(
-                                "%s found in %s cache, there is no need to download it",
-                                element['filename'],
-                                xz_cache_dir)
-                            # Get out of the cache for loop, as we managed
-                            # to find the package in this cache directory
-                            break
-                        except OSError as os_error:
-                            needs_to_download = True
-                            logging.debug(
-                                "Error copying %s to %s : %s",
-                                dst_xz_cache_path,
-                                dst_path,
-                                os_error)
-
-            if needs_to_download and not self.download_package(element, dst_path):
-                # None of the mirror urls works.
-                # Stop right here, so the user does not have to wait
-                # to download the other packages.
-                logging.error(
-                    "Can't download %s, even after trying all available mirrors",
-                    element['filename'])
-                return False
-            else:
-                downloaded += 1
+            try:
+                size = int(element.get('size', 0))
+            except (TypeError, ValueError):
+                size = 0
 
-            self.queue_event('progress_bar_show_text', '')
+            reserved = self.byte_budget.acquire(size, self.stop_event)
+            try:
+                if not self.stop_event.is_set():
+                    self.process_element(element, total_downloads)
+            except Exception as err:
+                # Do not let the other workers think everything went fine
+                logging.error(
+                    "Error processing %s: %s", element['filename'], err)
+                for line in traceback.format_exc().splitlines():
+                    logging.error(line)
+                self.stop_event.set()
+            finally:
+                self.byte_budget.release(reserved)
+
+    def process_element(self, element, total_downloads):
+        """ Checks caches for a package and downloads it if needed """
+        needs_to_download = True
+
+        txt = _("Fetching {0} {1} ({2}/{3})...").format(
+            element['identity'],
+            element['version'],
+            self.progress.get_downloaded() + 1,
+            total_downloads)
+        self.progress.started(element, txt)
 
-            downloads_percent = round(float(downloaded / total_downloads), 2)
-            self.queue_event('downloads_percent', str(downloads_percent))
+        dst_path = os.path.join(self.pacman_cache_dir, element['filename'])
 
-        # Wait until all xz packages are also copied to provided cache (if any)
-        for cache_thread in self.copy_to_cache_threads:
-            cache_thread.join()
+        if os.path.exists(dst_path):
+            # File already exists in destination pacman's cache
+            # (previous install?). We check the file md5 hash.
+            if not self.is_hash_ok(path=dst_path, element=element):
+                # We're sure it's a wrong hash. Force to download it
+                needs_to_download = True
+            else:
+                needs_to_download = False
+                logging.debug(
+                    "File %s found in %s cache, there is no need to download it",
+                    element['filename'],
+                    self.pacman_cache_dir)
+        else:
+            needs_to_download = True
+            # Check all cache directories
+            for xz_cache_dir in self.xz_cache_dirs:
+                dst_xz_cache_path = os.path.join(
+                    xz_cache_dir,
+                    element['filename'])
 
-        self.queue_event('downloads_progress_bar', 'hide')
-        return True
+                if (os.path.exists(dst_xz_cache_path) and
+                        self.is_hash_ok(path=dst_xz_cache_path, element=element)):
+                    # We're lucky, the package is already downloaded
+                    # in the cache the user has given us
+                    # and its md5 checks out (if there is a md5)
+                    try:
+                        how = cache_index.link_or_copy(
+                            dst_xz_cache_path, dst_path)
+                        needs_to_download = False
+                        hash_type, expected = get_expected_hash(element)
+                        if expected:
+                            self.record_verified(dst_path, hash_type, expected)
+                        logging.debug(
+                            "%s found in %s cache (%s), there is no need to download it",
+                            element['filename'],
+                            xz_cache_dir,
+                            how)
+                        # Get out of the cache for loop, as we managed
+                        # to find the package in this cache directory
+                        break
+                    except OSError as os_error:
+                        needs_to_download = True
+                        logging.debug(
+                            "Error copying %s to %s : %s",
+                            dst_xz_cache_path,
+                            dst_path,
+                            os_error)
+
+        if needs_to_download and not self.download_package(element, dst_path):
+            # None of the mirror urls works.
+            # Stop right here, so the user does not have to wait
+            # to download the other packages.
+            logging.error(
+                "Can't download %s, even after trying all available mirrors",
+                element['filename'])
+            self.stop_event.set()
+        else:
+            self.progress.finished(element['identity'])
+            if self.on_package_ready is not None:
+                self.on_package_ready(element)
 
     def download_package(self, element, dst_path):
         """ Package wasn't previously downloaded or its md5 was wrong
@@ -228,90 +549,250 @@ class Download(object):
             element['version'],
             len(element['urls']))
 
-        for url in element['urls']:
-            # Let's catch empty values as well as None just to be safe
-            if not url:
-                # Something bad has happened, let's try another mirror
-                download_ok = False
-                logging.debug(
-                    "Package %s-%s has an empty url for this mirror",
-                    element['identity'],
-                    element['version'])
-            else:
-                download_ok = self.download_url(url, dst_path)
-
-            if download_ok:
-                # Copy downloaded xz file to the cache the user has provided, too.
-
-                # TODO : Rethink this. Providec cache can be the ISO itself, so we
-                # can leave the ISO without any space and the installation will fail.
+        if self.download_segmented(element, dst_path):
+            return True
 
-                # copy_to_cache_thread = CopyToCache(dst_path, self.xz_cache_dirs)
-                # self.copy_to_cache_threads += [copy_to_cache_thread]
-                # copy_to_cache_thread.start()
+        urls = [url for url in element['urls'] if url]
+        if len(urls) < len(element['urls']):
+            logging.debug(
+                "Package %s-%s has empty urls for some mirrors",
+                element['identity'],
+                element['version'])
+
+        download_ok = False
+        deadline = time.monotonic() + MAX_RETRY_TIME
+        while True:
+            # Mirrors that have failed recently go last (or are skipped)
+            for url in self.mirror_health.sort_urls(urls):
+                if self.stop_event.is_set():
+                    return False
+                if not self.mirror_health.acquire(url):
+                    continue
+                try:
+                    with self.mirror_slots.get(url):
+                        download_ok = self.download_url(
+                            url,
+                            dst_path,
+                            identity=element['identity'],
+                            expected_hash=get_expected_hash(element))
+                except Exception:
+                    # Not the mirror's fault (e.g. disk full), let someone
+                    # else do its half-open test
+                    self.mirror_health.release(url)
+                    raise
+                if download_ok:
+                    self.mirror_health.record_success(url)
+                    # Copy downloaded xz file to the cache the user has provided, too.
+
+                    # TODO : Rethink this. Providec cache can be the ISO itself, so we
+                    # can leave the ISO without any space and the installation will fail.
+
+                    # copy_to_cache_thread = CopyToCache(dst_path, self.xz_cache_dirs)
+                    # self.copy_to_cache_threads += [copy_to_cache_thread]
+                    # copy_to_cache_thread.start()
+                    return True
 
-                # Get out of the for loop, as we managed
-                # to download the package
-                break
-            else:
                 # requests failed to obtain the file. Wrong url?
+                # Try the next mirror right away
+                self.mirror_health.record_failure(url)
                 msg = "Can't download %s, Cnchi will try another mirror."
                 logging.debug(msg, url)
-                # delays for 60 seconds
-                time.sleep(60)
+
+            remaining = deadline - time.monotonic()
+            if not urls or remaining <= 0:
+                break
+
+            # All mirrors have failed (or are resting, or being tested by
+            # other workers). Wait until one of them can be tried again
+            wait_time = min(remaining, self.mirror_health.get_wait_time(urls))
+            logging.debug(
+                "No mirror available for %s, waiting %.1f seconds...",
+                element['filename'],
+                wait_time)
+            if self.stop_event.wait(wait_time):
+                # Another worker has failed, there's no need to wait
+                break
 
         return download_ok
 
-    def download_url(self, url, dst_path, md5hash=""):
-        percent = 0
-        completed_length = 0
-        start = time.perf_counter()
+    def download_segmented(self, element, dst_path):
+        """ Downloads big packages in segments from several mirrors at once.
+            Returns False if the package is too small or something fails
+            (then it will be downloaded from one mirror at a time) """
+        try:
+            total_length = int(element.get('size', 0))
+        except (TypeError, ValueError):
+            total_length = 0
+
+        urls = [url for url in element['urls'] if url]
+
+        if total_length < segmented.MIN_SIZE or len(urls) < 2:
+            return False
+
+        identity = element['identity']
+
+        def on_progress(completed_length, total_length):
+            """ Updates the progress of this package """
+            if self.progress:
+                self.progress.update(identity, completed_length, total_length)
+
+        logging.debug(
+            "Downloading %s (%d bytes) in segments from %d mirrors...",
+            element['filename'],
+            total_length,
+            min(len(urls), segmented.MAX_MIRRORS))
+
+        segmented_download = segmented.SegmentedDownload(
+            urls,
+            dst_path,
+            total_length,
+            self.sessions,
+            proxies=self.proxies,
+            mirror_slots=self.mirror_slots,
+            mirror_health=self.mirror_health,
+            stop_event=self.stop_event,
+            on_progress=on_progress)
+
+        if segmented_download.run():
+            # Segments arrive out of order, so the hash can't be computed
+            # while downloading. Check it now (just one read pass)
+            if self.is_hash_ok(dst_path, element=element):
+                return True
+            logging.warning(
+                "Segmented download of %s is corrupt", element['filename'])
+            try:
+                os.remove(dst_path)
+            except OSError:
+                pass
+
+        logging.debug(
+            "Segmented download of %s failed, trying one mirror at a time",
+            element['filename'])
+        on_progress(0, total_length)
+        return False
+
+    def download_url(self, url, dst_path, md5hash="", identity=None,
+                     expected_hash=None):
+        """ Downloads url into dst_path.
+            Data is stored in a .part file first. If the download is
+            interrupted, the .part file is kept so the next try (even from
+            another mirror) can resume it using a Range request.
+            expected_hash is a (hash type, hash) tuple. The hash is computed
+            while the data arrives, so the file is never read again """
+        if not expected_hash or not expected_hash[0]:
+            expected_hash = ('md5', md5hash) if md5hash else (None, None)
+        hash_type, expected = expected_hash
+
+        part_path = dst_path + PART_SUFFIX
+        completed_length = get_part_length(dst_path)
+        headers = {}
+        if completed_length > 0:
+            headers['Range'] = 'bytes={0}-'.format(completed_length)
+            logging.debug(
+                "Resuming %s from byte %d using %s",
+                os.path.basename(dst_path),
+                completed_length,
+                url)
+
         try:
+            start = time.perf_counter()
             # By default, get waits five minutes before
             # issuing a timeout, which is too much.
             if self.proxies:
-                req = requests.get(
+                req = self.sessions.get(
                     url,
                     stream=True,
                     timeout=30,
+                    headers=headers,
                     proxies=self.proxies)
             else:
-                req = requests.get(
+                req = self.sessions.get(
                     url,
                     stream=True,
-                    timeout=30)
+                    timeout=30,
+                    headers=headers)
+
+            self.mirror_health.record_latency(url, time.perf_counter() - start)
+
+            try:
+                if req.status_code == requests.codes.partial_content and completed_length > 0:
+                    # Server accepted our range, append to what we have
+                    mode = 'ab'
+                elif req.status_code == requests.codes.ok:
+                    # Full file (server may have ignored our range)
+                    mode = 'wb'
+                    completed_length = 0
+                else:
+                    if req.status_code == requests.codes.requested_range_not_satisfiable:
+                        # Our partial file is no good, start from zero next time
+                        remove_part(dst_path)
+                    logging.debug(
+                        "Can't download %s (status %d)", url, req.status_code)
+                    return False
 
-            if req.status_code == requests.codes.ok:
                 # Get total file length
                 try:
                     total_length = int(req.headers.get('content-length'))
+                    total_length += completed_length
                 except TypeError:
                     total_length = 0
                     logging.debug(
                         "Metalink for package %s has no size info", url)
 
-                with open(dst_path, 'wb') as xz_file:
-                    for data in req.iter_content(io.DEFAULT_BUFFER_SIZE):
-                        if not data:
-                            break
-                        xz_file.write(data)
-                        completed_length += len(data)
-                        old_percent = percent
-                        if total_length > 0:
-                            percent = float(completed_length / total_length)
-                            percent = round(percent, 2)
-                        else:
-                            percent += 0.1
-                        if old_percent != percent:
-                            self.queue_event('percent', percent)
-                        bps = completed_length // (time.perf_counter() - start)
-                        msg = self.format_progress_message(percent, bps)
-                        self.queue_event('progress_bar_show_text', msg)
+                write_part_info(dst_path, url, completed_length, total_length)
+
+                new_hash = None
+                if hash_type:
+                    new_hash = hashlib.new(hash_type)
+                    if mode == 'ab':
+                        # Hash the data we already had
+                        with open(part_path, 'rb') as part_file:
+                            for block in iter(lambda: part_file.read(HASH_BLOCK_SIZE), b''):
+                                new_hash.update(block)
+
+                try:
+                    with open(part_path, mode) as xz_file:
+                        for data in req.iter_content(io.DEFAULT_BUFFER_SIZE):
+                            if not data:
+                                break
+                            xz_file.write(data)
+                            if new_hash:
+                                new_hash.update(data)
+                            completed_length += len(data)
+                            if self.progress and identity:
+                                self.progress.update(
+                                    identity, completed_length, total_length)
+                finally:
+                    # Remember how much we got (and from where)
+                    write_part_info(
+                        dst_path, url, completed_length, total_length)
+
+                if 0 < total_length != completed_length:
+                    logging.debug(
+                        "Incomplete download of %s (%d of %d bytes)",
+                        url,
+                        completed_length,
+                        total_length)
+                    return False
 
                 # Check hash of downloaded package
-                if md5hash and not self.is_hash_ok(path=dst_path, md5hash=md5hash):
-                    # Wrong md5! Force to download it again
+                if new_hash and new_hash.hexdigest() != expected:
+                    # Wrong hash! Force to download it again (from zero)
+                    logging.warning(
+                        "%s hash of %s does not match!",
+                        hash_type.upper(),
+                        url)
+                    remove_part(dst_path)
                     return False
+
+                os.replace(part_path, dst_path)
+                remove_part(dst_path, keep_data=True)
+
+                if new_hash:
+                    self.record_verified(dst_path, hash_type, expected)
+            finally:
+                # Give the connection back to the pool
+                req.close()
         except (socket.timeout,
                 requests.exceptions.Timeout,
                 requests.exceptions.ConnectionError,
@@ -321,6 +802,21 @@ class Download(object):
 
         return True
 
+    def queue_progress(self, total_downloads):
+        """ Sends the aggregated progress of all workers to Cnchi """
+        percent, bps, downloaded, info = self.progress.snapshot()
+
+        if info:
+            self.queue_event('info', info)
+        self.queue_event('percent', percent)
+        self.queue_event(
+            'progress_bar_show_text',
+            self.format_progress_message(percent, bps))
+
+        if total_downloads > 0:
+            downloads_percent = round(float(downloaded / total_downloads), 2)
+            self.queue_event('downloads_percent', str(downloads_percent))
+
     def format_progress_message(self, percent, bps):
         """ Formats speed message information """
         if bps >= (1024 * 1024):
@@ -335,21 +831,6 @@ class Download(object):
 
     def queue_event(self, event_type, event_text=None):
         """ Adds an event to Cnchi event queue """
-
-        if self.callback_queue is None:
-            if event_type != "percent":
-                logging.debug("{0}: {1}".format(event_type, event_text))
+        if self.downloads_bar_only and event_type in MAIN_BAR_EVENTS:
             return
-
-        if event_type in self.last_event:
-            if self.last_event[event_type] == event_text:
-                # do not repeat same event
-                return
-
-        self.last_event[event_type] = event_text
-
-        try:
-            # Add the event
-            self.callback_queue.put_nowait((event_type, event_text))
-        except queue.Full:
-            pass
+        self.events.queue_event(event_type, event_text)
@@ -39,9 +39,9 @@ import hashlib
 import re
 import argparse
 
-from collections import deque
+from collections import deque, OrderedDict
 
-import pyalpm
+import download.cache_index as cache_index
 
 try:
     import xml.etree.cElementTree as eTree
@@ -76,7 +76,10 @@ def get_info(metalink):
             elif elem.tag.endswith("description"):
                 element['description'] = elem.text
             elif elem.tag.endswith("hash"):
-                element['hash'] = elem.text
+                hash_type = elem.attrib.get('type', 'md5')
+                element.setdefault('hashes', {})[hash_type] = elem.text
+                if hash_type == 'md5':
+                    element['hash'] = elem.text
             elif elem.tag.endswith("url"):
                 try:
                     element['urls'].append(elem.text)
@@ -98,20 +101,28 @@ def get_info(metalink):
     return metalink_info
 
 
-def create(alpm, package_name, pacman_conf_file):
-    """ Creates a metalink to download package_name and its dependencies """
+def get_download_queue(alpm, package_name, pacman_conf_file,
+                       progress_callback=None):
+    """ Builds the download queue of package_name (a name or a list of
+        names) and their dependencies """
 
     # options = ["--conf", pacman_conf_file, "--noconfirm", "--all-deps", "--needed"]
     options = ["--conf", pacman_conf_file, "--noconfirm", "--all-deps"]
 
-    if package_name is "databases":
+    if isinstance(package_name, str):
+        package_names = [package_name]
+    else:
+        package_names = list(package_name)
+    package_name = " ".join(package_names)
+
+    if package_names == ["databases"]:
         options.append("--refresh")
     else:
-        options.append(package_name)
+        options.extend(package_names)
 
     try:
         download_queue, not_found, missing_deps = build_download_queue(
-            alpm, args=options)
+            alpm, args=options, progress_callback=progress_callback)
     except Exception as ex:
         template = "Unable to create download queue for package {0}. An exception of type {1} occured. Arguments:\n{2!r}"
         message = template.format(package_name, type(ex).__name__, ex.args)
@@ -132,11 +143,61 @@ def create(alpm, package_name, pacman_conf_file):
         logging.error(msg)
         return None
 
+    return download_queue
+
+
+def create(alpm, package_name, pacman_conf_file):
+    """ Creates a metalink to download package_name and its dependencies.
+        Only needed to export the download list as xml, use create_info
+        to get the download elements """
+
+    download_queue = get_download_queue(alpm, package_name, pacman_conf_file)
+
+    if download_queue is None:
+        return None
+
     metalink = download_queue_to_metalink(download_queue)
 
     return metalink
 
 
+def create_info(alpm, package_name, pacman_conf_file, progress_callback=None):
+    """ Returns the download elements of package_name (a name or a list of
+        names) and their dependencies (same dict get_info returns, but
+        without building any xml) """
+
+    download_queue = get_download_queue(
+        alpm, package_name, pacman_conf_file, progress_callback)
+
+    if download_queue is None:
+        return None
+
+    return download_queue_to_info(download_queue)
+
+
+def download_queue_to_info(download_queue):
+    """ Converts a download_queue object to a dict of download elements
+        (identity: element) """
+    metalink_info = {}
+
+    for pkg, urls, sigs in download_queue.sync_pkgs:
+        urls = list(urls)[:MAX_URLS]
+        element = {
+            'filename': pkg.filename,
+            'identity': pkg.name,
+            'size': str(pkg.size),
+            'version': pkg.version,
+            'description': pkg.desc,
+            'hashes': {
+                'sha256': pkg.sha256sum,
+                'md5': pkg.md5sum},
+            'hash': pkg.md5sum,
+            'urls': urls}
+        metalink_info[pkg.name] = element
+
+    return metalink_info
+
+
 """ From here comes modified code from pm2ml
     pm2ml is Copyright (C) 2012-2013 Xyne
     More info: http://xyne.archlinux.ca/projects/pm2ml """
@@ -314,106 +375,110 @@ def parse_args(args):
     return parser.parse_args(args)
 
 
-def build_download_queue(alpm, args=None):
+class SatisfierCache(object):
+    """ Remembers which package satisfies each dependency, so shared
+        dependencies (glibc, gtk3...) are only looked up once.
+        Lookups use the name/provides indexes of the Pac object, so they
+        are dict hits instead of scanning every package of every db """
+
+    def __init__(self, alpm):
+        self.local_index = alpm.get_local_index()
+        self.sync_index = alpm.get_provides_index()
+        # dep: True if an installed package satisfies it
+        self.installed = {}
+
+    def is_installed(self, dep):
+        """ Checks if dep is satisfied by an installed package """
+        if dep not in self.installed:
+            satisfier = self.local_index.find_satisfier(dep)
+            self.installed[dep] = satisfier is not None
+        return self.installed[dep]
+
+    def find_provider(self, dep):
+        """ Returns the sync package that satisfies dep (or None) """
+        return self.sync_index.find_satisfier(dep)
+
+
+def build_download_queue(alpm, args=None, satisfier_cache=None,
+                         progress_callback=None):
     """ Function to build a download queue.
-        Needs a pkgname in args """
+        Needs one or more pkgnames in args. All of them are resolved in a
+        single pass (dependencies shared by several packages are only
+        resolved once). progress_callback(processed, total) is called each
+        time a requested package (and its dependencies) has been processed """
 
     pargs = parse_args(args)
 
-    '''
-    try:
-        conf_file = pargs.conf
-        alpm = pac.Pac(conf_path=conf_file, callback_queue=None)
-    except Exception as ex:
-        logging.error("Can't initialize pyalpm: %s", ex)
-        return None, None, None
-    '''
-
     handle = alpm.get_handle()
     conf = alpm.get_config()
 
-    requested = set(pargs.pkgs)
+    if satisfier_cache is None:
+        satisfier_cache = SatisfierCache(alpm)
+
+    # Keep the requested order (so progress makes sense)
+    requested = list(OrderedDict.fromkeys(pargs.pkgs))
     other = PkgSet()
     missing_deps = list()
-    found = set()
-
-    one_repo_groups = ['cinnamon', 'mate', 'mate-extra']
-    antdb = [db for db in handle.get_syncdbs() if 'antergos' == db.name]
-    antdb = antdb[0]
-    one_repo_groups = [antdb.read_grp(one_repo_group)
-                       for one_repo_group in one_repo_groups]
-    one_repo_pkgs = {pkg for one_repo_group in one_repo_groups
-                     for pkg in one_repo_group[1] if one_repo_group}
 
-    # foreign_names = set()
-    # not_found = set()
+    # Resolve all requested names (packages and groups) at once
+    packages, groups, not_found = alpm.resolve(requested)
 
-    for pkg in requested:
-        other_grp = PkgSet()
-        for db in handle.get_syncdbs():
-            if pkg in one_repo_pkgs and 'antergos' != db.name:
-                # pkg should be sourced from the antergos repo only.
-                db = antdb
+    # Packages already added to the dependency resolution queue
+    seen = set()
+    queue = deque()
+    total = len(requested)
 
-            syncpkg = db.get_pkg(pkg)
-
-            if syncpkg:
-                other.add(syncpkg)
-                break
-            else:
-                syncgrp = db.read_grp(pkg)
-                if syncgrp:
-                    found.add(pkg)
-                    other_grp |= PkgSet(syncgrp[1])
-                    break
+    for index, name in enumerate(requested):
+        if name in groups:
+            brought = groups[name]
+        elif name in packages:
+            brought = [packages[name]]
         else:
-            other |= other_grp
-
-    # foreign_names = requested - set(x.name for x in other)
-
-    # Resolve dependencies.
-    if other and not pargs.nodeps:
-        queue = deque(other)
-        local_cache = handle.get_localdb().pkgcache
-        syncdbs = handle.get_syncdbs()
-        seen = set(queue)
-        while queue:
-            pkg = queue.popleft()
-            for dep in pkg.depends:
-                if pyalpm.find_satisfier(local_cache, dep) is None or pargs.alldeps:
-                    for db in syncdbs:
-                        prov = pyalpm.find_satisfier(db.pkgcache, dep)
-                        if prov is not None:
-                            other.add(prov)
-                            if prov.name not in seen:
-                                seen.add(prov.name)
-                                queue.append(prov)
-                            break
+            brought = []
+
+        for syncpkg in brought:
+            other.add(syncpkg)
+            if syncpkg.name not in seen:
+                seen.add(syncpkg.name)
+                queue.append(syncpkg)
+
+        # Resolve dependencies (of this package and the ones it brings).
+        while queue and not pargs.nodeps:
+            queued_pkg = queue.popleft()
+            for dep in queued_pkg.depends:
+                if pargs.alldeps or not satisfier_cache.is_installed(dep):
+                    prov = satisfier_cache.find_provider(dep)
+                    if prov is not None:
+                        other.add(prov)
+                        if prov.name not in seen:
+                            seen.add(prov.name)
+                            queue.append(prov)
                     else:
                         missing_deps.append(dep)
 
-    found |= set(other.pkgs)
-    not_found = requested - found
+        if progress_callback:
+            progress_callback(index + 1, total)
+
+    not_found = set(not_found)
     if pargs.needed:
         other = PkgSet(list(check_cache(conf, other)))
 
     download_queue = DownloadQueue()
 
+    # Does each repo need signatures? (computed once per repo, not per package)
+    db_sigs = {}
+    pkg_sigs = {}
+    for db in handle.get_syncdbs():
+        siglevel = get_siglevel(conf, db.name)
+        db_sigs[db.name] = needs_sig(siglevel, pargs.sigs, 'Database')
+        pkg_sigs[db.name] = needs_sig(siglevel, pargs.sigs, 'Package')
+
     if pargs.db:
         for db in handle.get_syncdbs():
-            try:
-                siglevel = conf[db.name]['SigLevel'].split()[0]
-            except KeyError:
-                siglevel = None
-            download_sig = needs_sig(siglevel, pargs.sigs, 'Database')
-            download_queue.add_db(db, download_sig)
+            download_queue.add_db(db, db_sigs[db.name])
 
     for pkg in other:
-        try:
-            siglevel = conf[pkg.db.name]['SigLevel'].split()[0]
-        except KeyError:
-            siglevel = None
-        download_sig = needs_sig(siglevel, pargs.sigs, 'Package')
+        download_sig = pkg_sigs.get(pkg.db.name, False)
         urls = set(os.path.join(url, pkg.filename) for url in pkg.db.servers)
         # Limit to MAX_URLS url
         while len(urls) > MAX_URLS:
@@ -441,12 +506,22 @@ def get_checksum(path, typ):
 
 
 def check_cache(conf, pkgs):
-    """ Checks package checksum in cache """
+    """ Checks package checksum in cache.
+        Files that have not changed since they were last checked are
+        not hashed again (see cache_index) """
     for pkg in pkgs:
         for cache in conf.options['CacheDir']:
             fpath = os.path.join(cache, pkg.filename)
+            # Pacman cache dirs are only indexed in memory (as in Download)
+            index = cache_index.get_index(cache, persistent=False)
             for checksum in ('sha256', 'md5'):
-                real_checksum = get_checksum(fpath, checksum)
+                try:
+                    real_checksum = index.get_checksum(fpath, checksum)
+                except FileNotFoundError:
+                    real_checksum = -1
+                except IOError as io_error:
+                    logging.error(io_error)
+                    real_checksum = None
                 correct_checksum = getattr(pkg, checksum + 'sum')
                 if real_checksum is None or real_checksum != correct_checksum:
                     yield pkg
@@ -456,6 +531,15 @@ def check_cache(conf, pkgs):
             break
 
 
+def get_siglevel(conf, repo):
+    """ Returns the first word of the repo's SigLevel (or None) """
+    try:
+        return conf.get_siglevel(repo)
+    except AttributeError:
+        # Not a PacmanConfig
+        return None
+
+
 def needs_sig(siglevel, insistence, prefix):
     """ Determines if a signature should be downloaded.
         The siglevel is the pacman.conf SigLevel for the given repo.
@@ -517,6 +601,42 @@ def test():
         logging.error(message)
 
 
+def benchmark(package_names, pacman_conf_file="/etc/pacman.conf"):
+    """ Compares the time needed to get the download elements of
+        package_names through xml (create + get_info) and directly
+        (create_info) """
+    import time
+    import pacman.pac as pac
+
+    pacman = pac.Pac(conf_path=pacman_conf_file, callback_queue=None)
+
+    start = time.perf_counter()
+    xml_info = {}
+    for package_name in package_names:
+        xml_info.update(get_info(create(pacman, package_name, pacman_conf_file)))
+    xml_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    direct_info = {}
+    for package_name in package_names:
+        direct_info.update(create_info(pacman, package_name, pacman_conf_file))
+    direct_time = time.perf_counter() - start
+
+    pacman.release()
+
+    print("{0} packages, {1} files".format(len(package_names), len(direct_info)))
+    print("xml (create + get_info): {0:.2f} s".format(xml_time))
+    print("direct (create_info):    {0:.2f} s".format(direct_time))
+    if set(xml_info) != set(direct_info):
+        print("Warning: both methods returned different packages!")
+
+
 ''' Test case '''
 if __name__ == '__main__':
-    test()
+    import sys
+
+    if len(sys.argv) > 2 and sys.argv[1] == "benchmark":
+        # ./metalink.py benchmark gnome gnome-extra ...
+        benchmark(sys.argv[2:])
+    else:
+        test()
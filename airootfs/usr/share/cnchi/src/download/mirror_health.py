@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# mirror_health.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tracks the health of the mirrors used during a download run """
+
+import logging
+import random
+import threading
+import time
+import urllib.parse
+
+# Consecutive failures needed to stop using a mirror for a while
+FAILURE_THRESHOLD = 2
+
+# Backoff (seconds) before trying a failed mirror again
+BACKOFF_BASE = 2
+BACKOFF_MAX = 60
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class MirrorState(object):
+    """ Health information of one mirror """
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.last_latency = None
+        self.state = CLOSED
+        # When an open mirror can be tried again
+        self.retry_at = 0
+        # True while the (only) half-open test request is running
+        self.probing = False
+
+
+class MirrorHealth(object):
+    """ Circuit breaker for each mirror host.
+        A mirror that fails FAILURE_THRESHOLD times in a row is opened (not
+        used) for an exponential backoff time with jitter. After that, one
+        request is allowed (half-open): if it works the mirror is closed
+        (used again), if it fails the mirror is opened for a longer time.
+        One instance is shared by all packages (and threads) of a run. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mirrors = {}
+
+    @staticmethod
+    def get_host(url):
+        """ Mirrors are identified by their host """
+        return urllib.parse.urlparse(url).netloc
+
+    def get_state(self, url):
+        """ Returns the state of url's mirror (lock must be held) """
+        host = self.get_host(url)
+        if host not in self.mirrors:
+            self.mirrors[host] = MirrorState()
+        return self.mirrors[host]
+
+    @staticmethod
+    def get_backoff(failures):
+        """ Exponential backoff with jitter """
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(0, failures - 1)))
+        return delay * random.uniform(0.5, 1.5)
+
+    def acquire(self, url):
+        """ Returns True if url's mirror can be used right now """
+        with self.lock:
+            mirror = self.get_state(url)
+            if mirror.state == CLOSED:
+                return True
+            if mirror.state == OPEN and time.monotonic() >= mirror.retry_at:
+                mirror.state = HALF_OPEN
+            if mirror.state == HALF_OPEN and not mirror.probing:
+                mirror.probing = True
+                return True
+            return False
+
+    def release(self, url):
+        """ Gives back a mirror got with acquire that hasn't been used
+            (so its half-open test can be done by someone else) """
+        with self.lock:
+            self.get_state(url).probing = False
+
+    def record_latency(self, url, latency):
+        """ Stores the time the mirror needed to answer """
+        with self.lock:
+            self.get_state(url).last_latency = latency
+
+    def record_success(self, url):
+        """ The mirror has worked, use it normally """
+        with self.lock:
+            mirror = self.get_state(url)
+            if mirror.state != CLOSED:
+                logging.debug("Mirror %s is working again", self.get_host(url))
+            mirror.consecutive_failures = 0
+            mirror.state = CLOSED
+            mirror.probing = False
+
+    def record_failure(self, url):
+        """ The mirror has failed """
+        with self.lock:
+            mirror = self.get_state(url)
+            mirror.consecutive_failures += 1
+            mirror.probing = False
+            if (mirror.state == HALF_OPEN or
+                    mirror.consecutive_failures >= FAILURE_THRESHOLD):
+                backoff = self.get_backoff(mirror.consecutive_failures)
+                mirror.state = OPEN
+                mirror.retry_at = time.monotonic() + backoff
+                logging.debug(
+                    "Mirror %s failed %d times, won't be used for %.1f seconds",
+                    self.get_host(url),
+                    mirror.consecutive_failures,
+                    backoff)
+
+    def sort_urls(self, urls):
+        """ Returns urls with healthy mirrors first. The original order
+            (mirror ranking) is kept among mirrors in the same condition """
+        with self.lock:
+            def sort_key(url):
+                """ Closed mirrors first, then by failures """
+                mirror = self.get_state(url)
+                return (mirror.state != CLOSED, mirror.consecutive_failures)
+            return sorted(urls, key=sort_key)
+
+    def get_wait_time(self, urls):
+        """ Seconds to wait until one of urls' mirrors can be tried again """
+        now = time.monotonic()
+        with self.lock:
+            waits = []
+            for url in urls:
+                mirror = self.get_state(url)
+                if mirror.state == CLOSED:
+                    return 0
+                if mirror.state == OPEN:
+                    waits.append(max(0, mirror.retry_at - now))
+            if not waits:
+                # Only half-open mirrors being tested by other threads
+                return BACKOFF_BASE
+            return min(waits)
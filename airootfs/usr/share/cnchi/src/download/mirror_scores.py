@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# mirror_scores.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Remembers how each Arch mirror performed in previous runs (moving
+    averages of its download rate and latency, and the last sync delay
+    seen), so mirror ranking can start from known good candidates """
+
+import json
+import logging
+import os
+import threading
+import time
+
+# Where scores are stored (a writable place of the live media, so they
+# survive between runs when the media is persistent)
+SCORES_PATH = "/var/cache/cnchi/mirror-scores.json"
+
+# Weight of a new measurement in the moving averages
+EWMA_WEIGHT = 0.3
+
+# Scores older than this are forgotten (in seconds)
+MAX_AGE = 30 * 24 * 3600
+
+# Minimum number of known good mirrors needed to skip probing the rest
+MIN_CANDIDATES = 5
+
+
+def ewma(average, value, weight=EWMA_WEIGHT):
+    """ Exponentially weighted moving average """
+    if average is None:
+        return value
+    return (1 - weight) * average + weight * value
+
+
+class MirrorScores(object):
+    """ Persistent mirror scores (url: score dict) """
+
+    def __init__(self, path=SCORES_PATH):
+        self.path = path
+        self.scores = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Reads stored scores (forgetting the old ones) """
+        try:
+            with open(self.path) as scores_file:
+                scores = json.load(scores_file)
+        except (OSError, ValueError) as err:
+            logging.debug("No mirror scores loaded from %s: %s", self.path, err)
+            scores = {}
+        if not isinstance(scores, dict):
+            scores = {}
+
+        oldest = time.time() - MAX_AGE
+        with self.lock:
+            self.scores = dict(
+                (url, score) for url, score in scores.items()
+                if isinstance(score, dict) and score.get('seen', 0) >= oldest)
+        logging.debug("%d mirror scores loaded", len(self.scores))
+
+    def save(self):
+        """ Stores scores for the next run """
+        with self.lock:
+            scores = dict(self.scores)
+        try:
+            os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+            with open(self.path + ".part", "w") as scores_file:
+                json.dump(scores, scores_file)
+            os.replace(self.path + ".part", self.path)
+        except OSError as os_error:
+            logging.warning("Can't store mirror scores: %s", os_error)
+
+    def get_score(self, url):
+        """ Returns the score dict of a mirror (None if unknown) """
+        with self.lock:
+            return self.scores.get(url, None)
+
+    def update(self, mirror, latency=None):
+        """ Stores a new latency measurement of a mirror (a mirror status
+            dict). A latency of None means that the mirror did not answer """
+        url = mirror['url']
+        with self.lock:
+            score = self.scores.setdefault(
+                url, {'rate': None, 'latency': None, 'failures': 0})
+            score['seen'] = time.time()
+            score['country_code'] = mirror.get('country_code', '')
+            score['delay'] = mirror.get('delay', None)
+            if latency is None:
+                score['failures'] += 1
+                return
+            score['failures'] = 0
+            score['latency'] = ewma(score['latency'], latency)
+
+    def update_rate(self, url, rate):
+        """ Stores a new download rate measurement (bytes/s) of a mirror """
+        with self.lock:
+            score = self.scores.get(url, None)
+            if score is not None and rate > 0:
+                score['rate'] = ewma(score['rate'], rate)
+
+    def is_good(self, url):
+        """ True if the mirror answered the last time it was probed """
+        score = self.get_score(url)
+        return (score is not None and score['failures'] == 0 and
+                score['latency'] is not None)
+
+    def sort_key(self, url):
+        """ Sort key of a mirror (known fast mirrors first, then the ones
+            with lower latency and then unknown ones) """
+        score = self.get_score(url)
+        if score is None or not self.is_good(url):
+            return (2, 0)
+        if score['rate']:
+            return (0, -score['rate'])
+        return (1, score['latency'])
+
+    def get_candidates(self, mirrors, country_code=None):
+        """ Returns the mirrors that should be probed, best known first.
+            If there are enough known good mirrors (in the user's country,
+            if there are enough there) only those are returned. Otherwise,
+            all mirrors are returned (the ones in the user's country first) """
+        country_code = (country_code or '').lower()
+
+        def is_local(mirror):
+            """ True if the mirror is in the user's country """
+            return mirror.get('country_code', '').lower() == country_code
+
+        known = [mirror for mirror in mirrors if self.is_good(mirror['url'])]
+        local = [mirror for mirror in known if is_local(mirror)]
+        if country_code and len(local) >= MIN_CANDIDATES:
+            candidates = local
+        elif len(known) >= MIN_CANDIDATES:
+            candidates = known
+        else:
+            candidates = list(mirrors)
+        return sorted(
+            candidates,
+            key=lambda mirror: (
+                self.sort_key(mirror['url']), not is_local(mirror)))
+
+    def get_mirrors(self):
+        """ Returns the known good mirrors as mirror status dicts (used
+            when the mirror status can't be downloaded) """
+        with self.lock:
+            urls = list(self.scores.keys())
+        mirrors = []
+        for url in urls:
+            if self.is_good(url):
+                score = self.get_score(url)
+                mirrors.append({
+                    'url': url,
+                    'country_code': score.get('country_code', ''),
+                    'delay': score.get('delay', None)})
+        return mirrors
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# segmented.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Downloads a big file in segments (HTTP ranges) from several mirrors """
+
+import io
+import logging
+import os
+import socket
+import threading
+import time
+
+from collections import deque
+
+import requests
+
+# Files smaller than this are downloaded from a single mirror
+MIN_SIZE = 32 * 1024 * 1024
+
+# Size of each segment
+SEGMENT_SIZE = 4 * 1024 * 1024
+
+# Maximum number of mirrors used at the same time for the same file
+MAX_MIRRORS = 4
+
+# Seconds without receiving data before a segment is considered stalled
+STALL_TIMEOUT = 15
+
+# A segment won't be split if less than this remains to be downloaded
+MIN_SPLIT_SIZE = 512 * 1024
+
+# Maximum failures allowed to a mirror before it is not used anymore
+MAX_MIRROR_FAILURES = 2
+
+
+class Segment(object):
+    """ Range of bytes [start, end) of the file """
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        # Next byte to be written
+        self.position = start
+        # url of the mirror that is downloading this segment
+        self.owner = None
+
+    def remaining(self):
+        """ Bytes left to download """
+        return max(0, self.end - self.position)
+
+    def is_done(self):
+        """ True if all bytes have been downloaded """
+        return self.position >= self.end
+
+
+class SegmentedDownload(object):
+    """ Splits a file into segments that are fetched with HTTP Range
+        requests from several mirrors at once and written in place
+        (os.pwrite) into a preallocated file.
+        When a mirror stalls its segment goes back to the queue, and when a
+        fast mirror runs out of work it takes half of what is left of the
+        segment of a slower mirror. """
+
+    def __init__(self, urls, dst_path, total_length, sessions, proxies=None,
+                 mirror_slots=None, mirror_health=None, stop_event=None,
+                 on_progress=None):
+        self.mirror_health = mirror_health
+        urls = [url for url in urls if url]
+        if self.mirror_health is not None:
+            urls = self.mirror_health.sort_urls(urls)
+        self.urls = []
+        for url in urls:
+            if len(self.urls) >= MAX_MIRRORS:
+                break
+            # Do not use mirrors that have been failing
+            if self.mirror_health is None or self.mirror_health.acquire(url):
+                self.urls.append(url)
+        self.dst_path = dst_path
+        self.total_length = total_length
+        self.sessions = sessions
+        self.proxies = proxies
+        self.mirror_slots = mirror_slots
+        self.stop_event = stop_event
+        self.on_progress = on_progress
+
+        self.lock = threading.Lock()
+        self.segments = []
+        self.pending = deque()
+        self.completed_length = 0
+        # Transfer rate (bytes per second) of each mirror
+        self.rates = {}
+        # Mirrors that do not support HTTP ranges
+        self.no_ranges = set()
+        self.fd = None
+        # Set when this file can't be downloaded this way
+        self.aborted = threading.Event()
+
+    def stopped(self):
+        """ True if this download (or all of them) has been cancelled """
+        if self.aborted.is_set():
+            return True
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def create_segments(self):
+        """ Splits the file in segments """
+        self.segments = []
+        for start in range(0, self.total_length, SEGMENT_SIZE):
+            end = min(start + SEGMENT_SIZE, self.total_length)
+            self.segments.append(Segment(start, end))
+        self.pending = deque(self.segments)
+
+    def preallocate(self):
+        """ Creates the destination file with its final size """
+        self.fd = os.open(
+            self.dst_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.posix_fallocate(self.fd, 0, self.total_length)
+        except (AttributeError, OSError):
+            # Filesystem does not support it, a sparse file will do
+            os.ftruncate(self.fd, self.total_length)
+
+    def run(self):
+        """ Downloads the file. Returns True if all segments are ok """
+        if len(self.urls) < 2 or self.total_length <= 0:
+            self.release_mirrors()
+            return False
+
+        start = time.perf_counter()
+
+        try:
+            self.preallocate()
+        except OSError as os_error:
+            logging.debug("Can't create %s: %s", self.dst_path, os_error)
+            self.release_mirrors()
+            return False
+
+        self.create_segments()
+
+        try:
+            workers = []
+            for url in self.urls:
+                worker = threading.Thread(target=self.worker, args=(url,))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+            for worker in workers:
+                worker.join()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+        download_ok = (not self.aborted.is_set() and
+                       all(segment.is_done() for segment in self.segments))
+
+        if not download_ok:
+            # Do not leave a preallocated (but incomplete) file behind
+            try:
+                os.remove(self.dst_path)
+            except OSError:
+                pass
+        else:
+            elapsed = time.perf_counter() - start
+            logging.debug(
+                "%s downloaded in %d segments from %d mirrors (%.2f s)",
+                os.path.basename(self.dst_path),
+                len(self.segments),
+                len(self.urls),
+                elapsed)
+            for url in self.urls:
+                logging.debug(
+                    "  %s: %.2f KiB/s", url, self.rates.get(url, 0) / 1024)
+
+        return download_ok
+
+    def worker(self, url):
+        """ Downloads segments from the mirror url until there is no
+            more work left (or the mirror fails too many times) """
+        try:
+            failures = 0
+            while failures < MAX_MIRROR_FAILURES and not self.stopped():
+                segment = self.next_segment(url)
+                if segment is None:
+                    break
+
+                if self.mirror_slots is not None:
+                    with self.mirror_slots.get(url):
+                        fetch_ok = self.fetch_segment(url, segment)
+                else:
+                    fetch_ok = self.fetch_segment(url, segment)
+
+                with self.lock:
+                    segment.owner = None
+                    if not segment.is_done():
+                        # Let other mirror finish this segment
+                        self.pending.appendleft(segment)
+
+                if url in self.no_ranges:
+                    # Not a mirror failure, just can't be used this way
+                    break
+                if not fetch_ok:
+                    failures += 1
+                    if self.mirror_health is not None:
+                        self.mirror_health.record_failure(url)
+                elif self.mirror_health is not None:
+                    self.mirror_health.record_success(url)
+        finally:
+            # Even if something went wrong, so the mirror can be tested again
+            if self.mirror_health is not None:
+                self.mirror_health.release(url)
+
+    def release_mirrors(self):
+        """ Gives back the mirrors we got from mirror_health """
+        if self.mirror_health is not None:
+            for url in self.urls:
+                self.mirror_health.release(url)
+
+    def next_segment(self, url):
+        """ Gets the next segment for the mirror url. If no segment is
+            pending, takes half of the segment of a slower mirror """
+        with self.lock:
+            while self.pending:
+                segment = self.pending.popleft()
+                if not segment.is_done():
+                    segment.owner = url
+                    return segment
+
+            my_rate = self.rates.get(url, 0)
+            victim = None
+            for segment in self.segments:
+                if segment.owner is None or segment.owner == url:
+                    continue
+                if segment.remaining() < 2 * MIN_SPLIT_SIZE:
+                    continue
+                if self.rates.get(segment.owner, 0) >= my_rate:
+                    continue
+                if victim is None or segment.remaining() > victim.remaining():
+                    victim = segment
+
+            if victim is None:
+                return None
+
+            middle = victim.position + victim.remaining() // 2
+            new_segment = Segment(middle, victim.end)
+            new_segment.owner = url
+            victim.end = middle
+            self.segments.append(new_segment)
+            return new_segment
+
+    def fetch_segment(self, url, segment):
+        """ Downloads what's left of segment from url """
+        first_byte = segment.position
+        headers = {'Range': 'bytes={0}-{1}'.format(first_byte, segment.end - 1)}
+        received = 0
+        start = time.perf_counter()
+
+        try:
+            req = self.sessions.get(
+                url,
+                headers=headers,
+                stream=True,
+                timeout=(30, STALL_TIMEOUT),
+                proxies=self.proxies)
+            try:
+                if req.status_code != requests.codes.partial_content:
+                    logging.debug(
+                        "Mirror %s does not support ranges (status %d)",
+                        url,
+                        req.status_code)
+                    self.no_ranges.add(url)
+                    return False
+
+                for data in req.iter_content(io.DEFAULT_BUFFER_SIZE):
+                    if not data or self.stopped():
+                        break
+                    with self.lock:
+                        # The segment might have been split meanwhile
+                        offset = segment.position
+                        data = data[:segment.remaining()]
+                        segment.position += len(data)
+                        self.completed_length += len(data)
+                        completed_length = self.completed_length
+                    if data:
+                        os.pwrite(self.fd, data, offset)
+                        received += len(data)
+                        elapsed = time.perf_counter() - start
+                        if elapsed > 0:
+                            self.rates[url] = received / elapsed
+                        if self.on_progress:
+                            self.on_progress(completed_length, self.total_length)
+                    if segment.is_done():
+                        break
+            finally:
+                req.close()
+        except (socket.timeout,
+                requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as connection_error:
+            logging.debug("Segment stalled in %s: %s", url, connection_error)
+            # Slow down this mirror so others can steal its work
+            self.rates[url] = 0
+            return False
+        except OSError as os_error:
+            logging.debug("Can't write to %s: %s", self.dst_path, os_error)
+            self.aborted.set()
+            return False
+
+        return segment.is_done()
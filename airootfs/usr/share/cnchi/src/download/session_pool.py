@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# session_pool.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Shared HTTP sessions (one connection pool per mirror host) """
+
+import logging
+import threading
+import urllib.parse
+
+import requests
+import requests.adapters
+
+import config
+
+# Maximum number of connections kept open to each host
+POOL_SIZE = 4
+
+# Keep connections open between requests
+KEEP_ALIVE = True
+
+
+class SessionPool(object):
+    """ Keeps one requests session (and its connection pool) for each
+        host, so DNS lookups and TCP/TLS handshakes are reused between
+        downloads from the same mirror """
+
+    def __init__(self, pool_size=POOL_SIZE, keep_alive=KEEP_ALIVE, proxies=None):
+        self.pool_size = max(1, pool_size)
+        self.keep_alive = keep_alive
+        self.proxies = proxies
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_options(self):
+        """ Returns the options the sessions are created with """
+        return (self.pool_size, self.keep_alive, self.proxies)
+
+    def reconfigure(self, pool_size, keep_alive, proxies):
+        """ Changes pool options. Sessions created with the old ones are
+            forgotten (not closed, someone may still be using them) """
+        with self.lock:
+            self.pool_size = max(1, pool_size)
+            self.keep_alive = keep_alive
+            self.proxies = proxies
+            self.sessions = {}
+
+    @staticmethod
+    def get_host(url):
+        """ Returns the key used to store the session of url """
+        parsed = urllib.parse.urlparse(url)
+        return "{0}://{1}".format(parsed.scheme, parsed.netloc)
+
+    def create_session(self):
+        """ Creates a new session with our pool options """
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        if self.proxies:
+            session.proxies.update(self.proxies)
+        return session
+
+    def get_session(self, url):
+        """ Returns the session that must be used to connect to url """
+        host = self.get_host(url)
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.create_session()
+                self.sessions[host] = session
+        return session
+
+    def get(self, url, **kwargs):
+        """ Same as requests.get, but using the shared session of url's host """
+        return self.get_session(url).get(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """ Same as requests.head, but using the shared session of url's host """
+        return self.get_session(url).head(url, **kwargs)
+
+    def get_stats(self):
+        """ Returns a dict with the number of requests and opened connections
+            of each host. Reused connections are requests - connections """
+        stats = {}
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for host, session in sessions:
+            num_requests = 0
+            num_connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    num_requests += getattr(pool, 'num_requests', 0)
+                    num_connections += getattr(pool, 'num_connections', 0)
+            stats[host] = {
+                'requests': num_requests,
+                'connections': num_connections,
+                'reused': max(0, num_requests - num_connections)}
+        return stats
+
+    def log_stats(self):
+        """ Logs connection reuse counters """
+        stats = self.get_stats()
+        total_requests = sum(host['requests'] for host in stats.values())
+        total_reused = sum(host['reused'] for host in stats.values())
+        for host in sorted(stats):
+            logging.debug(
+                "%s: %d requests, %d connections opened, %d reused",
+                host,
+                stats[host]['requests'],
+                stats[host]['connections'],
+                stats[host]['reused'])
+        logging.debug(
+            "HTTP session pool: %d requests to %d hosts, %d connections reused",
+            total_requests,
+            len(stats),
+            total_reused)
+
+    def close(self):
+        """ Closes all sessions (and their connections) """
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+_SESSION_POOL = None
+_SESSION_POOL_LOCK = threading.Lock()
+
+
+def get_pool_options():
+    """ Reads pool options from Cnchi settings (if already created) """
+    pool_size = POOL_SIZE
+    keep_alive = KEEP_ALIVE
+    proxies = None
+    settings = config.settings
+    if settings:
+        if settings.get('http_pool_size') is not None:
+            pool_size = max(1, settings.get('http_pool_size'))
+        if settings.get('http_keep_alive') is not None:
+            keep_alive = settings.get('http_keep_alive')
+        proxies = settings.get('proxies')
+    return (pool_size, keep_alive, proxies)
+
+
+def get_session_pool():
+    """ Returns the session pool shared by everyone in this process.
+        Options are read from settings on each call, so the pool follows
+        any change (proxies are set after the first mirrors are ranked) """
+    global _SESSION_POOL
+
+    options = get_pool_options()
+    with _SESSION_POOL_LOCK:
+        if _SESSION_POOL is None:
+            _SESSION_POOL = SessionPool(*options)
+        elif _SESSION_POOL.get_options() != options:
+            logging.debug("HTTP session pool options have changed")
+            _SESSION_POOL.reconfigure(*options)
+        return _SESSION_POOL
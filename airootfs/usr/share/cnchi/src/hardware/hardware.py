@@ -33,6 +33,9 @@ import logging
 import os
 import subprocess
 
+import misc.chroot_session as chroot_session
+from installation import systemd_units
+
 _HARDWARE_MODULES_PATH = '/usr/share/cnchi/cnchi/hardware/modules'
 
 
@@ -142,6 +145,18 @@ class Hardware(object):
         for element in cmd:
             run.append(element)
 
+        session = chroot_session.get_session(dest_dir)
+        if session is not None and stdin is None:
+            try:
+                returncode, out = session.run(cmd)
+                logging.debug(out)
+                if returncode != 0:
+                    logging.debug(
+                        "Command %s exited with code %d", " ".join(cmd), returncode)
+                return
+            except OSError as err:
+                logging.debug("Chroot helper failed: %s", err)
+
         try:
             proc = subprocess.Popen(run,
                                     stdin=stdin,
@@ -149,9 +164,22 @@ class Hardware(object):
                                     stderr=subprocess.STDOUT)
             out = proc.communicate()[0]
             logging.debug(out.decode())
+            if proc.returncode != 0:
+                logging.debug(
+                    "Command %s exited with code %d", " ".join(cmd), proc.returncode)
         except OSError as err:
             logging.error("Error running command: %s", err.strerror)
 
+    @staticmethod
+    def enable_services(services, dest_dir):
+        """ Enables systemd units (at the end of the installation) """
+        systemd_units.enable(services, dest_dir)
+
+    @staticmethod
+    def disable_services(services, dest_dir):
+        """ Disables systemd units (at the end of the installation) """
+        systemd_units.disable(services, dest_dir)
+
     def __str__(self):
         return "class name: {0}, class id: {1}, vendor id: {2}, product id: {3}".format(
             self.class_name,
@@ -159,9 +159,8 @@ class Catalyst(Hardware):
         path = os.path.join(dest_dir, "etc/pacman.conf")
         self.add_repositories(path)
 
-        Hardware.chroot(["systemctl", "enable", "atieventsd"])
-        Hardware.chroot(["systemctl", "enable", "catalyst-hook"])
-        Hardware.chroot(["systemctl", "enable", "temp-links-catalyst"])
+        Hardware.enable_services(
+            ["atieventsd", "catalyst-hook", "temp-links-catalyst"], dest_dir)
 
         Hardware.chroot(["aticonfig", "--initial"], dest_dir)
 
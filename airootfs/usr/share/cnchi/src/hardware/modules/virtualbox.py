@@ -68,8 +68,8 @@ class Virtualbox(Hardware):
             modules.write("vboxsf\n")
             modules.write("vboxvideo\n")
 
-        Hardware.chroot(["systemctl", "disable", "openntpd"], dest_dir)
-        Hardware.chroot(["systemctl", "-f", "enable", "vboxservice"], dest_dir)
+        Hardware.disable_services(["openntpd"], dest_dir)
+        Hardware.enable_services(["vboxservice"], dest_dir)
 
         # This fixes bug in virtualbox-guest-modules package
         Hardware.chroot(["depmod", "-a"], dest_dir)
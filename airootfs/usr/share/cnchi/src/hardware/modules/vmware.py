@@ -54,4 +54,4 @@ class Vmware(Hardware):
     @staticmethod
     def post_install(dest_dir):
         """ Post install commands """
-        Hardware.chroot(["systemctl", "enable", "vmtoolsd"], dest_dir)
+        Hardware.enable_services(["vmtoolsd"], dest_dir)
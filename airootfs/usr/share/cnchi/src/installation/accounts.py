@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# accounts.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Creates users and groups by editing the passwd, shadow, group and
+    gshadow files of the installation directly (all changes are written at
+    once, with the files locked), instead of running useradd, usermod,
+    groupadd and chfn inside the chroot """
+
+import fcntl
+import logging
+import os
+import stat
+import time
+
+from installation import skel
+
+DEST_DIR = "/install"
+
+# Files we edit (relative to the installation root) and their fields
+ACCOUNT_FILES = {
+    'passwd': ('etc/passwd', 7),
+    'shadow': ('etc/shadow', 9),
+    'group': ('etc/group', 4),
+    'gshadow': ('etc/gshadow', 4)}
+
+# Same lock file used by shadow-utils (lckpwdf)
+LOCK_PATH = "etc/.pwd.lock"
+
+# login.defs values used if the installation does not define them
+LOGIN_DEFS = {
+    'UID_MIN': 1000,
+    'UID_MAX': 60000,
+    'SYS_UID_MIN': 500,
+    'SYS_UID_MAX': 999,
+    'GID_MIN': 1000,
+    'GID_MAX': 60000,
+    'SYS_GID_MIN': 500,
+    'SYS_GID_MAX': 999,
+    'PASS_MIN_DAYS': 0,
+    'PASS_MAX_DAYS': 99999,
+    'PASS_WARN_AGE': 7}
+
+# Mode of new home directories
+HOME_MODE = 0o700
+
+
+class AccountsError(Exception):
+    """ Error editing the account files """
+    pass
+
+
+def read_login_defs(dest_dir):
+    """ Reads the numeric values we need from etc/login.defs """
+    values = dict(LOGIN_DEFS)
+    path = os.path.join(dest_dir, "etc/login.defs")
+    try:
+        with open(path) as login_defs:
+            for line in login_defs:
+                fields = line.split()
+                if len(fields) == 2 and fields[0] in values:
+                    try:
+                        values[fields[0]] = int(fields[1])
+                    except ValueError:
+                        pass
+    except OSError as os_error:
+        logging.debug("Can't read %s: %s", path, os_error)
+    return values
+
+
+def chown_tree(path, uid, gid):
+    """ Changes the owner of a directory tree (symlinks are not followed) """
+    os.lchown(path, uid, gid)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), uid, gid)
+
+
+class Accounts(object):
+    """ In memory copy of the account files of an installation.
+        Nothing is written until commit is called """
+
+    def __init__(self, dest_dir=DEST_DIR):
+        self.dest_dir = dest_dir
+        self.login_defs = read_login_defs(dest_dir)
+        # file name: list of entries (lists of fields)
+        self.entries = {}
+        for name, (path, _fields) in ACCOUNT_FILES.items():
+            self.entries[name] = self.read_entries(path)
+        # Home directories to create after commit: (user, skel dir)
+        self.homes = []
+
+    def read_entries(self, path):
+        """ Reads an account file """
+        entries = []
+        try:
+            with open(os.path.join(self.dest_dir, path)) as account_file:
+                for line in account_file:
+                    line = line.rstrip("\n")
+                    if line:
+                        entries.append(line.split(":"))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def find(self, file_name, name):
+        """ Returns the entry of name in an account file (or None) """
+        for entry in self.entries[file_name]:
+            if entry[0] == name:
+                return entry
+        return None
+
+    def get_free_id(self, file_name, system):
+        """ Returns an unused uid (passwd) or gid (group). As useradd does,
+            system ids are taken from the top of their range and normal ids
+            are the next after the highest used one """
+        prefix = "SYS_" if system else ""
+        kind = "UID" if file_name == "passwd" else "GID"
+        first = self.login_defs["{0}{1}_MIN".format(prefix, kind)]
+        last = self.login_defs["{0}{1}_MAX".format(prefix, kind)]
+        used = set()
+        for entry in self.entries[file_name]:
+            try:
+                used.add(int(entry[2]))
+            except (IndexError, ValueError):
+                pass
+        if system:
+            for free_id in range(last, first - 1, -1):
+                if free_id not in used:
+                    return free_id
+        else:
+            in_range = [used_id for used_id in used if first <= used_id <= last]
+            free_id = max(in_range) + 1 if in_range else first
+            if free_id <= last:
+                return free_id
+        raise AccountsError("No free {0} left".format(kind))
+
+    def get_gid(self, group):
+        """ Returns the gid of a group (name or number) """
+        entry = self.find('group', group)
+        if entry is not None:
+            return int(entry[2])
+        try:
+            return int(group)
+        except ValueError:
+            raise AccountsError("Group {0} does not exist".format(group))
+
+    def add_group(self, name, gid=None, system=False):
+        """ Adds a group (if it does not exist yet) """
+        if self.find('group', name) is not None:
+            logging.debug("Group %s already exists", name)
+            return
+        if gid is None:
+            gid = self.get_free_id('group', system)
+        self.entries['group'].append([name, 'x', str(gid), ''])
+        self.entries['gshadow'].append([name, '!', '', ''])
+        logging.debug("Group %s (%d) added", name, gid)
+
+    def add_to_groups(self, user, groups):
+        """ Adds user to supplementary groups (missing groups are skipped) """
+        for group in groups:
+            entry = self.find('group', group)
+            if entry is None:
+                logging.warning(
+                    "Can't add user %s to group %s: group does not exist",
+                    user, group)
+                continue
+            for file_name, members in [('group', 3), ('gshadow', 3)]:
+                entry = self.find(file_name, group)
+                if entry is None:
+                    continue
+                names = [member for member in entry[members].split(",") if member]
+                if user not in names:
+                    names.append(user)
+                entry[members] = ",".join(names)
+
+    def add_user(self, name, group='users', groups=None, home=None,
+                 shell='/bin/bash', comment='', uid=None, system=False,
+                 create_home=False, skel_dir="etc/skel"):
+        """ Adds a user (if it does not exist yet). The home directory (and
+            its skel files) is created after commit """
+        if self.find('passwd', name) is not None:
+            logging.debug("User %s already exists", name)
+            return
+        if uid is None:
+            uid = self.get_free_id('passwd', system)
+        gid = self.get_gid(group)
+        if home is None:
+            home = os.path.join("/home", name)
+        self.entries['passwd'].append(
+            [name, 'x', str(uid), str(gid), comment, home, shell])
+        self.entries['shadow'].append([
+            name, '!', str(int(time.time() // 86400)),
+            str(self.login_defs['PASS_MIN_DAYS']),
+            str(self.login_defs['PASS_MAX_DAYS']),
+            str(self.login_defs['PASS_WARN_AGE']), '', '', ''])
+        if groups:
+            self.add_to_groups(name, groups)
+        if create_home:
+            self.homes.append((name, skel_dir))
+        logging.debug("User %s (%d) added", name, uid)
+
+    def set_password(self, user, hashed_password):
+        """ Sets the (already hashed) password of a user """
+        entry = self.find('shadow', user)
+        if entry is None:
+            raise AccountsError("User {0} has no shadow entry".format(user))
+        entry[1] = hashed_password
+        entry[2] = str(int(time.time() // 86400))
+
+    def set_comment(self, user, comment):
+        """ Sets the comment (GECOS, full name) of a user """
+        entry = self.find('passwd', user)
+        if entry is None:
+            raise AccountsError("User {0} does not exist".format(user))
+        entry[4] = comment
+
+    def write_file(self, file_name):
+        """ Writes an account file atomically (same mode and owner) """
+        path, fields = ACCOUNT_FILES[file_name]
+        path = os.path.join(self.dest_dir, path)
+        tmp_path = path + "+"
+        try:
+            old_stat = os.stat(path)
+            mode = stat.S_IMODE(old_stat.st_mode)
+            uid, gid = old_stat.st_uid, old_stat.st_gid
+        except FileNotFoundError:
+            mode = 0o600 if 'shadow' in file_name else 0o644
+            uid, gid = 0, 0
+
+        lines = []
+        for entry in self.entries[file_name]:
+            entry = entry + [''] * (fields - len(entry))
+            lines.append(":".join(entry) + "\n")
+
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with os.fdopen(fd, 'w') as account_file:
+            os.fchown(account_file.fileno(), uid, gid)
+            os.fchmod(account_file.fileno(), mode)
+            account_file.writelines(lines)
+            account_file.flush()
+            os.fsync(account_file.fileno())
+        os.replace(tmp_path, path)
+
+    def commit(self):
+        """ Writes all account files (holding the shadow-utils lock) and
+            then creates the new home directories """
+        lock_path = os.path.join(self.dest_dir, LOCK_PATH)
+        with open(lock_path, 'a') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            try:
+                for file_name in ACCOUNT_FILES:
+                    self.write_file(file_name)
+            finally:
+                fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+        homes = self.homes
+        self.homes = []
+        for user, skel_dir in homes:
+            self.create_home(user, skel_dir)
+
+    def create_home(self, user, skel_dir):
+        """ Creates the home directory of a user with the skel files.
+            An existing home (from a kept /home partition) is only chowned """
+        entry = self.find('passwd', user)
+        uid, gid = int(entry[2]), int(entry[3])
+        home = os.path.join(self.dest_dir, entry[5].lstrip("/"))
+        if os.path.exists(home):
+            logging.debug("Home %s already exists, not copying skel files", home)
+            chown_tree(home, uid, gid)
+            return
+        os.makedirs(os.path.dirname(home), mode=0o755, exist_ok=True)
+        os.mkdir(home, HOME_MODE)
+        os.chown(home, uid, gid)
+        skel_path = os.path.join(self.dest_dir, skel_dir)
+        if os.path.isdir(skel_path):
+            skel.copy_skel(skel_path, home, uid, gid)
@@ -35,6 +35,7 @@ import math
 
 from misc.extra import InstallError
 from misc.run_cmd import call, popen
+import misc.event_bus as event_bus
 import parted3.fs_module as fs
 
 from installation import wrapper
@@ -264,7 +265,7 @@ class AutoPartition(object):
 
         # Will use these queue to show progress info to the user
         self.callback_queue = callback_queue
-        self.last_event = {}
+        self.events = event_bus.get_event_bus(callback_queue)
         self.percent = 0
 
         if os.path.exists("/sys/firmware/efi"):
@@ -278,24 +279,7 @@ class AutoPartition(object):
 
     def queue_event(self, event_type, event_text=""):
         """ Adds an event to Cnchi event queue """
-
-        if self.callback_queue is None:
-            if event_type != "percent":
-                logging.debug("{0}:{1}".format(event_type, event_text))
-            return
-
-        if event_type in self.last_event:
-            if self.last_event[event_type] == event_text:
-                # do not repeat same event
-                return
-
-        self.last_event[event_type] = event_text
-
-        try:
-            # Add the event
-            self.callback_queue.put_nowait((event_type, event_text))
-        except queue.Full:
-            pass
+        self.events.queue_event(event_type, event_text)
 
     def mkfs(self, device, fs_type, mount_point, label_name, fs_options="", btrfs_devices=""):
         """ We have two main cases: "swap" and everything else. """
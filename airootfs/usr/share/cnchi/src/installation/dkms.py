@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# dkms.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Builds dkms modules for all installed kernels at the same time.
+    Modules are built in the given order for each kernel (spl before zfs).
+    dkms uses one build directory per module version, so a module is never
+    built for two kernels at once: kernels are pipelined instead (spl for
+    a kernel is built while zfs is being built for the previous one) """
+
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import misc.chroot_session as chroot_session
+
+DEST_DIR = "/install"
+
+# Where build logs and timings are stored (relative to DEST_DIR)
+LOG_DIR = "var/log/cnchi"
+TIMINGS_NAME = "dkms-timings.json"
+
+
+class DkmsBuilds(object):
+    """ Runs 'dkms install' for each module and kernel """
+
+    def __init__(self, modules, kernel_versions=None, dest_dir=DEST_DIR):
+        """ modules is an ordered list of 'name/version' strings. If there
+            are no kernel versions, modules are built for the current one """
+        self.modules = modules
+        self.kernel_versions = kernel_versions or [None]
+        self.dest_dir = dest_dir
+        self.log_dir = os.path.join(dest_dir, LOG_DIR)
+        # module: lock (a module can only be built for one kernel at a time)
+        self.locks = dict((module, threading.Lock()) for module in modules)
+        self.jobs = self.get_jobs()
+        self.timings = []
+        self.timings_lock = threading.Lock()
+
+    def get_jobs(self):
+        """ Make jobs of each build, so all builds running at the same time
+            use all CPUs (but not more) """
+        builds = max(1, min(len(self.kernel_versions), len(self.modules)))
+        return max(1, (os.cpu_count() or 1) // builds)
+
+    def get_log_path(self, module, kernel_version):
+        """ Log file of a build """
+        name = "dkms-{0}-{1}.log".format(
+            module.replace("/", "-"), kernel_version or "current")
+        return os.path.join(self.log_dir, name)
+
+    def run_command(self, cmd, log_file):
+        """ Runs cmd inside the chroot writing its output to log_file.
+            Returns its exit code """
+        session = chroot_session.get_session(self.dest_dir)
+        if session is not None:
+            try:
+                returncode, _output = session.run(cmd, on_output=log_file.write)
+                return returncode
+            except OSError as err:
+                logging.debug("Chroot helper failed: %s", err)
+        log_file.flush()
+        return subprocess.call(
+            ['chroot', self.dest_dir] + cmd,
+            stdout=log_file,
+            stderr=subprocess.STDOUT)
+
+    def build(self, module, kernel_version):
+        """ Builds and installs a module for a kernel.
+            Returns True if it succeeds """
+        cmd = ['dkms', 'install', module, '-j', str(self.jobs)]
+        if kernel_version:
+            cmd.extend(['-k', kernel_version])
+
+        log_path = self.get_log_path(module, kernel_version)
+        start = time.perf_counter()
+        try:
+            with open(log_path, 'w') as log_file:
+                log_file.write(" ".join(cmd) + "\n")
+                returncode = self.run_command(cmd, log_file)
+        except OSError as os_error:
+            logging.error("Can't run %s: %s", " ".join(cmd), os_error)
+            returncode = None
+        seconds = time.perf_counter() - start
+
+        with self.timings_lock:
+            self.timings.append({
+                'module': module,
+                'kernel': kernel_version or "current",
+                'returncode': returncode,
+                'seconds': round(seconds, 2),
+                'log': os.path.basename(log_path)})
+        logging.debug(
+            "dkms install %s for kernel %s: exit code %s in %.2f seconds",
+            module, kernel_version or "current", returncode, seconds)
+        return returncode == 0
+
+    def build_kernel(self, kernel_version):
+        """ Thread target. Builds all modules (in order) for a kernel """
+        for module in self.modules:
+            with self.locks[module]:
+                if not self.build(module, kernel_version):
+                    logging.error(
+                        "Can't install %s for kernel %s (see %s)",
+                        module,
+                        kernel_version or "current",
+                        self.get_log_path(module, kernel_version))
+                    # Next modules depend on this one
+                    return
+
+    def run(self):
+        """ Runs all builds. Returns True if all of them succeed """
+        os.makedirs(self.log_dir, mode=0o755, exist_ok=True)
+        logging.debug(
+            "Building %s for kernels %s (%d make jobs per build)",
+            ", ".join(self.modules),
+            ", ".join(kernel or "current" for kernel in self.kernel_versions),
+            self.jobs)
+
+        start = time.perf_counter()
+        threads = []
+        for kernel_version in self.kernel_versions:
+            thread = threading.Thread(
+                target=self.build_kernel, args=(kernel_version,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+
+        self.save_timings(seconds)
+        expected = len(self.modules) * len(self.kernel_versions)
+        succeeded = [t for t in self.timings if t['returncode'] == 0]
+        logging.debug(
+            "%d of %d dkms builds done in %.2f seconds",
+            len(succeeded), expected, seconds)
+        return len(succeeded) == expected
+
+    def save_timings(self, seconds):
+        """ Stores the timings of all builds """
+        path = os.path.join(self.log_dir, TIMINGS_NAME)
+        try:
+            with open(path, 'w') as timings_file:
+                json.dump(
+                    {'jobs': self.jobs, 'seconds': round(seconds, 2),
+                     'builds': self.timings},
+                    timings_file,
+                    indent=2)
+        except OSError as os_error:
+            logging.warning("Can't store dkms timings: %s", os_error)
@@ -28,9 +28,9 @@ import crypt
 import glob
 import logging
 import os
-import queue
 import shutil
 import sys
+import threading
 import time
 import re
 import tempfile
@@ -40,17 +40,26 @@ import encfs
 
 from download import download
 
+from installation import accounts
 from installation import auto_partition
+from installation import dkms
 from installation import special_dirs
 from installation import mkinitcpio
 from installation import firewall
+from installation import pipeline
+from installation import skel
+from installation import systemd_units
 
 from misc.extra import InstallError
 from misc.run_cmd import call, chroot_call
 
 import parted3.fs_module as fs
 import misc.extra as misc
+import misc.chroot_session as chroot_session
+import misc.event_bus as event_bus
 import pacman.pac as pac
+import pacman.handle_service as handle_service
+import pacman.telemetry as telemetry
 
 from mako.template import Template
 
@@ -86,6 +95,7 @@ class Installation(object):
 
         self.settings = settings
         self.callback_queue = callback_queue
+        self.events = event_bus.get_event_bus(callback_queue)
         self.packages = packages
         self.metalinks = metalinks
 
@@ -129,11 +139,7 @@ class Installation(object):
 
     def queue_event(self, event_type, event_text=""):
         """ Enqueue a new event """
-        if self.callback_queue:
-            try:
-                self.callback_queue.put_nowait((event_type, event_text))
-            except queue.Full:
-                pass
+        self.events.queue_event(event_type, event_text)
 
     def mount_partitions(self):
         """ Do not call this in automatic mode as AutoPartition class mounts
@@ -308,17 +314,25 @@ class Installation(object):
             message = template.format(type(ex).__name__, ex.args)
             logging.error(message)
 
-        logging.debug("Downloading packages...")
-        self.download_packages()
+        if self.settings.get('pipelined_install'):
+            # This mounts (binds) /dev and others to /DEST_DIR/dev and others
+            special_dirs.mount(DEST_DIR)
 
-        # This mounts (binds) /dev and others to /DEST_DIR/dev and others
-        special_dirs.mount(DEST_DIR)
+            logging.debug("Downloading and installing packages...")
+            self.download_and_install_packages()
+        else:
+            logging.debug("Downloading packages...")
+            self.download_packages()
 
-        logging.debug("Installing packages...")
-        self.install_packages()
+            # This mounts (binds) /dev and others to /DEST_DIR/dev and others
+            special_dirs.mount(DEST_DIR)
+
+            logging.debug("Installing packages...")
+            self.install_packages()
 
         logging.debug("Configuring system...")
-        self.configure_system()
+        with chroot_session.session(DEST_DIR):
+            self.configure_system()
 
         # This unmounts (unbinds) /dev and others to /DEST_DIR/dev and others
         special_dirs.umount(DEST_DIR)
@@ -327,6 +341,9 @@ class Installation(object):
         logging.debug("Running postinstall.sh script...")
         self.set_desktop_settings()
 
+        handle_service.get_handle_service().log_stats()
+        telemetry.get_telemetry().log_summary()
+
         # Copy installer log to the new installation
         logging.debug("Copying install log to /var/log.")
         self.copy_log()
@@ -365,6 +382,15 @@ class Installation(object):
             except FileExistsError:
                 pass
 
+        # Trace of the alpm transactions (see pacman/telemetry.py)
+        src = telemetry.TRACE_PATH
+        dst = os.path.join(
+            log_dest_dir, "cnchi-alpm-trace-{0}.jsonl".format(datetime))
+        try:
+            shutil.copy(src, dst)
+        except FileNotFoundError:
+            logging.warning("Can't copy %s to %s", src, dst)
+
         # Store install id for later use by antergos-pkgstats
         with open(os.path.join(log_dest_dir, 'install_id'), 'w') as install_record:
             install_id = self.settings.get('install_id')
@@ -372,9 +398,13 @@ class Installation(object):
                 install_id = '0'
             install_record.write(install_id)
 
-    def download_packages(self):
+    def download_packages(self, metalinks=None, on_package_ready=None,
+                          downloads_bar_only=False):
         """ Downloads necessary packages """
 
+        if metalinks is None:
+            metalinks = self.metalinks
+
         self.pacman_cache_dir = os.path.join(DEST_DIR, 'var/cache/pacman/pkg')
 
         download_packages = download.DownloadPackages(
@@ -387,7 +417,86 @@ class Installation(object):
         # Metalinks have already been calculated before,
         # When downloadpackages class has been called in process.py to test
         # that Cnchi was able to create it before partitioning/formatting
-        download_packages.start(self.metalinks)
+        download_packages.start(metalinks, on_package_ready, downloads_bar_only)
+
+    def download_and_install_packages(self):
+        """ Installs packages in waves while the rest are still being
+            downloaded (see pipeline.py) """
+        start = time.perf_counter()
+
+        install_pipeline = pipeline.InstallPipeline(
+            self.pacman,
+            self.metalinks,
+            self.settings.get('pipelined_install_waves') or pipeline.WAVES)
+        logging.debug(
+            "%d packages will be installed in %d waves",
+            len(install_pipeline.order),
+            len(install_pipeline.waves))
+
+        download_errors = []
+
+        def download():
+            """ Download thread """
+            try:
+                # Install waves use the main progress bar
+                self.download_packages(
+                    install_pipeline.get_ordered_metalinks(),
+                    install_pipeline.package_ready,
+                    downloads_bar_only=True)
+            except Exception as download_error:
+                # Raised again in the installer thread (see below)
+                download_errors.append(download_error)
+            finally:
+                install_pipeline.downloads_finished()
+
+        download_thread = threading.Thread(target=download)
+        download_thread.daemon = True
+        download_thread.start()
+
+        self.add_xz_cache_dirs()
+
+        # Everything is installed as a dependency here. Packages the user
+        # asked for are marked as explicitly installed afterwards
+        options = {'needed': True, 'mode': pac.pyalpm.PKG_REASON_DEPEND}
+        installed_waves = 0
+        for num, wave in enumerate(install_pipeline.waves, start=1):
+            if not install_pipeline.wait_for_wave(wave):
+                break
+            logging.debug(
+                "Installing wave %d of %d (%d packages) after %.2f seconds",
+                num,
+                len(install_pipeline.waves),
+                len(wave),
+                time.perf_counter() - start)
+            try:
+                if not self.pacman.install(pkgs=wave, options=options):
+                    break
+            except pac.pyalpm.error:
+                break
+            installed_waves += 1
+
+        download_thread.join()
+        if download_errors:
+            raise download_errors[0]
+
+        if installed_waves < len(install_pipeline.waves):
+            logging.warning(
+                "Only %d of %d install waves could be installed, "
+                "installing the rest of the packages at once",
+                installed_waves,
+                len(install_pipeline.waves))
+
+        # Installs whatever is missing (and retries if something went wrong)
+        self.install_packages(options={'needed': True})
+
+        if installed_waves > 0:
+            explicit = self.pacman.get_targets(self.packages)
+            cmd = ['pacman', '-D', '--asexplicit', '--quiet'] + explicit
+            chroot_call(cmd)
+
+        logging.debug(
+            "Packages downloaded and installed in %.2f seconds",
+            time.perf_counter() - start)
 
     def create_pacman_conf_file(self):
         """ Creates a temporary pacman.conf """
@@ -416,8 +525,12 @@ class Installation(object):
         self.prepare_pacman_keyring()
 
         # Init pyalpm
+        service = handle_service.get_handle_service()
         try:
-            self.pacman = pac.Pac("/tmp/pacman.conf", self.callback_queue)
+            self.pacman = service.get_pac(
+                "/tmp/pacman.conf",
+                self.callback_queue,
+                stage="install")
         except Exception as ex:
             self.pacman = None
             template = "Can't initialize pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
@@ -425,8 +538,9 @@ class Installation(object):
             logging.error(message)
             raise InstallError(message)
 
-        # Refresh pacman databases
-        if not self.pacman.refresh():
+        # Refresh pacman databases (databases refreshed by previous stages
+        # are copied instead of downloaded again)
+        if not service.refresh(self.pacman, stage="install"):
             logging.error("Can't refresh pacman databases.")
             raise InstallError(_("Can't refresh pacman databases."))
 
@@ -473,19 +587,26 @@ class Installation(object):
         # cmd = ["pacman-key", "--refresh-keys", "--gpgdir", dest_path]
         # call(cmd)
 
-    def install_packages(self):
+    def add_xz_cache_dirs(self):
+        """ Adds the xz cache dirs to pacman's cache dirs (only once).
+            This shouldn't be necessary if download.py really downloaded all
+            needed packages, but it does not do it (why?) """
+        # alpm stores cache dirs with a trailing slash
+        cache_dirs = [path.rstrip('/') for path in self.pacman.handle.cachedirs]
+        for cache_dir in self.settings.get('xz_cache'):
+            if cache_dir.rstrip('/') not in cache_dirs:
+                self.pacman.handle.add_cachedir(cache_dir)
+
+    def install_packages(self, options=None):
         """ Start pacman installation of packages """
         result = False
-        # This shouldn't be necessary if download.py really downloaded all
-        # needed packages, but it does not do it (why?)
-        for cache_dir in self.settings.get('xz_cache'):
-            self.pacman.handle.add_cachedir(cache_dir)
+        self.add_xz_cache_dirs()
 
         logging.debug("Installing packages...")
 
         try:
             result = self.pacman.install(
-                pkgs=self.packages, conflicts=None, options=None)
+                pkgs=self.packages, conflicts=None, options=options)
         except pac.pyalpm.error:
             pass
 
@@ -506,7 +627,8 @@ class Installation(object):
 
                 self.pacman.refresh()
 
-                result = self.pacman.install(pkgs=self.packages)
+                result = self.pacman.install(
+                    pkgs=self.packages, options=options)
 
         elif not result and self.settings.get('desktop').lower() in ['cinnamon', 'mate']:
             # Failure might be due to antergos mirror issues. Try using build server repo.
@@ -522,7 +644,7 @@ class Installation(object):
 
             self.pacman.refresh()
 
-            result = self.pacman.install(pkgs=self.packages)
+            result = self.pacman.install(pkgs=self.packages, options=options)
 
         if not result:
             txt = _("Can't install necessary packages. Cnchi can't continue.")
@@ -783,22 +905,78 @@ class Installation(object):
 
     @staticmethod
     def enable_services(services):
-        """ Enables all services that are in the list 'services' """
-        for name in services:
-            path = os.path.join(
-                DEST_DIR,
-                "usr/lib/systemd/system/{0}.service".format(name))
-            if os.path.exists(path):
-                chroot_call(['systemctl', '-fq', 'enable', name])
-                logging.debug("Service '%s' has been enabled.", name)
-            else:
-                logging.warning("Can't find service %s", name)
+        """ Enables all services that are in the list 'services'
+            (they are enabled all at once at the end of configure_system) """
+        systemd_units.enable(services, DEST_DIR)
 
     @staticmethod
     def change_user_password(user, new_password):
-        """ Changes the user's password """
+        """ Changes the user's password. Returns True if it is changed """
         shadow_password = crypt.crypt(new_password, crypt.mksalt())
-        chroot_call(['usermod', '-p', shadow_password, user])
+        try:
+            users = accounts.Accounts(DEST_DIR)
+            users.set_password(user, shadow_password)
+            users.commit()
+        except (OSError, accounts.AccountsError) as err:
+            logging.error("Can't change %s password: %s", user, err)
+            return False
+        return True
+
+    def setup_accounts(self, username, fullname, password):
+        """ Creates the user (and the groups it needs), sets user's and
+            root's password and fixes the avahi user. Account files are
+            edited directly. Root's password and the avahi fixup are
+            committed on their own, so they do not depend on the user """
+
+        # User password is the root password
+        if self.change_user_password('root', password):
+            logging.debug("Set the same password to root.")
+
+        default_groups = ['wheel']
+
+        if self.vbox:
+            self.enable_services(["vboxservice"])
+
+        try:
+            users = accounts.Accounts(DEST_DIR)
+
+            if self.vbox:
+                # Why there is no vboxusers group? Add it ourselves.
+                users.add_group('vboxusers')
+                default_groups.extend(['vboxusers', 'vboxsf'])
+
+            if self.settings.get('require_password') is False:
+                # Prepare system for autologin.
+                # LightDM needs the user to be in the autologin group.
+                users.add_group('autologin')
+                default_groups.append('autologin')
+
+            users.add_user(
+                username,
+                group='users',
+                groups=default_groups,
+                shell='/bin/bash',
+                comment=fullname,
+                create_home=True)
+            users.set_password(username, crypt.crypt(password, crypt.mksalt()))
+            users.commit()
+        except (OSError, accounts.AccountsError) as err:
+            txt = "Can't create user {0}: {1}".format(username, err)
+            logging.error(txt)
+            raise InstallError(txt)
+        logging.debug("User %s added.", username)
+
+        if self.desktop != "base":
+            # avahi package seems to fail to create its user and group in some cases (¿?)
+            try:
+                users = accounts.Accounts(DEST_DIR)
+                users.add_group('avahi', gid=84, system=True)
+                users.add_user(
+                    'avahi', group='avahi', home='/', shell='/bin/nologin',
+                    comment='avahi', uid=84, system=True)
+                users.commit()
+            except (OSError, accounts.AccountsError) as err:
+                logging.warning("Can't create avahi user: %s", err)
 
     @staticmethod
     def auto_timesetting():
@@ -1258,8 +1436,7 @@ class Installation(object):
                                     "0.fr.pool.ntp.org\n")
             except FileNotFoundError as err:
                 logging.warning("Can't find %s file.", timesyncd_path)
-            chroot_call(['systemctl', '-fq', 'enable',
-                         'systemd-timesyncd.service'])
+            self.enable_services(['systemd-timesyncd.service'])
 
         # Set timezone
         zone = self.settings.get("timezone_zone")
@@ -1274,9 +1451,7 @@ class Installation(object):
 
         # Wait FOREVER until the user sets his params
         # FIXME: We can wait here forever!
-        while self.settings.get('user_info_done') is False:
-            # Wait five seconds and try again
-            time.sleep(5)
+        self.settings.wait_for('user_info_done')
 
         # Set user parameters
         username = self.settings.get('username')
@@ -1310,38 +1485,8 @@ class Installation(object):
                 message = template.format(type(ex).__name__, ex.args)
                 logging.error(message)
 
-        # Setup user
-
-        default_groups = 'wheel'
-
-        if self.vbox:
-            # Why there is no vboxusers group? Add it ourselves.
-            chroot_call(['groupadd', 'vboxusers'])
-            default_groups += ',vboxusers,vboxsf'
-            self.enable_services(["vboxservice"])
-
-        if self.settings.get('require_password') is False:
-            # Prepare system for autologin.
-            # LightDM needs the user to be in the autologin group.
-            chroot_call(['groupadd', 'autologin'])
-            default_groups += ',autologin'
-
-        cmd = [
-            'useradd',
-            '--create-home',
-            '--shell', '/bin/bash',
-            '--gid', 'users',
-            '--groups', default_groups,
-            username]
-        chroot_call(cmd)
-        logging.debug("User %s added.", username)
-
-        self.change_user_password(username, password)
-
-        chroot_call(['chfn', '-f', fullname, username])
-        home_dir = os.path.join("/home", username)
-        cmd = ['chown', '-R', '{0}:users'.format(username), home_dir]
-        chroot_call(cmd)
+        # Setup user (and groups). All account files are written at once
+        self.setup_accounts(username, fullname, password)
 
         # Set hostname
         hostname_path = os.path.join(DEST_DIR, "etc/hostname")
@@ -1351,10 +1496,6 @@ class Installation(object):
 
         logging.debug("Hostname set to %s", hostname)
 
-        # User password is the root password
-        self.change_user_password('root', password)
-        logging.debug("Set the same password to root.")
-
         # Generate locales
         locale = self.settings.get("locale")
         self.queue_event('info', _("Generating locales..."))
@@ -1376,7 +1517,8 @@ class Installation(object):
         self.set_keymap()
 
         # Install configs for root
-        chroot_call(['cp', '-av', '/etc/skel/.', '/root/'])
+        skel.copy_skel(
+            os.path.join(DEST_DIR, "etc/skel"), os.path.join(DEST_DIR, "root"))
 
         self.queue_event('info', _("Configuring hardware..."))
 
@@ -1411,21 +1553,13 @@ class Installation(object):
             zfs_version = self.get_installed_zfs_version()
             spl_module = 'spl/{}'.format(zfs_version)
             zfs_module = 'zfs/{}'.format(zfs_version)
+            # If no kernel version is found, modules are installed for
+            # the current kernel
             kernel_versions = self.get_installed_kernel_versions()
-            if kernel_versions:
-                for kernel_version in kernel_versions:
-                    logging.debug(
-                        "Installing zfs v%s modules for kernel %s", zfs_version, kernel_version)
-                    chroot_call(
-                        ['dkms', 'install', spl_module, '-k', kernel_version])
-                    chroot_call(
-                        ['dkms', 'install', zfs_module, '-k', kernel_version])
-            else:
-                # No kernel version found, try to install for current kernel
-                logging.debug(
-                    "Installing zfs v%s modules for current kernel.", zfs_version)
-                chroot_call(['dkms', 'install', spl_module])
-                chroot_call(['dkms', 'install', zfs_module])
+            logging.debug("Installing zfs v%s modules", zfs_version)
+            builds = dkms.DkmsBuilds(
+                [spl_module, zfs_module], kernel_versions, DEST_DIR)
+            builds.run()
 
         # Let's start without using hwdetect for mkinitcpio.conf.
         # It should work out of the box most of the time.
@@ -1475,14 +1609,6 @@ class Installation(object):
         logging.debug("Updating pkgfile database")
         chroot_call(["pkgfile", "--update"])
 
-        if self.desktop != "base":
-            # avahi package seems to fail to create its user and group in some cases (¿?)
-            cmd = ["groupadd", "-r", "-g", "84", "avahi"]
-            chroot_call(cmd)
-            cmd = ["useradd", "-r", "-u", "84", "-g", "avahi", "-d", "/", "-s",
-                   "/bin/nologin", "-c", "avahi", "avahi"]
-            chroot_call(cmd)
-
         # Install sonar (a11y) gsettings if present in the ISO (and a11y is on)
         src = "/usr/share/glib-2.0/schemas/92_antergos_sonar.gschema.override"
         if self.settings.get('a11y') and os.path.exists(src):
@@ -1517,3 +1643,9 @@ class Installation(object):
                 nanorc.write('set keycolor cyan\n')
                 nanorc.write('set functioncolor green\n')
                 nanorc.write('include "/usr/share/nano/*.nanorc"\n')
+
+        # Enable all services requested during the installation
+        failed = systemd_units.apply(DEST_DIR)
+        if failed:
+            logging.warning(
+                "These services could not be enabled: %s", ", ".join(failed))
@@ -40,6 +40,7 @@ import logging
 import shutil
 
 from misc.run_cmd import chroot_call
+from installation import systemd_units
 
 DEST_DIR = '/install'
 
@@ -67,8 +68,7 @@ def mariadb_setup():
         "--datadir=/var/lib/mysql"]
     chroot_call(cmd)
 
-    cmd = ["systemctl", "enable", "mysqld"]
-    chroot_call(cmd)
+    systemd_units.enable(["mysqld"], DEST_DIR)
 
     # TODO: Warn user to run mysql_secure_installation
 
@@ -119,7 +119,7 @@ def apache_setup():
     # We activate the virtual localhost site
     chroot_call(["a2ensite", "localhost"])
 
-    chroot_call(["systemctl", "enable", "httpd"])
+    systemd_units.enable(["httpd"], DEST_DIR)
 
 
 def php_setup():
@@ -39,6 +39,7 @@ import os
 import logging
 
 from misc.run_cmd import chroot_call
+from installation import systemd_units
 
 DEST_DIR = '/install'
 
@@ -66,16 +67,14 @@ def mariadb_setup():
         "--datadir=/var/lib/mysql"]
     chroot_call(cmd)
 
-    cmd = ["systemctl", "enable", "mysqld"]
-    chroot_call(cmd)
+    systemd_units.enable(["mysqld"], DEST_DIR)
 
     # TODO: Warn user to run mysql_secure_installation
 
 
 def nginx_setup():
     """ Setup Nginx web server """
-    cmd = ["systemctl", "enable", "nginx"]
-    chroot_call(cmd)
+    systemd_units.enable(["nginx"], DEST_DIR)
 
     # We need to tell nginx to run php using php-fpm.
     path = os.path.join(DEST_DIR, "etc/nginx/nginx.conf")
@@ -132,8 +131,7 @@ def php_setup():
                         "/usr/share/webapps/:/etc/webapps/\n")
             php_ini.write(line)
 
-    cmd = ["systemctl", "enable", "php-fpm"]
-    chroot_call(cmd)
+    systemd_units.enable(["php-fpm"], DEST_DIR)
 
 
 if __name__ == '__main__':
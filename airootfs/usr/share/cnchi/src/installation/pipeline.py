@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# pipeline.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Overlaps package downloading with package installation.
+    Packages are downloaded in dependency order (dependencies first) and
+    split in waves. A wave is installed as soon as it (and all waves before
+    it) is in pacman's cache, while the next waves are still downloading """
+
+import threading
+
+from collections import OrderedDict
+
+# Number of install waves (each wave is an alpm transaction, so each wave
+# runs pacman hooks again. Do not use too many of them)
+WAVES = 4
+
+
+def sort_dependencies_first(names, get_dependencies):
+    """ Returns names sorted so each package comes after its dependencies.
+        Packages in a dependency cycle are kept together.
+        (Tarjan's strongly connected components algorithm, without recursion,
+        which outputs each component after the ones it depends on) """
+    order = []
+    indexes = {}
+    lowlinks = {}
+    stack = []
+    on_stack = set()
+    counter = 0
+
+    for root in names:
+        if root in indexes:
+            continue
+        work = [(root, iter(get_dependencies(root)))]
+        indexes[root] = lowlinks[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            name, dependencies = work[-1]
+            for dependency in dependencies:
+                if dependency not in indexes:
+                    indexes[dependency] = lowlinks[dependency] = counter
+                    counter += 1
+                    stack.append(dependency)
+                    on_stack.add(dependency)
+                    work.append(
+                        (dependency, iter(get_dependencies(dependency))))
+                    break
+                elif dependency in on_stack:
+                    lowlinks[name] = min(lowlinks[name], indexes[dependency])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlinks[parent] = min(lowlinks[parent], lowlinks[name])
+                if lowlinks[name] == indexes[name]:
+                    # name is the root of a component, output it
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        order.append(member)
+                        if member == name:
+                            break
+    return order
+
+
+class InstallPipeline(object):
+    """ Orders the download list and tells when each install wave is ready """
+
+    def __init__(self, pacman, metalinks, waves=WAVES):
+        """ pacman is the Pac object used to install the packages and
+            metalinks the download list (identity: element) """
+        self.pacman = pacman
+        self.metalinks = metalinks
+
+        # Packages available in pacman's cache
+        self.ready = set()
+        self.finished = False
+        self.condition = threading.Condition()
+
+        self.order = self.get_order()
+        self.waves = self.split_in_waves(max(1, waves))
+
+    def get_dependencies(self, name):
+        """ Returns the packages of the download list name depends on """
+        index = self.pacman.get_provides_index()
+        pkg = index.get_pkg(name)
+        if pkg is None:
+            return []
+        dependencies = []
+        for dep in pkg.depends:
+            satisfier = index.find_satisfier(dep)
+            if satisfier is not None and satisfier.name in self.metalinks:
+                dependencies.append(satisfier.name)
+        return dependencies
+
+    def get_order(self):
+        """ Download list identities, dependencies first """
+        return sort_dependencies_first(
+            list(self.metalinks.keys()), self.get_dependencies)
+
+    def get_ordered_metalinks(self):
+        """ Returns the download list in dependency order """
+        return OrderedDict(
+            (identity, self.metalinks[identity]) for identity in self.order)
+
+    def split_in_waves(self, waves):
+        """ Splits the ordered list in waves of about the same download
+            size. As each wave is a prefix of the ordered list (plus the
+            waves before it), its dependencies are always in the cache when
+            the wave is ready """
+        sizes = []
+        for identity in self.order:
+            try:
+                sizes.append(int(self.metalinks[identity].get('size', 0)))
+            except (TypeError, ValueError):
+                sizes.append(0)
+
+        wave_size = max(1, sum(sizes) / waves)
+        result = [[]]
+        downloaded = 0
+        for identity, size in zip(self.order, sizes):
+            result[-1].append(identity)
+            downloaded += size
+            if downloaded >= wave_size * len(result) and len(result) < waves:
+                result.append([])
+        return [wave for wave in result if wave]
+
+    def package_ready(self, element):
+        """ Called by the downloader each time a package is in the cache """
+        with self.condition:
+            self.ready.add(element['identity'])
+            self.condition.notify_all()
+
+    def downloads_finished(self):
+        """ Called when the downloader stops (successfully or not) """
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def wait_for_wave(self, wave):
+        """ Waits until all packages of the wave are in the cache.
+            Returns False if the downloader stopped before that """
+        with self.condition:
+            while not self.ready.issuperset(wave):
+                if self.finished:
+                    return False
+                self.condition.wait()
+        return True
@@ -34,11 +34,11 @@ import subprocess
 import traceback
 import logging
 import sys
-import queue
 
 import pyalpm
 
 import misc.extra as misc
+import misc.event_bus as event_bus
 
 from download import download
 
@@ -85,6 +85,11 @@ class Process(multiprocessing.Process):
         """ Calculates download package list and then calls run_format and
         run_install. Takes care of the exceptions, too. """
 
+        # Events sent from this process are coalesced and rate limited
+        event_bus.get_event_bus(
+            self.callback_queue,
+            self.settings.get('events_interval'))
+
         try:
             # Before formatting, let's try to calculate package download list
             # this way, if something fails (a missing package, mostly) we have
@@ -142,10 +147,5 @@ class Process(multiprocessing.Process):
 
     def queue_event(self, event_type, event_text=""):
         """ Enqueue an event """
-        if self.callback_queue is not None:
-            try:
-                self.callback_queue.put_nowait((event_type, event_text))
-            except queue.Full:
-                pass
-        else:
-            print("{0}: {1}".format(event_type, event_text))
+        event_bus.get_event_bus(self.callback_queue).queue_event(
+            event_type, event_text)
@@ -26,9 +26,7 @@
 
 import logging
 import os
-import queue
 import sys
-import requests
 from requests.exceptions import RequestException
 
 try:
@@ -40,8 +38,10 @@ import desktop_info
 import info
 
 
-import pacman.pac as pac
+import pacman.handle_service as handle_service
+import download.session_pool as session_pool
 import misc.extra as misc
+import misc.event_bus as event_bus
 from misc.extra import InstallError
 
 import hardware.hardware as hardware
@@ -65,6 +65,7 @@ class SelectPackages(object):
         """ Initialize package class """
 
         self.callback_queue = callback_queue
+        self.events = event_bus.get_event_bus(callback_queue)
         self.settings = settings
         self.alternate_package_list = self.settings.get(
             'alternate_package_list')
@@ -88,13 +89,7 @@ class SelectPackages(object):
 
     def queue_event(self, event_type, event_text=""):
         """ Enqueue event """
-        if self.callback_queue is not None:
-            try:
-                self.callback_queue.put_nowait((event_type, event_text))
-            except queue.Full:
-                pass
-        else:
-            print("{0}: {1}".format(event_type, event_text))
+        self.events.queue_event(event_type, event_text)
 
     def create_package_list(self):
         """ Create package list """
@@ -121,9 +116,13 @@ class SelectPackages(object):
     @misc.raise_privileges
     def refresh_pacman_databases(self):
         """ Updates pacman databases """
-        # Init pyalpm
+        # Init pyalpm (the handle is kept, so next stages can reuse it)
+        service = handle_service.get_handle_service()
         try:
-            pacman = pac.Pac("/etc/pacman.conf", self.callback_queue)
+            pacman = service.get_pac(
+                "/etc/pacman.conf",
+                self.callback_queue,
+                stage="select_packages")
         except Exception as ex:
             template = "Can't initialize pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
             message = template.format(type(ex).__name__, ex.args)
@@ -131,20 +130,11 @@ class SelectPackages(object):
             raise InstallError(message)
 
         # Refresh pacman databases
-        if not pacman.refresh():
+        if not service.refresh(pacman, stage="select_packages"):
             logging.error("Can't refresh pacman databases.")
             txt = _("Can't refresh pacman databases.")
             raise InstallError(txt)
 
-        try:
-            pacman.release()
-            del pacman
-        except Exception as ex:
-            template = "Can't release pyalpm. An exception of type {0} occured. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            logging.error(message)
-            raise InstallError(message)
-
     def add_package(self, pkg):
         """ Adds xml node text to our package list
             returns TRUE if the package is added """
@@ -202,7 +192,8 @@ class SelectPackages(object):
                 # url = '{0}packages-{1}.xml'.format(PKGLIST_URL, info.CNCHI_VERSION.rsplit('.')[-2])
                 url = PKGLIST_URL
                 logging.debug("Getting url %s...", url)
-                req = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
+                sessions = session_pool.get_session_pool()
+                req = sessions.get(url, headers={'User-Agent': 'Mozilla/5.0'})
                 packages_xml_data = req.content
             except RequestException as url_error:
                 # If the installer can't retrieve the remote file Cnchi will use
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# skel.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Copies skel directories (/etc/skel to /root or to a new home) walking the
+    tree only once: data is copied inside the kernel (copy_file_range or
+    sendfile) and owner, mode and times are set while copying """
+
+import errno
+import logging
+import os
+import stat
+import time
+
+# Fall back to a normal copy when the kernel can't copy between these files
+_NO_KERNEL_COPY = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+# Bytes copied by each copy_file_range / sendfile / read call
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def copy_data(src_fd, dst_fd, size):
+    """ Copies size bytes from src_fd to dst_fd (from offset 0) """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                done = os.copy_file_range(
+                    src_fd, dst_fd, min(CHUNK_SIZE, size - copied))
+                if done == 0:
+                    break
+                copied += done
+            return copied
+        except OSError as os_error:
+            if os_error.errno not in _NO_KERNEL_COPY:
+                raise
+
+    try:
+        while copied < size:
+            done = os.sendfile(
+                dst_fd, src_fd, copied, min(CHUNK_SIZE, size - copied))
+            if done == 0:
+                break
+            copied += done
+        return copied
+    except OSError as os_error:
+        if os_error.errno not in _NO_KERNEL_COPY:
+            raise
+
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    os.lseek(dst_fd, copied, os.SEEK_SET)
+    while True:
+        data = os.read(src_fd, CHUNK_SIZE)
+        if not data:
+            break
+        os.write(dst_fd, data)
+        copied += len(data)
+    return copied
+
+
+class SkelCopy(object):
+    """ Copies a directory tree into another one (existing files are
+        replaced). If uid and gid are given, they own all copied files,
+        otherwise source owners are kept """
+
+    def __init__(self, src_dir, dst_dir, uid=None, gid=None):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.uid = uid
+        self.gid = gid
+        self.dirs = 0
+        self.files = 0
+        self.links = 0
+        self.size = 0
+        self.errors = 0
+
+    def get_owner(self, src_stat):
+        """ Owner of a copied file """
+        uid = src_stat.st_uid if self.uid is None else self.uid
+        gid = src_stat.st_gid if self.gid is None else self.gid
+        return uid, gid
+
+    def copy_file(self, src, dst, src_stat):
+        """ Copies a regular file with its owner, mode and times """
+        uid, gid = self.get_owner(src_stat)
+        mode = stat.S_IMODE(src_stat.st_mode)
+        if os.path.islink(dst):
+            os.remove(dst)
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.fchown(dst_fd, uid, gid)
+                self.size += copy_data(src_fd, dst_fd, src_stat.st_size)
+                os.fchmod(dst_fd, mode)
+                os.utime(dst_fd, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        self.files += 1
+
+    def copy_link(self, src, dst, src_stat):
+        """ Copies a symbolic link """
+        if os.path.lexists(dst):
+            os.remove(dst)
+        os.symlink(os.readlink(src), dst)
+        os.lchown(dst, *self.get_owner(src_stat))
+        self.links += 1
+
+    def make_dir(self, dst, src_stat):
+        """ Creates (or updates) a directory """
+        if os.path.islink(dst) or (os.path.lexists(dst) and not os.path.isdir(dst)):
+            # Replace whatever is there (never follow links out of the tree)
+            os.remove(dst)
+        if not os.path.isdir(dst):
+            os.mkdir(dst, 0o700)
+        os.chown(dst, *self.get_owner(src_stat))
+        os.chmod(dst, stat.S_IMODE(src_stat.st_mode))
+        self.dirs += 1
+
+    def run(self):
+        """ Copies the tree and logs a summary. Returns True if there were
+            no errors """
+        start = time.perf_counter()
+        pending = [(self.src_dir, self.dst_dir)]
+        while pending:
+            src_dir, dst_dir = pending.pop()
+            try:
+                entries = list(os.scandir(src_dir))
+            except OSError as os_error:
+                logging.warning("Can't read %s: %s", src_dir, os_error)
+                self.errors += 1
+                continue
+            for entry in entries:
+                dst = os.path.join(dst_dir, entry.name)
+                try:
+                    src_stat = entry.stat(follow_symlinks=False)
+                    if stat.S_ISLNK(src_stat.st_mode):
+                        self.copy_link(entry.path, dst, src_stat)
+                    elif stat.S_ISDIR(src_stat.st_mode):
+                        self.make_dir(dst, src_stat)
+                        pending.append((entry.path, dst))
+                    elif stat.S_ISREG(src_stat.st_mode):
+                        self.copy_file(entry.path, dst, src_stat)
+                except OSError as os_error:
+                    logging.warning("Can't copy %s: %s", entry.path, os_error)
+                    self.errors += 1
+
+        logging.debug(
+            "Copied %s to %s: %d files, %d dirs, %d links, %d bytes, "
+            "%d errors in %.2f seconds",
+            self.src_dir, self.dst_dir, self.files, self.dirs, self.links,
+            self.size, self.errors, time.perf_counter() - start)
+        return self.errors == 0
+
+
+def copy_skel(src_dir, dst_dir, uid=None, gid=None):
+    """ Copies src_dir contents into dst_dir (see SkelCopy) """
+    return SkelCopy(src_dir, dst_dir, uid, gid).run()
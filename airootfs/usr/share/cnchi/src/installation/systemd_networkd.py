@@ -37,7 +37,7 @@ import os
 import subprocess
 import logging
 
-from misc.run_cmd import chroot_call
+from installation import systemd_units
 
 DEST_DIR = "/install"
 
@@ -118,8 +118,8 @@ def setup(ssid=None, passphrase=None):
                     conf_file.write(conf)
             except subprocess.CalledProcessError as process_error:
                 logging.warning(process_error)
-            cmd = ["systemctl", "enable", "wpa_supplicant@{0}".format(link)]
-            chroot_call(cmd)
+            systemd_units.enable(
+                ["wpa_supplicant@{0}".format(link)], DEST_DIR)
             # cmd = ["systemctl", "enable", "dhcpcd@{0}".format(link)]
             # chroot_run(cmd)
 
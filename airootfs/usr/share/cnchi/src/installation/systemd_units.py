@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# systemd_units.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Gathers all systemd units that must be enabled (or disabled) during the
+    installation and applies them at the end, with one systemctl call """
+
+import logging
+import os
+import threading
+
+from collections import OrderedDict
+
+from misc.run_cmd import call
+
+DEST_DIR = "/install"
+
+# Where unit files can be (relative to the installation root)
+UNIT_DIRS = ["etc/systemd/system", "usr/lib/systemd/system", "lib/systemd/system"]
+
+UNIT_TYPES = [
+    ".service", ".socket", ".target", ".timer", ".path", ".mount",
+    ".automount", ".swap", ".slice", ".device", ".scope"]
+
+
+def get_unit_name(name):
+    """ Adds .service to names without a unit type """
+    if os.path.splitext(name)[1] in UNIT_TYPES:
+        return name
+    return name + ".service"
+
+
+class UnitBatch(object):
+    """ Units to enable and disable in an installation root """
+
+    def __init__(self, dest_dir=DEST_DIR):
+        self.dest_dir = dest_dir
+        # unit name: True (enable) or False (disable)
+        self.units = OrderedDict()
+        self.lock = threading.Lock()
+
+    def enable(self, names):
+        """ Enables units (later, when apply is called) """
+        with self.lock:
+            for name in names:
+                if name:
+                    self.units[get_unit_name(name)] = True
+
+    def disable(self, names):
+        """ Disables units (later, when apply is called) """
+        with self.lock:
+            for name in names:
+                if name:
+                    self.units[get_unit_name(name)] = False
+
+    def find_unit_file(self, unit):
+        """ Returns the path of the unit file (None if it does not exist).
+            Instances of template units (name@instance) use the template """
+        name, unit_type = os.path.splitext(unit)
+        names = [unit]
+        if "@" in name:
+            names.append(name.split("@", 1)[0] + "@" + unit_type)
+        for unit_dir in UNIT_DIRS:
+            for file_name in names:
+                path = os.path.join(self.dest_dir, unit_dir, file_name)
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def systemctl(self, action, units):
+        """ Runs systemctl on the installation root (no chroot needed) """
+        cmd = [
+            "systemctl", "--root={0}".format(self.dest_dir), "--quiet",
+            "--force", action] + units
+        return call(cmd, warning=False) is not False
+
+    def run_batch(self, action, units):
+        """ Applies action to all units at once. If that fails, they are
+            applied one by one to find out which ones fail.
+            Returns the units that failed """
+        if not units or self.systemctl(action, units):
+            return []
+        return [unit for unit in units if not self.systemctl(action, [unit])]
+
+    def apply(self):
+        """ Applies all pending changes. Returns the units that could not
+            be enabled (or disabled) """
+        with self.lock:
+            units = list(self.units.items())
+            self.units.clear()
+
+        missing = []
+        to_enable = []
+        to_disable = []
+        for unit, enable in units:
+            if self.find_unit_file(unit) is None:
+                missing.append(unit)
+            elif enable:
+                to_enable.append(unit)
+            else:
+                to_disable.append(unit)
+
+        failed = self.run_batch("disable", to_disable)
+        failed.extend(self.run_batch("enable", to_enable))
+
+        for unit in to_enable:
+            if unit not in failed:
+                logging.debug("Service '%s' has been enabled.", unit)
+        for unit in to_disable:
+            if unit not in failed:
+                logging.debug("Service '%s' has been disabled.", unit)
+        for unit in missing:
+            logging.warning("Can't find service %s", unit)
+        for unit in failed:
+            logging.warning("Can't enable or disable service %s", unit)
+        return missing + failed
+
+
+# One batch per installation root
+_BATCHES = {}
+_BATCHES_LOCK = threading.Lock()
+
+
+def get_batch(dest_dir=DEST_DIR):
+    """ Returns the batch of units of dest_dir """
+    dest_dir = os.path.abspath(dest_dir)
+    with _BATCHES_LOCK:
+        if dest_dir not in _BATCHES:
+            _BATCHES[dest_dir] = UnitBatch(dest_dir)
+        return _BATCHES[dest_dir]
+
+
+def enable(names, dest_dir=DEST_DIR):
+    """ Enables units when apply is called """
+    get_batch(dest_dir).enable(names)
+
+
+def disable(names, dest_dir=DEST_DIR):
+    """ Disables units when apply is called """
+    get_batch(dest_dir).disable(names)
+
+
+def apply(dest_dir=DEST_DIR):
+    """ Enables and disables all units requested so far.
+        Returns the units that failed """
+    return get_batch(dest_dir).apply()
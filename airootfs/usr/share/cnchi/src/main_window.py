@@ -91,6 +91,7 @@ class MainWindow(Gtk.ApplicationWindow):
         logging.info("Cnchi installer version %s", info.CNCHI_VERSION)
 
         self.settings = config.Settings()
+        config.settings = self.settings
         self.ui_dir = self.settings.get('ui')
 
         if not os.path.exists(self.ui_dir):
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# chroot_server.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Helper process used by chroot_session.py. It chroots itself into the
+    directory given as its only argument and then runs the commands it
+    reads from stdin (one JSON request per line), sending their output and
+    exit codes to stdout (one JSON message per line).
+    It must only use the standard library: it runs outside Cnchi's path """
+
+import errno
+import json
+import os
+import subprocess
+import sys
+import threading
+
+_WRITE_LOCK = threading.Lock()
+
+# Exit codes used by chroot(1) when it can't run the command
+EXIT_CANNOT_INVOKE = 126
+EXIT_ENOENT = 127
+
+# request id: Popen object
+_PROCESSES = {}
+
+
+def send(message):
+    """ Sends a message to Cnchi """
+    with _WRITE_LOCK:
+        sys.stdout.write(json.dumps(message) + "\n")
+        sys.stdout.flush()
+
+
+def run(request):
+    """ Runs a command, streaming its output """
+    request_id = request['id']
+    try:
+        proc = subprocess.Popen(
+            request['cmd'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=request.get('env', None))
+    except OSError as err:
+        # Behave as chroot(1) does, so callers get the same output
+        send({
+            'id': request_id,
+            'output': "chroot: failed to run command ‘{0}’: {1}\n".format(
+                request['cmd'][0], err.strerror)})
+        if err.errno == errno.ENOENT:
+            send({'id': request_id, 'returncode': EXIT_ENOENT})
+        else:
+            send({'id': request_id, 'returncode': EXIT_CANNOT_INVOKE})
+        return
+    except ValueError as err:
+        send({'id': request_id, 'error': str(err)})
+        return
+
+    _PROCESSES[request_id] = proc
+    for line in proc.stdout:
+        send({'id': request_id, 'output': line.decode(errors='replace')})
+    returncode = proc.wait()
+    _PROCESSES.pop(request_id, None)
+    send({'id': request_id, 'returncode': returncode})
+
+
+def serve():
+    """ Reads requests until stdin is closed """
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            continue
+        if request.get('kill', False):
+            proc = _PROCESSES.get(request['id'], None)
+            if proc is not None:
+                proc.kill()
+            continue
+        thread = threading.Thread(target=run, args=(request,))
+        thread.daemon = True
+        thread.start()
+
+
+def main():
+    """ Chroots into sys.argv[1] and serves requests """
+    os.chroot(sys.argv[1])
+    os.chdir("/")
+    send({'id': None, 'ready': True})
+    serve()
+    for proc in list(_PROCESSES.values()):
+        proc.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# chroot_session.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Runs commands inside a chroot through one long lived helper process
+    (chroot_server.py), instead of forking Cnchi and running 'chroot' again
+    for each command """
+
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chroot_server.py")
+
+# Seconds to wait for the helper to start or to exit
+HELPER_TIMEOUT = 10
+
+
+class ChrootSession(object):
+    """ Client side of a chroot helper process """
+
+    def __init__(self, chroot_dir):
+        self.chroot_dir = chroot_dir
+        self.proc = None
+        self.reader = None
+        # request id: queue where its messages are put
+        self.requests = {}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.alive = False
+        self.commands = 0
+        self.run_time = 0
+
+    def start(self):
+        """ Starts the helper. Returns True if it is ready """
+        try:
+            self.proc = subprocess.Popen(
+                [sys.executable, SERVER_PATH, self.chroot_dir],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+                bufsize=1)
+        except OSError as os_error:
+            logging.warning("Can't start chroot helper: %s", os_error)
+            return False
+
+        ready = queue.Queue()
+        self.requests[None] = ready
+        self.alive = True
+        self.reader = threading.Thread(target=self.read_messages)
+        self.reader.daemon = True
+        self.reader.start()
+
+        try:
+            message = ready.get(timeout=HELPER_TIMEOUT)
+        except queue.Empty:
+            message = {}
+        if not message.get('ready', False):
+            logging.warning("Chroot helper for %s did not start", self.chroot_dir)
+            self.stop()
+            return False
+        logging.debug("Chroot helper for %s started", self.chroot_dir)
+        return True
+
+    def read_messages(self):
+        """ Reader thread. Passes each message to its request's queue """
+        for line in self.proc.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            with self.lock:
+                messages = self.requests.get(message.get('id'), None)
+            if messages is not None:
+                messages.put(message)
+
+        # Helper has exited. Tell everyone still waiting
+        with self.lock:
+            self.alive = False
+            waiting = list(self.requests.values())
+        for messages in waiting:
+            messages.put({'error': "chroot helper exited"})
+
+    def send(self, request):
+        """ Sends a request to the helper """
+        with self.lock:
+            self.proc.stdin.write(json.dumps(request) + "\n")
+            self.proc.stdin.flush()
+
+    def run(self, cmd, timeout=None, on_output=None):
+        """ Runs cmd inside the chroot. Returns (exit code, output).
+            on_output(line) is called with each output line as soon as it
+            is printed. Raises subprocess.TimeoutExpired if the command
+            does not finish in time (it is killed) and OSError if the helper
+            is not running. As with chroot(1), a command that can't be found
+            returns 127 (126 if it can't be run) and an error message """
+        messages = queue.Queue()
+        with self.lock:
+            if not self.alive:
+                raise OSError("chroot helper is not running")
+            request_id = self.next_id
+            self.next_id += 1
+            self.requests[request_id] = messages
+
+        start = time.perf_counter()
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        output = []
+        try:
+            self.send({'id': request_id, 'cmd': list(cmd), 'env': dict(os.environ)})
+            while True:
+                wait = None
+                if deadline is not None:
+                    wait = max(0, deadline - time.monotonic())
+                try:
+                    message = messages.get(timeout=wait)
+                except queue.Empty:
+                    self.send({'id': request_id, 'kill': True})
+                    raise subprocess.TimeoutExpired(cmd, timeout, "".join(output))
+                if 'output' in message:
+                    output.append(message['output'])
+                    if on_output is not None:
+                        on_output(message['output'])
+                elif 'returncode' in message:
+                    return message['returncode'], "".join(output)
+                elif 'error' in message:
+                    raise OSError(message['error'])
+        except (BrokenPipeError, ValueError) as err:
+            raise OSError("chroot helper is not running: {0}".format(err))
+        finally:
+            with self.lock:
+                del self.requests[request_id]
+                self.commands += 1
+                self.run_time += time.perf_counter() - start
+
+    def stop(self):
+        """ Stops the helper (waits for running commands) """
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=HELPER_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.alive = False
+        logging.debug(
+            "Chroot helper for %s ran %d commands in %.2f seconds",
+            self.chroot_dir,
+            self.commands,
+            self.run_time)
+
+
+# chroot dir: session (only in the process that started it)
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(chroot_dir):
+    """ Returns the running session of chroot_dir (or None) """
+    key = (os.getpid(), os.path.abspath(chroot_dir))
+    with _SESSIONS_LOCK:
+        chroot_session = _SESSIONS.get(key, None)
+    if chroot_session is not None and chroot_session.alive:
+        return chroot_session
+    return None
+
+
+@contextmanager
+def session(chroot_dir):
+    """ Keeps a chroot helper running for chroot_dir while in the with
+        block. Meanwhile, chroot_call uses it (if it could be started) """
+    key = (os.getpid(), os.path.abspath(chroot_dir))
+    chroot_session = ChrootSession(chroot_dir)
+    started = chroot_session.start()
+    if started:
+        with _SESSIONS_LOCK:
+            _SESSIONS[key] = chroot_session
+    try:
+        yield chroot_session
+    finally:
+        if started:
+            with _SESSIONS_LOCK:
+                _SESSIONS.pop(key, None)
+            chroot_session.stop()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# event_bus.py
+#
+# Copyright © 2013-2017 Antergos
+#
+# This file is part of Cnchi.
+#
+# Cnchi is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# Cnchi is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# The following additional terms are in effect as per Section 7 of the license:
+#
+# The preservation of all legal notices and author attributions in
+# the material or in the Appropriate Legal Notices displayed
+# by works containing it is required.
+#
+# You should have received a copy of the GNU General Public License
+# along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Sends events from the installer process to the GUI (slides.py).
+    Events of the same type are coalesced (only the last value is sent) and
+    sent in batches, at most once every INTERVAL seconds """
+
+import logging
+import os
+import queue
+import threading
+import time
+
+from collections import OrderedDict
+
+# Minimum time between two batches (in seconds)
+INTERVAL = 0.25
+
+# Events of these types are never coalesced nor delayed
+IMMEDIATE_EVENTS = ['error', 'finished', 'cache_pkgs_md5_check_failed']
+
+# Name of the event that carries a list of events
+BATCH = 'batch'
+
+
+class EventBus(object):
+    """ Coalescing, rate limited wrapper around Cnchi's callback queue """
+
+    def __init__(self, callback_queue, interval=INTERVAL):
+        self.callback_queue = callback_queue
+        self.interval = interval
+
+        # Events waiting to be sent (type: text)
+        self.pending = OrderedDict()
+        # Last text sent (or waiting to be sent) of each event type
+        self.last_event = {}
+        self.last_flush = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def queue_event(self, event_type, event_text=""):
+        """ Adds an event. It will be sent with the next batch """
+        if self.callback_queue is None:
+            if event_type != "percent":
+                logging.debug("%s: %s", event_type, event_text)
+            return
+
+        with self.lock:
+            if self.last_event.get(event_type, None) == event_text:
+                # Do not repeat same event
+                return
+            self.last_event[event_type] = event_text
+
+            if event_type in IMMEDIATE_EVENTS:
+                # Send what we have (so order is kept) and then this event
+                self.flush_pending()
+                self.put((event_type, event_text))
+                return
+
+            self.pending[event_type] = event_text
+
+            wait = self.last_flush + self.interval - time.monotonic()
+            if wait <= 0:
+                self.flush_pending()
+            elif self.timer is None:
+                self.timer = threading.Timer(wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """ Sends all pending events now """
+        with self.lock:
+            self.flush_pending()
+
+    def flush_pending(self):
+        """ Sends pending events as one batch (lock must be held) """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        events = list(self.pending.items())
+        self.pending.clear()
+        if len(events) == 1:
+            self.put(events[0])
+        else:
+            self.put((BATCH, events))
+
+    def put(self, event):
+        """ Puts an event in the callback queue """
+        try:
+            self.callback_queue.put_nowait(event)
+        except queue.Full:
+            logging.warning("Callback queue is full")
+
+
+# One bus per callback queue (and process)
+_EVENT_BUSES = {}
+_EVENT_BUSES_LOCK = threading.Lock()
+
+
+def get_event_bus(callback_queue, interval=None):
+    """ Returns the event bus of callback_queue. If interval is given, the
+        bus will use it from now on """
+    key = (os.getpid(), id(callback_queue))
+    with _EVENT_BUSES_LOCK:
+        bus = _EVENT_BUSES.get(key, None)
+        if bus is None:
+            bus = EventBus(callback_queue)
+            _EVENT_BUSES[key] = bus
+    if interval is not None:
+        bus.interval = interval
+    return bus
+
+
+def unpack(event):
+    """ Returns the list of events carried by an event read from the
+        callback queue (batches carry several of them) """
+    if event[0] == BATCH:
+        return event[1]
+    return [event]
@@ -39,6 +39,7 @@ import shutil
 from functools import wraps
 
 from misc.extra import InstallError, raised_privileges
+import misc.chroot_session as chroot_session
 
 DEST_DIR = "/install"
 
@@ -126,7 +127,8 @@ def call(cmd, warning=True, error=False, fatal=False, msg=None, timeout=None,
 
 def chroot_call(cmd, chroot_dir=DEST_DIR, fatal=False, msg=None, timeout=None,
                 stdin=None):
-    """ Runs command inside the chroot """
+    """ Runs command inside the chroot (through the chroot helper, if there
+        is one running for chroot_dir) """
     full_cmd = ['chroot', chroot_dir]
 
     for element in cmd:
@@ -135,16 +137,31 @@ def chroot_call(cmd, chroot_dir=DEST_DIR, fatal=False, msg=None, timeout=None,
     if not os.environ.get('CNCHI_RUNNING', False):
         os.environ['CNCHI_RUNNING'] = 'True'
 
+    proc = None
+    returncode = None
+    session = chroot_session.get_session(chroot_dir)
     try:
-        proc = subprocess.Popen(
-            full_cmd,
-            stdin=stdin,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-        stdout_data, stderr_data = proc.communicate(timeout=timeout)
-        stdout_data = stdout_data.decode().strip()
+        if session is not None and stdin is None:
+            try:
+                returncode, stdout_data = session.run(cmd, timeout=timeout)
+            except OSError as os_error:
+                # The helper is gone, run chroot as usual
+                logging.debug("Chroot helper failed: %s", os_error)
+        if returncode is None:
+            proc = subprocess.Popen(
+                full_cmd,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            stdout_data, stderr_data = proc.communicate(timeout=timeout)
+            stdout_data = stdout_data.decode()
+            returncode = proc.returncode
+        stdout_data = stdout_data.strip()
         if stdout_data:
             logging.debug(stdout_data)
+        if returncode != 0:
+            logging.debug(
+                "Command %s exited with code %d", " ".join(cmd), returncode)
         return stdout_data
     except subprocess.TimeoutExpired as err:
         if proc:
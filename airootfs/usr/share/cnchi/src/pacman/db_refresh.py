@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  db_refresh.py
+#
+#  Copyright © 2013-2017 Antergos
+#
+#  This file is part of Cnchi.
+#
+#  Cnchi is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Cnchi is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  The following additional terms are in effect as per Section 7 of the license:
+#
+#  The preservation of all legal notices and author attributions in
+#  the material or in the Appropriate Legal Notices displayed
+#  by works containing it is required.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Downloads all sync databases at the same time (outside libalpm).
+    Requests are conditional (If-Modified-Since / If-None-Match), so
+    databases that have not changed are not downloaded again """
+
+import email.utils
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+# Stores the ETag of each database file (in the sync directory)
+ETAGS_NAME = ".cnchi-db-etags.json"
+
+# Seconds to wait for a mirror
+TIMEOUT = 15
+
+CHUNK_SIZE = 64 * 1024
+
+# Results
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+def write_atomically(response, dst_path):
+    """ Writes the response body to a temporary file and then renames it """
+    tmp_path = dst_path + ".part"
+    try:
+        with open(tmp_path, "wb") as tmp_file:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                tmp_file.write(chunk)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+
+        last_modified = response.headers.get("Last-Modified")
+        if last_modified:
+            # Keep server's time, so If-Modified-Since works next time
+            modified = email.utils.parsedate_to_datetime(last_modified)
+            os.utime(tmp_path, (time.time(), modified.timestamp()))
+
+        os.replace(tmp_path, dst_path)
+    except (OSError, ValueError, TypeError, requests.RequestException):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class DatabaseRefresh(object):
+    """ Refreshes the sync databases of an alpm handle """
+
+    def __init__(self, sync_dir, sessions, timeout=TIMEOUT):
+        self.sync_dir = sync_dir
+        self.sessions = sessions
+        self.timeout = timeout
+        self.etags = {}
+        self.lock = threading.Lock()
+        # database name: (result, seconds)
+        self.timings = {}
+
+    def load_etags(self):
+        """ Reads the stored ETags """
+        path = os.path.join(self.sync_dir, ETAGS_NAME)
+        try:
+            with open(path) as etags_file:
+                self.etags = json.load(etags_file)
+        except (OSError, ValueError):
+            self.etags = {}
+
+    def save_etags(self):
+        """ Stores the ETags for the next refresh """
+        path = os.path.join(self.sync_dir, ETAGS_NAME)
+        try:
+            with open(path + ".part", "w") as etags_file:
+                json.dump(self.etags, etags_file)
+            os.replace(path + ".part", path)
+        except OSError as os_error:
+            logging.warning("Can't store database ETags: %s", os_error)
+
+    def get_headers(self, file_name):
+        """ Conditional request headers of a database file """
+        headers = {}
+        path = os.path.join(self.sync_dir, file_name)
+        if os.path.exists(path):
+            headers["If-Modified-Since"] = email.utils.formatdate(
+                os.path.getmtime(path), usegmt=True)
+            with self.lock:
+                etag = self.etags.get(file_name)
+            if etag:
+                headers["If-None-Match"] = etag
+        return headers
+
+    def fetch(self, name, servers):
+        """ Downloads one database (trying each server in turn).
+            Returns UPDATED, UNCHANGED or FAILED """
+        file_name = name + ".db"
+        dst_path = os.path.join(self.sync_dir, file_name)
+
+        for server in servers:
+            url = "{0}/{1}".format(server.rstrip("/"), file_name)
+            try:
+                response = self.sessions.get(
+                    url,
+                    headers=self.get_headers(file_name),
+                    timeout=self.timeout,
+                    stream=True)
+                with response:
+                    if response.status_code == 304:
+                        return UNCHANGED
+                    response.raise_for_status()
+                    write_atomically(response, dst_path)
+                    with self.lock:
+                        self.etags[file_name] = response.headers.get("ETag")
+                self.fetch_signature(name, server)
+                return UPDATED
+            except (OSError, ValueError, TypeError,
+                    requests.RequestException) as err:
+                logging.debug("Can't download %s: %s", url, err)
+        return FAILED
+
+    def fetch_signature(self, name, server):
+        """ Downloads the signature of a database that has just been updated.
+            An old signature would not match, so it is removed if the
+            server does not have one """
+        file_name = name + ".db.sig"
+        dst_path = os.path.join(self.sync_dir, file_name)
+        url = "{0}/{1}".format(server.rstrip("/"), file_name)
+        try:
+            response = self.sessions.get(url, timeout=self.timeout, stream=True)
+            with response:
+                if response.status_code == 200:
+                    write_atomically(response, dst_path)
+                    return
+        except (OSError, ValueError, TypeError,
+                requests.RequestException) as err:
+            logging.debug("Can't download %s: %s", url, err)
+        if os.path.exists(dst_path):
+            os.remove(dst_path)
+
+    def fetch_timed(self, name, servers):
+        """ Thread target. Stores result and time of a database """
+        start = time.perf_counter()
+        result = self.fetch(name, servers)
+        with self.lock:
+            self.timings[name] = (result, time.perf_counter() - start)
+
+    def run(self, databases):
+        """ Refreshes all databases at once. databases is a list of
+            (name, servers). Returns the names of the databases that
+            could not be refreshed """
+        os.makedirs(self.sync_dir, mode=0o755, exist_ok=True)
+        self.load_etags()
+        self.timings = {}
+
+        threads = []
+        for name, servers in databases:
+            thread = threading.Thread(
+                target=self.fetch_timed, args=(name, servers))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        self.save_etags()
+        self.log_timings()
+        return [name for name, (result, _seconds) in self.timings.items()
+                if result == FAILED]
+
+    def log_timings(self):
+        """ Logs the result and time of each database """
+        for name in sorted(self.timings):
+            result, seconds = self.timings[name]
+            logging.debug("Database %s %s in %.2f seconds", name, result, seconds)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  handle_service.py
+#
+#  Copyright © 2013-2017 Antergos
+#
+#  This file is part of Cnchi.
+#
+#  Cnchi is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Cnchi is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  The following additional terms are in effect as per Section 7 of the license:
+#
+#  The preservation of all legal notices and author attributions in
+#  the material or in the Appropriate Legal Notices displayed
+#  by works containing it is required.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Keeps one initialized alpm handle (Pac object) per pacman.conf and root
+    dir, so all installation stages share it instead of creating their own
+    and refreshing the same databases again """
+
+import logging
+import os
+import shutil
+import threading
+import time
+
+from collections import OrderedDict
+
+import pacman.pac as pac
+import pacman.pacman_conf as pacman_conf
+
+import download.session_pool as session_pool
+
+# Download all databases at once, and only if they have changed
+PARALLEL_REFRESH = True
+
+
+class HandleService(object):
+    """ Serves shared Pac objects """
+
+    def __init__(self, parallel_refresh=PARALLEL_REFRESH):
+        self.parallel_refresh = parallel_refresh
+        # (conf path, root dir): Pac object
+        self.handles = OrderedDict()
+        # (conf path, root dir): seconds needed to initialize / refresh it
+        self.init_times = {}
+        self.refresh_times = {}
+        # Handles whose databases have already been refreshed in this run
+        self.refreshed = set()
+        # stage: seconds saved by reusing handles and databases
+        self.saved = OrderedDict()
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def get_key(conf_path):
+        """ Returns the (conf path, root dir) pair of a pacman.conf file """
+        config = pacman_conf.get_pacman_config(conf_path)
+        return (os.path.abspath(conf_path),
+                os.path.abspath(config.options["RootDir"]))
+
+    def get_key_of(self, pacman):
+        """ Returns the key of a Pac object served by us """
+        for key, value in self.handles.items():
+            if value is pacman:
+                return key
+        return None
+
+    def add_saved(self, stage, seconds):
+        """ Stores time saved by a stage """
+        stage = stage or "unknown"
+        self.saved[stage] = self.saved.get(stage, 0) + seconds
+
+    def get_pac(self, conf_path, callback_queue=None, stage=None):
+        """ Returns the Pac object of conf_path (creates it if needed) """
+        key = self.get_key(conf_path)
+        with self.lock:
+            pacman = self.handles.get(key, None)
+            if pacman is not None:
+                pacman.set_callback_queue(callback_queue)
+                self.add_saved(stage, self.init_times[key])
+                logging.debug("Reusing alpm handle of %s (root %s)", *key)
+                return pacman
+
+            start = time.perf_counter()
+            pacman = pac.Pac(conf_path, callback_queue)
+            self.init_times[key] = time.perf_counter() - start
+            self.handles[key] = pacman
+            return pacman
+
+    def refresh(self, pacman, force=False, stage=None):
+        """ Refreshes the databases of a Pac object. Unless forced, they are
+            only refreshed once per run. Databases already refreshed (in this
+            run) by another handle with the same servers are copied instead
+            of being downloaded again """
+        with self.lock:
+            key = self.get_key_of(pacman)
+            if key in self.refreshed and not force:
+                self.add_saved(stage, self.refresh_times.get(key, 0))
+                return True
+
+            start = time.perf_counter()
+            seeded = []
+            if not force:
+                seeded = self.seed_sync_dbs(pacman, stage)
+            if self.parallel_refresh:
+                result = pacman.refresh_parallel(
+                    session_pool.get_session_pool(), skip=seeded)
+            else:
+                result = pacman.refresh(skip=seeded)
+            self.refresh_times[key] = time.perf_counter() - start
+
+            if result and key is not None:
+                self.refreshed.add(key)
+            return result
+
+    def seed_sync_dbs(self, pacman, stage=None):
+        """ Copies sync databases already refreshed in this run by another
+            handle, if they have exactly the same servers.
+            Returns the names of the copied databases """
+        seeded = []
+        config = pacman.get_config()
+        dst_dir = os.path.join(config.options["DBPath"], "sync")
+
+        for key in self.refreshed:
+            source = self.handles[key]
+            if source is pacman:
+                continue
+            source_config = source.get_config()
+            src_dir = os.path.join(source_config.options["DBPath"], "sync")
+            if os.path.abspath(src_dir) == os.path.abspath(dst_dir):
+                continue
+
+            copied = 0
+            for repo, servers in config.repos.items():
+                if repo in seeded or source_config.repos.get(repo) != servers:
+                    continue
+                src_path = os.path.join(src_dir, repo + ".db")
+                if not os.path.exists(src_path):
+                    continue
+                try:
+                    os.makedirs(dst_dir, mode=0o755, exist_ok=True)
+                    for ext in [".db", ".db.sig"]:
+                        src_path = os.path.join(src_dir, repo + ext)
+                        if os.path.exists(src_path):
+                            shutil.copy2(
+                                src_path, os.path.join(dst_dir, repo + ext))
+                except OSError as os_error:
+                    logging.warning(
+                        "Can't copy %s database: %s", repo, os_error)
+                    continue
+                seeded.append(repo)
+                copied += 1
+
+            if copied > 0 and source_config.repos:
+                # Estimate: the share of the source refresh time
+                self.add_saved(
+                    stage,
+                    self.refresh_times.get(key, 0) * copied /
+                    len(source_config.repos))
+
+        if seeded:
+            logging.debug(
+                "Databases %s copied to %s instead of downloading them again",
+                ", ".join(seeded),
+                dst_dir)
+        return seeded
+
+    def log_stats(self):
+        """ Logs time saved by each stage """
+        for stage, seconds in self.saved.items():
+            logging.debug(
+                "Shared alpm handles saved %.2f seconds in stage %s",
+                seconds,
+                stage)
+        logging.debug(
+            "Shared alpm handles saved %.2f seconds in total",
+            sum(self.saved.values()))
+
+    def release(self, pacman):
+        """ Releases a handle (it will be created again if needed) """
+        with self.lock:
+            key = self.get_key_of(pacman)
+            if key is not None:
+                del self.handles[key]
+                self.refreshed.discard(key)
+            pacman.release()
+
+    def release_all(self):
+        """ Releases all handles """
+        with self.lock:
+            for pacman in self.handles.values():
+                pacman.release()
+            self.handles.clear()
+            self.refreshed.clear()
+
+
+# One service per process (alpm handles can't be shared between processes)
+_HANDLE_SERVICE = None
+_HANDLE_SERVICE_PID = None
+
+
+def get_handle_service():
+    """ Returns this process' handle service """
+    global _HANDLE_SERVICE
+    global _HANDLE_SERVICE_PID
+
+    if _HANDLE_SERVICE is None or _HANDLE_SERVICE_PID != os.getpid():
+        _HANDLE_SERVICE = HandleService()
+        _HANDLE_SERVICE_PID = os.getpid()
+    return _HANDLE_SERVICE
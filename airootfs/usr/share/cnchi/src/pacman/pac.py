@@ -35,9 +35,9 @@ import sys
 import math
 import logging
 import os
-import queue
 import inspect
 import traceback
+import re
 from collections import OrderedDict
 
 try:
@@ -49,6 +49,11 @@ except NameError:
 import pacman.alpm_events as alpm
 import pacman.pkginfo as pkginfo
 import pacman.pacman_conf as config
+import pacman.provides_index as provides_index
+import pacman.db_refresh as db_refresh
+import pacman.telemetry as telemetry
+
+import misc.event_bus as event_bus
 
 try:
     import pyalpm
@@ -60,6 +65,21 @@ except ImportError as err:
 _DEFAULT_ROOT_DIR = "/"
 _DEFAULT_DB_PATH = "/var/lib/pacman"
 
+# alpm log lines that are not worth showing
+_IGNORED_LOG_RE = re.compile(
+    "|".join(re.escape(partial) for partial in [
+        'error 0',
+        'error 32',
+        'extracting',
+        'error 31 from alpm_db_get_pkg',
+        'command failed to execute correctly',
+        'extract: skipping dir extraction',
+        'loading package data for']))
+
+# Packages of these groups must be sourced from the ONE_REPO repo only
+ONE_REPO_GROUPS = ['cinnamon', 'mate', 'mate-extra']
+ONE_REPO = 'antergos'
+
 
 class Pac(object):
     """ Communicates with libalpm using pyalpm """
@@ -86,19 +106,31 @@ class Pac(object):
         # Store package total download size
         self.total_download_size = 0
 
-        self.last_event = {}
+        self.events = event_bus.get_event_bus(callback_queue)
+
+        # Result and seconds of each database in the last parallel refresh
+        self.refresh_timings = {}
+
+        # Name/provides indexes of sync and local databases (built on demand)
+        self.sync_index = None
+        self.local_index = None
 
         if not os.path.exists(conf_path):
             raise pyalpm.error
 
         if conf_path is not None and os.path.exists(conf_path):
-            self.config = config.PacmanConfig(conf_path)
+            self.config = config.get_pacman_config(conf_path)
             self.initialize_alpm()
             logging.debug('ALPM repository database order is: %s',
                           self.config.repo_order)
         else:
             raise pyalpm.error
 
+    def set_callback_queue(self, callback_queue):
+        """ Changes the queue where events are sent (shared handles) """
+        self.callback_queue = callback_queue
+        self.events = event_bus.get_event_bus(callback_queue)
+
     def get_handle(self):
         """ Return alpm handle """
         return self.handle
@@ -107,6 +139,25 @@ class Pac(object):
         """ Get pacman.conf config """
         return self.config
 
+    def get_provides_index(self):
+        """ Returns the name/provides index of all sync databases """
+        if self.sync_index is None:
+            self.sync_index = provides_index.ProvidesIndex(
+                self.handle.get_syncdbs())
+        return self.sync_index
+
+    def get_local_index(self):
+        """ Returns the name/provides index of the local database """
+        if self.local_index is None:
+            self.local_index = provides_index.ProvidesIndex(
+                [self.handle.get_localdb()])
+        return self.local_index
+
+    def invalidate_indexes(self):
+        """ Databases have changed, indexes must be built again """
+        self.sync_index = None
+        self.local_index = None
+
     def initialize_alpm(self):
         """ Set alpm setup """
         if self.config is not None:
@@ -143,8 +194,21 @@ class Pac(object):
         # Downloading callback
         self.handle.fetchcb = None
 
+    def reload_syncdbs(self):
+        """ Sync database files have been replaced without alpm knowing it,
+            so the packages it may have cached are stale. pyalpm can't
+            unregister a database, so a new handle is created (it reads the
+            new files when they are used). Cache dirs added later are kept """
+        cachedirs = list(self.handle.cachedirs)
+        self.release()
+        self.initialize_alpm()
+        for cache_dir in cachedirs:
+            if cache_dir not in self.handle.cachedirs:
+                self.handle.add_cachedir(cache_dir)
+
     def release(self):
         """ Release alpm handle """
+        self.invalidate_indexes()
         if self.handle is not None:
             del self.handle
             self.handle = None
@@ -153,6 +217,8 @@ class Pac(object):
     def finalize_transaction(transaction):
         """ Commit a transaction """
         all_ok = False
+        trace = telemetry.get_telemetry()
+        trace.transaction_started()
         try:
             logging.debug("Prepare alpm transaction...")
             transaction.prepare()
@@ -166,6 +232,7 @@ class Pac(object):
         finally:
             logging.debug("Releasing alpm transaction...")
             transaction.release()
+            trace.transaction_finished(all_ok)
             logging.debug("Alpm transaction done.")
         return all_ok
 
@@ -225,15 +292,22 @@ class Pac(object):
 
         return self.finalize_transaction(transaction)
 
-    def refresh(self):
-        """ Sync databases like pacman -Sy """
+    def refresh(self, skip=None):
+        """ Sync databases like pacman -Sy
+            Databases named in skip are not updated """
         if self.handle is None:
             logging.error("alpm is not initialised")
             raise pyalpm.error
 
+        if skip is None:
+            skip = []
+
         force = True
         res = True
+        self.invalidate_indexes()
         for database in self.handle.get_syncdbs():
+            if database.name in skip:
+                continue
             transaction = self.init_transaction()
             if transaction:
                 database.update(force)
@@ -242,6 +316,46 @@ class Pac(object):
                 res = False
         return res
 
+    def refresh_parallel(self, sessions, skip=None):
+        """ Sync databases downloading all of them at the same time, and
+            only if they have changed (see db_refresh.py). Databases that
+            can't be downloaded this way are refreshed by alpm.
+            Database files are replaced behind alpm, so the handle is
+            created again afterwards (see reload_syncdbs) """
+        if self.handle is None:
+            logging.error("alpm is not initialised")
+            raise pyalpm.error
+
+        if skip is None:
+            skip = []
+
+        self.invalidate_indexes()
+        databases = [(database.name, database.servers)
+                     for database in self.handle.get_syncdbs()
+                     if database.name not in skip]
+        sync_dir = os.path.join(self.config.options["DBPath"], "sync")
+
+        # The transaction holds alpm's database lock while we write
+        transaction = self.init_transaction()
+        if transaction is None:
+            return False
+        try:
+            refresh = db_refresh.DatabaseRefresh(sync_dir, sessions)
+            failed = refresh.run(databases)
+            self.refresh_timings = refresh.timings
+        finally:
+            transaction.release()
+            # Also needed by the databases copied by handle_service (skip)
+            self.reload_syncdbs()
+
+        if failed:
+            logging.warning(
+                "Databases %s will be refreshed by alpm", ", ".join(failed))
+            names = [name for name, _servers in databases]
+            return self.refresh(
+                skip=skip + [name for name in names if name not in failed])
+        return True
+
     def install(self, pkgs, conflicts=None, options=None):
         """ Install a list of packages like pacman -S """
 
@@ -259,64 +373,9 @@ class Pac(object):
             logging.error("Package list is empty")
             raise pyalpm.error
 
-        # Discard duplicates
-        pkgs = list(set(pkgs))
-
-        # `alpm.handle.get_syncdbs()` returns a list (the order is important) so we
-        # have to ensure we don't clobber the priority of the repos.
-        repos = OrderedDict()
-        repo_order = []
-        one_repo_groups = ['cinnamon', 'mate', 'mate-extra']
-        db_match = [db for db in self.handle.get_syncdbs()
-                    if 'antergos' == db.name]
-        antdb = OrderedDict()
-        antdb['antergos'] = db_match[0]
-        one_repo_groups = [antdb['antergos'].read_grp(one_repo_group)
-                           for one_repo_group in one_repo_groups]
-        one_repo_pkgs = {pkg for one_repo_group in one_repo_groups
-                         for pkg in one_repo_group[1] if one_repo_group}
-
-        for syncdb in self.handle.get_syncdbs():
-            repo_order.append(syncdb)
-            repos[syncdb.name] = syncdb
-
-        targets = []
-        logging.debug('REPO DB ORDER IS: %s', repo_order)
-
-        for name in pkgs:
-            _repos = repos
-
-            if name in one_repo_pkgs:
-                # pkg should be sourced from the antergos repo only.
-                _repos = antdb
-
-            result_ok, pkg = self.find_sync_package(name, _repos)
-
-            if result_ok:
-                # Check that added package is not in our conflicts list
-                if pkg.name not in conflicts:
-                    targets.append(pkg.name)
-            else:
-                # Couldn't find the package, check if it's a group
-                group_pkgs = self.get_group_pkgs(name)
-                if group_pkgs is not None:
-                    # It's a group
-                    for group_pkg in group_pkgs:
-                        # Check that added package is not in our conflicts list
-                        # Ex: connman conflicts with netctl(openresolv),
-                        # which is installed by default with base group
-                        if group_pkg.name not in conflicts:
-                            targets.append(group_pkg.name)
-                else:
-                    # No, it wasn't neither a package nor a group. As we don't
-                    # know if this error is fatal or not, we'll register it and
-                    # we'll allow to continue.
-                    logging.error(
-                        "Can't find a package or group called '%s'", name)
-
-        # Discard duplicates
-        targets = list(set(targets))
-        logging.debug(targets)
+        packages, _groups, _not_found = self.resolve(pkgs, conflicts)
+        targets = list(packages.values())
+        logging.debug([pkg.name for pkg in targets])
 
         if len(targets) == 0:
             logging.error("No targets found")
@@ -335,15 +394,80 @@ class Pac(object):
             logging.error("Can't initialize alpm transaction")
             return False
 
-        for i in range(0, num_targets):
-            result_ok, pkg = self.find_sync_package(targets.pop(), repos)
-            if result_ok:
-                transaction.add_pkg(pkg)
-            else:
-                logging.warning(pkg)
+        for pkg in targets:
+            transaction.add_pkg(pkg)
 
         return self.finalize_transaction(transaction)
 
+    def get_targets(self, pkgs, conflicts=None):
+        """ Returns the package names of a list of packages and groups """
+        packages, _groups, _not_found = self.resolve(pkgs, conflicts)
+        return list(packages.keys())
+
+    def get_one_repo_pkgs(self):
+        """ Names of the packages that must be sourced from the antergos
+            repo only (members of ONE_REPO_GROUPS) """
+        index = self.get_provides_index()
+        one_repo_pkgs = set()
+        for group in ONE_REPO_GROUPS:
+            group_pkgs = index.get_group(group, [ONE_REPO])
+            if group_pkgs:
+                one_repo_pkgs.update(pkg.name for pkg in group_pkgs)
+        return one_repo_pkgs
+
+    def resolve(self, names, conflicts=None):
+        """ Resolves a list of package and group names in one pass, using the
+            name and group indexes of the sync databases.
+            Returns (packages, groups, not_found):
+              packages: OrderedDict of name: pkg (requested packages and
+                        the members of requested groups)
+              groups: OrderedDict of group name: [pkg, ...]
+              not_found: names that are neither a package nor a group
+            Packages in conflicts are left out """
+        if not conflicts:
+            conflicts = []
+
+        index = self.get_provides_index()
+        one_repo_pkgs = self.get_one_repo_pkgs()
+
+        packages = OrderedDict()
+        groups = OrderedDict()
+        not_found = []
+
+        # Discard duplicates (keeping order)
+        for name in OrderedDict.fromkeys(names):
+            db_names = None
+            if name in one_repo_pkgs:
+                # pkg should be sourced from the antergos repo only.
+                db_names = [ONE_REPO]
+
+            pkg = index.get_pkg(name, db_names)
+            if pkg is not None:
+                # Check that added package is not in our conflicts list
+                if pkg.name not in conflicts:
+                    packages[pkg.name] = pkg
+                continue
+
+            # Couldn't find the package, check if it's a group
+            group_pkgs = index.get_group(name)
+            if group_pkgs is not None:
+                groups[name] = group_pkgs
+                for group_pkg in group_pkgs:
+                    # Check that added package is not in our conflicts list
+                    # Ex: connman conflicts with netctl(openresolv),
+                    # which is installed by default with base group
+                    if group_pkg.name not in conflicts:
+                        packages.setdefault(group_pkg.name, group_pkg)
+            else:
+                # No, it wasn't neither a package nor a group. As we don't
+                # know if this error is fatal or not, we'll register it and
+                # we'll allow to continue.
+                logging.error(
+                    "Can't find a package or group called '%s'", name)
+                not_found.append(name)
+
+        return packages, groups, not_found
+
     def upgrade(self, pkgs, conflicts=None, options=None):
         """ Install a list package tarballs like pacman -U """
 
@@ -447,13 +571,6 @@ class Pac(object):
             # Limit percent to two decimal
             event_text = "{0:.2f}".format(event_text)
 
-        if event_type in self.last_event:
-            if self.last_event[event_type] == event_text:
-                # Do not enqueue the same event twice
-                return
-
-        self.last_event[event_type] = event_text
-
         if event_type == "error":
             # Format message to show file, function, and line where the
             # error was issued
@@ -474,10 +591,7 @@ class Pac(object):
             else:
                 logging.debug(event_text)
         else:
-            try:
-                self.callback_queue.put_nowait((event_type, event_text))
-            except queue.Full:
-                logging.warning("Callback queue is full")
+            self.events.queue_event(event_type, event_text)
 
             if event_type == "error":
                 # We've queued a fatal event so we must exit installer_process
@@ -500,6 +614,8 @@ class Pac(object):
     def cb_event(self, event_type, event_txt):
         """ Converts action ID to descriptive text and enqueues it to the events queue """
 
+        telemetry.get_telemetry().event(event_type)
+
         if event_type is alpm.ALPM_EVENT_CHECKDEPS_START:
             action = _('Checking dependencies...')
         elif event_type is alpm.ALPM_EVENT_FILECONFLICTS_START:
@@ -545,22 +661,9 @@ class Pac(object):
 
         # Log everything to cnchi-alpm.log
         self.logger.debug(line)
+        telemetry.get_telemetry().log_line(line)
 
-        ignore = False
-        partials = ['error 0',
-                    'error 32',
-                    'extracting',
-                    'error 31 from alpm_db_get_pkg',
-                    'command failed to execute correctly',
-                    'extract: skipping dir extraction',
-                    'loading package data for']
-
-        for partial in partials:
-            if partial in line:
-                ignore = True
-                break
-
-        if ignore or not level:
+        if not level or _IGNORED_LOG_RE.search(line):
             return
 
         if level == pyalpm.LOG_ERROR:
@@ -573,6 +676,7 @@ class Pac(object):
 
     def cb_progress(self, target, percent, total, current):
         """ Shows install progress """
+        telemetry.get_telemetry().progress(target, percent)
         if target:
             msg = _("Installing {0} ({1}/{2})").format(target, current, total)
             self.queue_event('info', msg)
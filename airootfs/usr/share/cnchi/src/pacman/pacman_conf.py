@@ -30,6 +30,7 @@
 """ This module handles pacman.conf files """
 
 import os
+import copy
 import glob
 import collections
 import warnings
@@ -88,31 +89,43 @@ BOOLEAN_OPTIONS = (
 )
 
 
-def pacman_conf_enumerator(path):
-    """ Parse pacman.conf file """
-    filestack = []
+def read_conf_lines(path, files_read=None):
+    """ Returns the meaningful (stripped, not empty, not comment) lines of a
+        file. If files_read is given, (path, mtime) is added to it """
+    with open(path) as conf_file:
+        if files_read is not None:
+            files_read.append((path, os.fstat(conf_file.fileno()).st_mtime_ns))
+        lines = [line.strip() for line in conf_file.read().splitlines()]
+    return [line for line in lines if line and line[0] != '#']
+
+
+def pacman_conf_enumerator(path, files_read=None, globs=None):
+    """ Parse pacman.conf file
+        Included files are read (and include patterns globbed) only once,
+        even if they are included by several repos (mirrorlist).
+        Files read (and their mtimes) are appended to files_read and include
+        patterns (with the files they matched) are stored in globs """
+    if globs is None:
+        globs = {}
+    # path: lines (of included files)
+    included = {}
+
+    filestack = [(path, iter(read_conf_lines(path, files_read)))]
     current_section = None
-    filestack.append(open(path))
     while len(filestack) > 0:
-        file_obj = filestack[-1]
-        line = file_obj.readline()
-        if len(line) == 0:
+        file_name, lines = filestack[-1]
+        line = next(lines, None)
+        if line is None:
             # end of file
-            file_obj.close()
             filestack.pop()
             continue
 
-        line = line.strip()
-        if len(line) == 0:
-            continue
-        if line[0] == '#':
-            continue
         if line[0] == '[' and line[-1] == ']':
             current_section = line[1:-1]
             continue
         if current_section is None:
             raise InvalidSyntax(
-                file_obj.name,
+                file_name,
                 'statement outside of a section',
                 line)
         # read key, value
@@ -120,7 +133,15 @@ def pacman_conf_enumerator(path):
 
         # include files
         if equal == '=' and key == 'Include':
-            filestack.extend(open(f) for f in glob.glob(value))
+            if value not in globs:
+                globs[value] = sorted(glob.glob(value))
+            # Pushed in reverse so they are read in order (as pacman does)
+            for include_path in reversed(globs[value]):
+                if include_path not in included:
+                    included[include_path] = read_conf_lines(
+                        include_path, files_read)
+                filestack.append(
+                    (include_path, iter(included[include_path])))
             continue
         if current_section != 'options':
             # repos only have the Server, SigLevel, Usage options
@@ -128,7 +149,7 @@ def pacman_conf_enumerator(path):
                 yield (current_section, key, value)
             else:
                 raise InvalidSyntax(
-                    file_obj.name,
+                    file_name,
                     'invalid key for repository configuration',
                     line)
             continue
@@ -140,13 +161,13 @@ def pacman_conf_enumerator(path):
                 yield (current_section, key, value)
             else:
                 warnings.warn(InvalidSyntax(
-                    file_obj.name, 'unrecognized option', key))
+                    file_name, 'unrecognized option', key))
         else:
             if key in BOOLEAN_OPTIONS:
                 yield (current_section, key, True)
             else:
                 warnings.warn(InvalidSyntax(
-                    file_obj.name, 'unrecognized option', key))
+                    file_name, 'unrecognized option', key))
 
 
 class PacmanConfig(collections.OrderedDict):
@@ -163,6 +184,11 @@ class PacmanConfig(collections.OrderedDict):
         self.options["LogFile"] = "/var/log/pacman.log"
         self.options["Architecture"] = os.uname()[-1]
         self.repo_order = []
+        # repo: SigLevel (repo's own or the global one)
+        self.siglevels = collections.OrderedDict()
+        # Files read (path, mtime) and include patterns (with their matches)
+        self.files_read = []
+        self.globs = {}
         if conf is not None:
             self.load_from_file(conf)
         if options is not None:
@@ -170,7 +196,9 @@ class PacmanConfig(collections.OrderedDict):
 
     def load_from_file(self, filename):
         """ Load pacman options from file (pacman.conf) """
-        for section, key, value in pacman_conf_enumerator(filename):
+        repo_siglevels = {}
+        for section, key, value in pacman_conf_enumerator(
+                filename, self.files_read, self.globs):
             if section == 'options':
                 if key == 'Architecture' and value == 'auto':
                     continue
@@ -182,9 +210,36 @@ class PacmanConfig(collections.OrderedDict):
                 servers = self.repos.setdefault(section, [])
                 if key == 'Server':
                     servers.append(value)
+                elif key == 'SigLevel':
+                    repo_siglevels[section] = value
         if "CacheDir" not in self.options:
             self.options["CacheDir"] = ["/var/cache/pacman/pkg"]
 
+        default_siglevel = self.options.get("SigLevel", None)
+        for repo in self.repos:
+            self.siglevels[repo] = repo_siglevels.get(repo, default_siglevel)
+
+    def get_siglevel(self, repo):
+        """ Returns the first word of the repo's SigLevel (or None) """
+        siglevel = self.siglevels.get(repo, None)
+        if siglevel:
+            return siglevel.split()[0]
+        return None
+
+    def is_unchanged(self):
+        """ Checks that no file read (nor include pattern) has changed since
+            this config was loaded """
+        for pattern, matches in self.globs.items():
+            if sorted(glob.glob(pattern)) != matches:
+                return False
+        for path, mtime in self.files_read:
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
     def load_from_options(self, options):
         """ Load options from 'options' variable """
         global _LOGMASK
@@ -224,6 +279,7 @@ class PacmanConfig(collections.OrderedDict):
         # h.logcb = cb_log
 
         # set sync databases
+        self.repo_order = []
         for repo, servers in self.repos.items():
             self.repo_order.append(repo)
             database = handle.register_syncdb(repo, 0)
@@ -249,3 +305,19 @@ class PacmanConfig(collections.OrderedDict):
                     conf = '{0}{1} = {2}\n'.format(conf, key, value)
             conf += '\n'
         return conf
+
+
+# path: parsed PacmanConfig
+_CONFIG_CACHE = {}
+
+
+def get_pacman_config(path):
+    """ Returns a parsed pacman.conf. Files are only parsed again if they
+        (or any of their includes) have changed. Each caller gets its own
+        copy, so it can be modified freely """
+    path = os.path.abspath(path)
+    conf = _CONFIG_CACHE.get(path, None)
+    if conf is None or not conf.is_unchanged():
+        conf = PacmanConfig(path)
+        _CONFIG_CACHE[path] = conf
+    return copy.deepcopy(conf)
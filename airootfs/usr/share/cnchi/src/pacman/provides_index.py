@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  provides_index.py
+#
+#  Copyright © 2013-2017 Antergos
+#
+#  This file is part of Cnchi.
+#
+#  Cnchi is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Cnchi is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  The following additional terms are in effect as per Section 7 of the license:
+#
+#  The preservation of all legal notices and author attributions in
+#  the material or in the Appropriate Legal Notices displayed
+#  by works containing it is required.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" In-memory index of package names and provides (for fast dependency
+    lookups) """
+
+import logging
+import re
+import time
+
+try:
+    import pyalpm
+except ImportError:
+    # This is already logged elsewhere
+    pass
+
+# Splits a dependency (or provision) string in name, operator and version
+_DEP_RE = re.compile(r'^(?P<name>[^<>=]+)(?:(?P<op><=|>=|<|>|=)(?P<version>.+))?$')
+
+# Candidate kinds. In each database, packages with the dependency name
+# are preferred to packages that provide it (as alpm_find_satisfier does)
+_BY_NAME = 0
+_BY_PROVIDES = 1
+
+
+def split_dep(dep):
+    """ Returns (name, operator, version) of a dependency string.
+        operator and version are None if there is no version constraint """
+    match = _DEP_RE.match(dep)
+    if match is None:
+        return dep, None, None
+    return match.group('name'), match.group('op'), match.group('version')
+
+
+def version_satisfies(version, operator, wanted):
+    """ Checks if version satisfies 'operator wanted' (for instance >= 1.2) """
+    if operator is None:
+        return True
+    if version is None:
+        # Unversioned provisions only satisfy unversioned dependencies
+        return False
+    cmp = pyalpm.vercmp(version, wanted)
+    if operator == '=':
+        return cmp == 0
+    if operator == '>=':
+        return cmp >= 0
+    if operator == '<=':
+        return cmp <= 0
+    if operator == '>':
+        return cmp > 0
+    if operator == '<':
+        return cmp < 0
+    return False
+
+
+class ProvidesIndex(object):
+    """ Maps each package name and each 'provides' entry to its candidate
+        packages, in repository priority order. Built once, then dependency
+        lookups are just dict hits instead of a linear scan of every
+        package of every database. Groups are indexed too """
+
+    def __init__(self, databases):
+        self.databases = list(databases)
+        # name: [(db position, kind, provided version, pkg), ...]
+        self.candidates = {}
+        # dep string: satisfier (or None)
+        self.satisfiers = {}
+        # group name: {db position: [pkg, ...]}
+        self.groups = {}
+        self.build()
+
+    def build(self):
+        """ Reads all packages of all databases """
+        start = time.perf_counter()
+        total = 0
+        for position, database in enumerate(self.databases):
+            for pkg in database.pkgcache:
+                total += 1
+                self.add(pkg.name, (position, _BY_NAME, pkg.version, pkg))
+                for provision in pkg.provides:
+                    name, _operator, version = split_dep(provision)
+                    self.add(name, (position, _BY_PROVIDES, version, pkg))
+                for group in pkg.groups:
+                    self.groups.setdefault(group, {}).setdefault(
+                        position, []).append(pkg)
+
+        for entries in self.candidates.values():
+            entries.sort(key=lambda entry: (entry[0], entry[1]))
+
+        logging.debug(
+            "Provides index of %d packages (%d names) built in %.2f seconds",
+            total,
+            len(self.candidates),
+            time.perf_counter() - start)
+
+    def add(self, name, entry):
+        """ Adds a candidate to name """
+        self.candidates.setdefault(name, []).append(entry)
+
+    def find_satisfier(self, dep, db_names=None):
+        """ Returns the first package (in repo order) that satisfies dep,
+            or None. If db_names is given, only those databases are used """
+        if db_names is None and dep in self.satisfiers:
+            return self.satisfiers[dep]
+
+        name, operator, wanted = split_dep(dep)
+        satisfier = None
+        for position, _kind, version, pkg in self.candidates.get(name, []):
+            if db_names is not None and self.databases[position].name not in db_names:
+                continue
+            if version_satisfies(version, operator, wanted):
+                satisfier = pkg
+                break
+
+        if db_names is None:
+            self.satisfiers[dep] = satisfier
+        return satisfier
+
+    def get_group(self, name, db_names=None):
+        """ Returns the packages of group name in the first database (in
+            repo order) that has it (like read_grp), or None """
+        positions = self.groups.get(name, {})
+        for position in sorted(positions):
+            if db_names is None or self.databases[position].name in db_names:
+                return positions[position]
+        return None
+
+    def get_pkg(self, name, db_names=None):
+        """ Returns the package called name (in repo order), or None """
+        for position, kind, _version, pkg in self.candidates.get(name, []):
+            if kind != _BY_NAME:
+                continue
+            if db_names is None or self.databases[position].name in db_names:
+                return pkg
+        return None
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  telemetry.py
+#
+#  Copyright © 2013-2017 Antergos
+#
+#  This file is part of Cnchi.
+#
+#  Cnchi is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  Cnchi is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  The following additional terms are in effect as per Section 7 of the license:
+#
+#  The preservation of all legal notices and author attributions in
+#  the material or in the Appropriate Legal Notices displayed
+#  by works containing it is required.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with Cnchi; If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Records how long each phase of the alpm transactions takes (from alpm
+    callbacks) in a JSONL trace, and summarizes the slowest packages and
+    hooks """
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import pacman.alpm_events as alpm
+
+TRACE_PATH = "/tmp/cnchi-alpm-trace.jsonl"
+
+# How many packages / hooks are shown in the summary
+SUMMARY_SIZE = 10
+
+# event: (phase, True if it starts the phase)
+PHASE_EVENTS = {
+    alpm.ALPM_EVENT_CHECKDEPS_START: ('checkdeps', True),
+    alpm.ALPM_EVENT_CHECKDEPS_DONE: ('checkdeps', False),
+    alpm.ALPM_EVENT_RESOLVEDEPS_START: ('resolvedeps', True),
+    alpm.ALPM_EVENT_RESOLVEDEPS_DONE: ('resolvedeps', False),
+    alpm.ALPM_EVENT_INTERCONFLICTS_START: ('interconflicts', True),
+    alpm.ALPM_EVENT_INTERCONFLICTS_DONE: ('interconflicts', False),
+    alpm.ALPM_EVENT_INTEGRITY_START: ('integrity', True),
+    alpm.ALPM_EVENT_INTEGRITY_DONE: ('integrity', False),
+    alpm.ALPM_EVENT_LOAD_START: ('load', True),
+    alpm.ALPM_EVENT_LOAD_DONE: ('load', False),
+    alpm.ALPM_EVENT_FILECONFLICTS_START: ('fileconflicts', True),
+    alpm.ALPM_EVENT_FILECONFLICTS_DONE: ('fileconflicts', False),
+    alpm.ALPM_EVENT_DISKSPACE_START: ('diskspace', True),
+    alpm.ALPM_EVENT_DISKSPACE_DONE: ('diskspace', False),
+    alpm.ALPM_EVENT_KEYRING_START: ('keyring', True),
+    alpm.ALPM_EVENT_KEYRING_DONE: ('keyring', False),
+    alpm.ALPM_EVENT_RETRIEVE_START: ('retrieve', True),
+    alpm.ALPM_EVENT_RETRIEVE_DONE: ('retrieve', False),
+    alpm.ALPM_EVENT_RETRIEVE_FAILED: ('retrieve', False),
+    alpm.ALPM_EVENT_TRANSACTION_START: ('packages', True),
+    alpm.ALPM_EVENT_TRANSACTION_DONE: ('packages', False),
+    alpm.ALPM_EVENT_HOOK_START: ('hooks', True),
+    alpm.ALPM_EVENT_HOOK_DONE: ('hooks', False),
+}
+
+# alpm logs the name of each hook it runs
+_HOOK_NAME_RE = re.compile(r"running hook (?:'|\")?(?P<name>[^'\"\s]+)")
+
+
+class TransactionTelemetry(object):
+    """ Receives alpm callbacks and writes a JSONL trace """
+
+    def __init__(self, path=TRACE_PATH):
+        self.path = path
+        self.trace_file = None
+        self.lock = threading.Lock()
+
+        self.transaction = 0
+        self.transaction_start = None
+        # phase: start time
+        self.open_phases = {}
+        # Current package (name, start time)
+        self.package = None
+        # Current hook (name, start time)
+        self.hook = None
+        self.hooks_run = 0
+        self.last_hook_name = None
+
+        # Totals of all transactions. name: seconds
+        self.phase_times = {}
+        self.package_times = {}
+        self.hook_times = {}
+
+    def write(self, kind, name, **fields):
+        """ Appends a record to the trace """
+        record = {'time': time.time(), 'transaction': self.transaction,
+                  'kind': kind, 'name': name}
+        record.update(fields)
+        with self.lock:
+            try:
+                if self.trace_file is None:
+                    self.trace_file = open(self.path, "w")
+                self.trace_file.write(json.dumps(record) + "\n")
+                self.trace_file.flush()
+            except OSError as os_error:
+                logging.warning("Can't write alpm trace: %s", os_error)
+
+    def transaction_started(self):
+        """ Called before a transaction is prepared """
+        self.transaction += 1
+        self.transaction_start = time.perf_counter()
+        self.open_phases = {}
+        self.write('transaction', 'start')
+
+    def transaction_finished(self, result):
+        """ Called after a transaction has been committed (or not) """
+        self.end_package()
+        self.end_hook()
+        for phase in list(self.open_phases):
+            self.end_phase(phase)
+        duration = 0
+        if self.transaction_start is not None:
+            duration = time.perf_counter() - self.transaction_start
+        self.write('transaction', 'done', duration=duration, ok=result)
+
+    def start_phase(self, phase):
+        """ A phase has started """
+        self.open_phases[phase] = time.perf_counter()
+        self.write('phase', phase, state='start')
+
+    def end_phase(self, phase):
+        """ A phase has finished """
+        start = self.open_phases.pop(phase, None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        self.phase_times[phase] = self.phase_times.get(phase, 0) + duration
+        self.write('phase', phase, state='done', duration=duration)
+
+    def start_package(self, name):
+        """ alpm has started installing a package """
+        self.end_package()
+        self.package = (name, time.perf_counter())
+
+    def end_package(self):
+        """ alpm has finished installing the current package """
+        if self.package is None:
+            return
+        name, start = self.package
+        self.package = None
+        duration = time.perf_counter() - start
+        self.package_times[name] = self.package_times.get(name, 0) + duration
+        self.write('package', name, duration=duration)
+
+    def start_hook(self):
+        """ alpm has started running a hook """
+        self.end_hook()
+        self.hooks_run += 1
+        self.last_hook_name = None
+        self.hook = (time.perf_counter(), self.hooks_run)
+
+    def end_hook(self):
+        """ alpm has finished running the current hook """
+        if self.hook is None:
+            return
+        start, number = self.hook
+        self.hook = None
+        name = self.last_hook_name or "hook #{0}".format(number)
+        duration = time.perf_counter() - start
+        self.hook_times[name] = self.hook_times.get(name, 0) + duration
+        self.write('hook', name, duration=duration)
+
+    def event(self, event_type):
+        """ alpm event callback """
+        if event_type in PHASE_EVENTS:
+            phase, starts = PHASE_EVENTS[event_type]
+            if starts:
+                self.start_phase(phase)
+            else:
+                if phase == 'packages':
+                    self.end_package()
+                self.end_phase(phase)
+        elif event_type == alpm.ALPM_EVENT_PACKAGE_OPERATION_DONE:
+            self.end_package()
+        elif event_type == alpm.ALPM_EVENT_HOOK_RUN_START:
+            self.start_hook()
+        elif event_type == alpm.ALPM_EVENT_HOOK_RUN_DONE:
+            self.end_hook()
+
+    def progress(self, target, percent):
+        """ alpm progress callback """
+        if not target:
+            return
+        if self.package is None or self.package[0] != target:
+            self.start_package(target)
+        if percent >= 100:
+            self.end_package()
+
+    def log_line(self, line):
+        """ alpm log callback (used to get hook names) """
+        if self.hook is not None and self.last_hook_name is None:
+            match = _HOOK_NAME_RE.search(line)
+            if match:
+                self.last_hook_name = match.group('name')
+
+    def get_summary(self, size=SUMMARY_SIZE):
+        """ Returns summary lines (phases and the slowest packages and hooks) """
+        lines = []
+        tables = [
+            ("Phase", self.phase_times, len(self.phase_times)),
+            ("Package", self.package_times, size),
+            ("Hook", self.hook_times, size)]
+        for title, times, limit in tables:
+            if not times:
+                continue
+            lines.append("{0:<40} {1:>10}".format(title, "seconds"))
+            slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)
+            for name, seconds in slowest[:limit]:
+                lines.append("{0:<40} {1:>10.2f}".format(name, seconds))
+        return lines
+
+    def log_summary(self):
+        """ Logs the summary and adds it to the trace """
+        for line in self.get_summary():
+            logging.debug(line)
+        self.write(
+            'summary', 'all',
+            phases=self.phase_times,
+            slowest_packages=sorted(
+                self.package_times.items(),
+                key=lambda item: item[1],
+                reverse=True)[:SUMMARY_SIZE],
+            slowest_hooks=sorted(
+                self.hook_times.items(),
+                key=lambda item: item[1],
+                reverse=True)[:SUMMARY_SIZE])
+
+
+_TELEMETRY = None
+_TELEMETRY_PID = None
+
+
+def get_telemetry():
+    """ Returns this process' transaction telemetry """
+    global _TELEMETRY
+    global _TELEMETRY_PID
+
+    if _TELEMETRY is None or _TELEMETRY_PID != os.getpid():
+        _TELEMETRY = TransactionTelemetry()
+        _TELEMETRY_PID = os.getpid()
+    return _TELEMETRY
@@ -317,8 +317,7 @@ class AutoTimezoneProcess(multiprocessing.Process):
         # Do not start looking for our timezone until we've reached the
         # language screen (welcome.py sets timezone_start to true when
         # next is clicked)
-        while not self.settings.get('timezone_start'):
-            time.sleep(2)
+        self.settings.wait_for('timezone_start')
 
         # OK, now get our timezone
 
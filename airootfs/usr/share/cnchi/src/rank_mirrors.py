@@ -32,9 +32,6 @@
 
 import queue
 import threading
-import urllib.request
-import urllib.error
-import http.client
 import subprocess
 import logging
 import time
@@ -45,8 +42,27 @@ import multiprocessing
 
 import requests
 
+import download.mirror_scores as mirror_scores
+import download.session_pool as session_pool
 import misc.extra as misc
 
+# Maximum time spent ranking Arch mirrors (in seconds)
+TIME_BUDGET = 30
+
+# Phase 1: all mirrors are asked for the headers of a small file
+PROBE_SUBPATH = 'core/os/x86_64/core.db'
+PROBE_TIMEOUT = 3
+PROBE_THREADS = 20
+# Part of TIME_BUDGET phase 1 may use, the rest is left for phase 2
+PROBE_BUDGET = 0.5
+
+# Phase 2: only the RATE_TEST_MIRRORS fastest answering mirrors download
+# the first RATE_TEST_SIZE bytes of a big file
+RATE_TEST_SUBPATH = 'extra/os/x86_64/extra.db'
+RATE_TEST_SIZE = 512 * 1024
+RATE_TEST_MIRRORS = 10
+RATE_TEST_THREADS = 5
+
 
 class AutoRankmirrorsProcess(multiprocessing.Process):
     """ Process class that downloads and sorts the mirrorlist """
@@ -61,6 +77,7 @@ class AutoRankmirrorsProcess(multiprocessing.Process):
         self.arch_mirror_status = "http://www.archlinux.org/mirrors/status/json/"
         self.arch_mirrorlist_ranked = []
         self.settings = settings
+        self.scores = mirror_scores.MirrorScores()
 
     @staticmethod
     def is_good_mirror(m):
@@ -112,7 +129,8 @@ class AutoRankmirrorsProcess(multiprocessing.Process):
 
         if not self.json_obj:
             try:
-                req = requests.get(
+                sessions = session_pool.get_session_pool()
+                req = sessions.get(
                     self.arch_mirror_status,
                     headers={'User-Agent': 'Mozilla/5.0'}
                 )
@@ -123,6 +141,10 @@ class AutoRankmirrorsProcess(multiprocessing.Process):
                     err
                 )
 
+        if not self.json_obj:
+            # Use the mirrors that worked in previous runs
+            return self.scores.get_mirrors()
+
         try:
             # Remove servers that have not synced, and parse the "last_sync"
             # times for comparison later.
@@ -138,97 +160,161 @@ class AutoRankmirrorsProcess(multiprocessing.Process):
         return mirrors
 
     @staticmethod
-    def sort_mirrors_by_speed(mirrors=None, threads=5):
-        # Ensure that "mirrors" is a list and not a generator.
-        if not isinstance(mirrors, list):
-            mirrors = list(mirrors)
-
-        threads = min(threads, len(mirrors))
-
-        rates = {}
+    def probe_latency(sessions, url):
+        """ Returns the seconds needed to get the headers of a small file
+            from the mirror (None if the mirror does not answer) """
+        try:
+            start = time.perf_counter()
+            req = sessions.head(
+                url + PROBE_SUBPATH,
+                timeout=PROBE_TIMEOUT,
+                allow_redirects=False)
+            req.raise_for_status()
+            return time.perf_counter() - start
+        except (OSError, requests.RequestException):
+            return None
 
-        # Check version of cryptsetup pkg (used to test mirror speed)
+    @staticmethod
+    def probe_rate(sessions, url, timeout):
+        """ Returns the download rate (bytes/s) of the first RATE_TEST_SIZE
+            bytes of a big file of the mirror (0 if the download fails) """
+        headers = {'Range': 'bytes=0-{0}'.format(RATE_TEST_SIZE - 1)}
+        size = 0
         try:
-            cmd = ["pacman", "-Ss", "cryptsetup"]
-            line = subprocess.check_output(cmd).decode().split()
-            version = line[1]
-            logging.debug('cryptsetup version is: %s', version)
-        except subprocess.CalledProcessError as err:
-            logging.debug(err)
-            version = False
-
-        # URL input queue.Queue
+            start = time.perf_counter()
+            req = sessions.get(
+                url + RATE_TEST_SUBPATH,
+                headers=headers,
+                timeout=timeout,
+                stream=True)
+            with req:
+                req.raise_for_status()
+                # Servers that do not support ranges send the whole file
+                for chunk in req.iter_content(64 * 1024):
+                    size += len(chunk)
+                    if size >= RATE_TEST_SIZE:
+                        break
+            elapsed = time.perf_counter() - start
+        except (OSError, requests.RequestException):
+            return 0
+        if elapsed <= 0:
+            return 0
+        return size / elapsed
+
+    @staticmethod
+    def run_probes(items, probe, threads, deadline):
+        """ Runs probe(item) in threads. Yields (item, result) as soon as
+            each result arrives, until all of them are done or the deadline
+            (time.monotonic() value) is reached """
         q_in = queue.Queue()
-        # URL and rate output queue.Queue
         q_out = queue.Queue()
 
         def worker():
-            """ worker thread. Retrieves data to test mirror speed """
-            while True:
-                url = q_in.get()
-                if version:
-                    db_subpath = 'core/os/x86_64/cryptsetup-{0}-x86_64.pkg.tar.xz'
-                    db_subpath = db_subpath.format(version)
-                else:
-                    db_subpath = 'core/os/x86_64/core.db.tar.gz'
-                db_url = url + db_subpath
-                # Leave the rate as 0 if the connection fails.
-                # TODO: Consider more graceful error handling.
-                rate = 0
-                dt = float('NaN')
-
-                req = urllib.request.Request(url=db_url)
+            """ Worker thread. Probes items until there are no more """
+            while time.monotonic() < deadline:
                 try:
-                    t0 = time.time()
-                    with urllib.request.urlopen(req, None, 5) as f:
-                        size = len(f.read())
-                        dt = time.time() - t0
-                        rate = size / dt
-                except (OSError,
-                        urllib.error.HTTPError,
-                        http.client.HTTPException):
-                    pass
-                q_out.put((url, rate, dt))
-                q_in.task_done()
-
-        # Launch threads
-        for i in range(threads):
-            t = threading.Thread(target=worker)
-            t.start()
-
-        # Load the input queue.Queue
-        url_len = 0
-        for mirror in mirrors:
-            url_len = max(url_len, len(mirror['url']))
-            logging.debug("Rating mirror '%s'", mirror['url'])
-            q_in.put(mirror['url'])
+                    item = q_in.get_nowait()
+                except queue.Empty:
+                    return
+                q_out.put((item, probe(item)))
+
+        for item in items:
+            q_in.put(item)
+
+        for _i in range(min(threads, len(items))):
+            thread = threading.Thread(target=worker)
+            # Do not let a slow mirror delay Cnchi's exit
+            thread.daemon = True
+            thread.start()
+
+        for _i in range(len(items)):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                yield q_out.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+    @staticmethod
+    def sort_mirrors_by_speed(mirrors=None, threads=PROBE_THREADS,
+                              on_ranked=None, time_budget=TIME_BUDGET,
+                              scores=None):
+        """ Sorts mirrors in two phases. First, all of them are probed with
+            a cheap HEAD request (latency). Then the download rate of the
+            RATE_TEST_MIRRORS fastest ones is tested with a small Range
+            request. Mirrors not rate tested are kept after the tested ones
+            (by latency). Mirrors that do not answer are removed.
+            on_ranked(mirrors) is called each time the ranking improves.
+            The whole ranking takes at most time_budget seconds, and the
+            first phase at most PROBE_BUDGET of it.
+            Measurements are stored in scores (MirrorScores), if given """
+        # Ensure that "mirrors" is a list and not a generator.
+        if not isinstance(mirrors, list):
+            mirrors = list(mirrors)
 
-        q_in.join()
+        start = time.monotonic()
+        deadline = start + time_budget
+        probe_deadline = start + time_budget * PROBE_BUDGET
+        sessions = session_pool.get_session_pool()
+        by_url = dict((mirror['url'], mirror) for mirror in mirrors)
+
+        # Phase 1: latency
+        latencies = {}
+        probes = AutoRankmirrorsProcess.run_probes(
+            list(by_url.keys()),
+            lambda url: AutoRankmirrorsProcess.probe_latency(sessions, url),
+            threads,
+            probe_deadline)
+        for url, latency in probes:
+            if latency is not None:
+                latencies[url] = latency
+            if scores is not None:
+                scores.update(by_url[url], latency=latency)
+        by_latency = sorted(latencies, key=lambda url: latencies[url])
+        logging.debug(
+            "%d of %d mirrors answered the latency probe",
+            len(by_latency),
+            len(mirrors))
+
+        # Phase 2: download rate of the best ones
+        rates = {}
+
+        def get_ranking():
+            """ Rate tested mirrors (fastest first) and then the others """
+            tested = [url for url in by_latency if rates.get(url, 0) > 0]
+            tested.sort(key=lambda url: rates[url], reverse=True)
+            untested = [url for url in by_latency if url not in rates]
+            return [by_url[url] for url in tested + untested]
+
+        if on_ranked is not None and by_latency:
+            on_ranked(get_ranking())
+        candidates = by_latency[:RATE_TEST_MIRRORS]
+        probes = AutoRankmirrorsProcess.run_probes(
+            candidates,
+            lambda url: AutoRankmirrorsProcess.probe_rate(
+                sessions, url, max(0.1, deadline - time.monotonic())),
+            RATE_TEST_THREADS,
+            deadline)
+        for url, rate in probes:
+            rates[url] = rate
+            if scores is not None:
+                scores.update_rate(url, rate)
+            if on_ranked is not None and rate > 0:
+                on_ranked(get_ranking())
 
         # Log some extra data.
-        url_len = str(url_len)
+        url_len = str(max([len(url) for url in by_latency] or [0]))
         logging.debug(
             ('%-' + url_len + 's  %14s  %9s'),
             _("Server"),
             _("Rate"),
-            _("Time"))
+            _("Latency"))
+        fmt = '%-' + url_len + 's  %8.2f KiB/s  %7.3f s'
+        for url in by_latency:
+            logging.debug(fmt, url, rates.get(url, 0) / 1024.0, latencies[url])
 
-        fmt = '%-' + url_len + 's  %8.2f KiB/s  %7.2f s'
-
-        # Loop over the mirrors just to ensure that we get the rate for each.
-        # The value in the loop does not (necessarily) correspond to the mirror.
-        for mirror in mirrors:
-            url, rate, dt = q_out.get()
-            kibps = rate / 1024.0
-            logging.debug(fmt, url, kibps, dt)
-            rates[url] = rate
-            q_out.task_done()
-
-        # Sort by rate.
-        rated_mirrors = [m for m in mirrors if rates[m['url']] > 0]
-        rated_mirrors.sort(key=lambda m: rates[m['url']], reverse=True)
-
-        return rated_mirrors
+        return get_ranking()
 
     def uncomment_antergos_mirrors(self):
         """ Uncomment Antergos mirrors and comment out auto selection so
@@ -288,10 +374,32 @@ class AutoRankmirrorsProcess(multiprocessing.Process):
                         why)
             self.sync()
 
+    def store_partial_ranking(self, mirrors):
+        """ Lets the downloader use the best Arch mirrors found so far """
+        ranked = [mirror['url'] for mirror in mirrors if mirror['url']]
+        self.settings.set('rankmirrors_result', ranked)
+
     def filter_and_sort_arch_mirrorlist(self):
         output = '# Arch Linux mirrorlist generated by Cnchi #\n'
+        self.scores.load()
         mlist = self.get_mirror_stats()
-        mirrors = self.sort_mirrors_by_speed(mirrors=mlist)
+        candidates = self.scores.get_candidates(
+            mlist, self.settings.get('country_code'))
+        known = [m for m in candidates if self.scores.is_good(m['url'])]
+        if known:
+            # Use the order of previous runs until we have our own
+            self.store_partial_ranking(known)
+        logging.debug(
+            "Ranking %d of %d Arch mirrors (%d known from previous runs)",
+            len(candidates),
+            len(mlist),
+            len(known))
+        mirrors = self.sort_mirrors_by_speed(
+            mirrors=candidates,
+            on_ranked=self.store_partial_ranking,
+            scores=self.scores)
+        with misc.raised_privileges() as __:
+            self.scores.save()
 
         for mirror in mirrors:
             self.arch_mirrorlist_ranked.append(mirror['url'])
@@ -326,6 +434,9 @@ class AutoRankmirrorsProcess(multiprocessing.Process):
         self.arch_mirrorlist_ranked = [
             x for x in self.arch_mirrorlist_ranked if x]
         self.settings.set('rankmirrors_result', self.arch_mirrorlist_ranked)
+        self.settings.set('rankmirrors_done', True)
+
+        session_pool.get_session_pool().log_stats()
 
         logging.debug("Auto mirror selection has been run successfully.")
 
@@ -138,6 +138,7 @@ def run(page_name):
     import config
 
     settings = config.Settings()
+    config.settings = settings
     settings.set('data', '/usr/share/cnchi/data')
 
     from desktop_info import DESKTOPS